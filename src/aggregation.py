@@ -0,0 +1,282 @@
+import argparse
+import json
+import re
+import sys
+from datetime import datetime, timedelta
+from typing import Iterable, List
+
+import numpy as np
+import requests
+from api_types import StreamQuery, StreamQueryAggregate
+from client import DataApiClient, client_from_env
+from filters import add_where_argument, where_filter
+from planner import matches_sensor
+from utils import response_data, to_epoch_ms, from_epoch_ms
+
+FUNCTIONS = ('count', 'sum', 'avg', 'min', 'max')
+UNIT_MS = {
+    's': 1000, 'sec': 1000, 'second': 1000,
+    'm': 60 * 1000, 'min': 60 * 1000, 'minute': 60 * 1000,
+    'h': 60 * 60 * 1000, 'hour': 60 * 60 * 1000,
+    'd': 24 * 60 * 60 * 1000, 'day': 24 * 60 * 60 * 1000,
+    'w': 7 * 24 * 60 * 60 * 1000, 'week': 7 * 24 * 60 * 60 * 1000,
+}
+ISO_DURATION = re.compile(r'^P(?:(?P<d>\d+)D)?(?:T(?:(?P<h>\d+)H)?(?:(?P<m>\d+)M)?(?:(?P<s>\d+(?:\.\d+)?)S)?)?$')
+# HTTP status codes which mean the aggregate endpoint isn't available, rather than the query being wrong
+UNSUPPORTED_STATUS = (404, 405, 501)
+
+
+def interval_ms(interval: str) -> int:
+    """Parse an aggregation interval such as ``15m``, ``1 hour`` or ``PT15M`` to milliseconds."""
+    text = interval.strip()
+    iso = ISO_DURATION.match(text.upper())
+    if iso and any(iso.groupdict().values()):
+        parts = {k: float(v) if v else 0 for k, v in iso.groupdict().items()}
+        return _positive(int((((parts['d'] * 24 + parts['h']) * 60 + parts['m']) * 60 + parts['s']) * 1000), interval)
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([a-zA-Z]+)$', text)
+    if match:
+        unit = match.group(2).lower()
+        if unit.endswith('s') and unit[:-1] in UNIT_MS:
+            unit = unit[:-1]
+        if unit in UNIT_MS:
+            return _positive(int(float(match.group(1)) * UNIT_MS[unit]), interval)
+    raise ValueError(f'Unsupported aggregation interval {interval}')
+
+
+def _positive(ms: int, interval: str) -> int:
+    if ms <= 0:
+        raise ValueError(f'Aggregation interval {interval} must be at least 1 ms')
+    return ms
+
+
+def event_value(event) -> float:
+    value = event.get('value') if isinstance(event, dict) else event.value
+    if isinstance(value, (int, float)):
+        return float(value)
+    return np.nan
+
+
+def event_fields(event):
+    """(sensor name, sensor ID, epoch ms, numeric value) of an event dict or ``SensorEvent``."""
+    if isinstance(event, dict):
+        return (event.get('sensorName'), event.get('sensorId'), to_epoch_ms(event['timeCollected']),
+                event_value(event))
+    return event.sensor_name, event.sensor_id, event.time_ms, event_value(event)
+
+
+def requested_sensor(sensor_name, sensor_id, requested: List[str]):
+    """The sensor of ``requested`` (a query's sensors) which a sensor name and ID belong to, else its name or ID, so
+    rows are labelled with the sensors as they were asked for."""
+    ids = {'sensorName': sensor_name, 'sensorId': sensor_id}
+    for sensor in requested:
+        if matches_sensor(ids, sensor):
+            return sensor
+    return sensor_name or sensor_id
+
+
+def _row(sensor, window_start: int, window_end: int) -> dict:
+    return {'sensor': sensor, 'windowStart': from_epoch_ms(window_start).isoformat(),
+            'windowEnd': from_epoch_ms(window_end).isoformat()}
+
+
+def _sort_rows(rows: List[dict], query: StreamQueryAggregate) -> List[dict]:
+    descending = bool(query.order) and query.order.lower().startswith('desc')
+    rows.sort(key=lambda r: r['windowStart'], reverse=descending)
+    return rows
+
+
+def aggregate_events(events: Iterable, query: StreamQueryAggregate) -> List[dict]:
+    """Aggregate events locally with the semantics of ``query_stream_aggregate``.
+
+    Events are grouped by sensor into windows of ``query.interval`` starting at ``query.start_time``.  Each result
+    row has the sensor, window bounds and one key per requested function; ``count`` counts events while the other
+    functions use the numeric ``value`` of each event.  Windows without events are only included when
+    ``fill_empty_windows`` is set, with a count of 0 and no value for the other functions.
+    """
+    functions = [f.lower() for f in query.functions]
+    for function in functions:
+        if function not in FUNCTIONS:
+            raise ValueError(f'Unsupported aggregation function {function}, expected one of {FUNCTIONS}')
+    start, end = to_epoch_ms(query.start_time), to_epoch_ms(query.end_time)
+    step = interval_ms(query.interval)
+    num_windows = max(-(-(end - start) // step), 0)
+
+    requested = list(query.sensors or [])
+    by_sensor = {sensor: ([], []) for sensor in requested} if query.fill_empty_windows else {}
+    labels = {}
+    for event in events:
+        sensor_name, sensor_id, time_ms, value = event_fields(event)
+        ids = (sensor_name, sensor_id)
+        if ids not in labels:
+            labels[ids] = requested_sensor(sensor_name, sensor_id, requested)
+        times, values = by_sensor.setdefault(labels[ids], ([], []))
+        times.append(time_ms)
+        values.append(value)
+
+    rows = []
+    for sensor, (times, values) in by_sensor.items():
+        times = np.asarray(times, dtype=np.int64)
+        values = np.asarray(values, dtype=float)
+        in_range = (times >= start) & (times < end)
+        window = (times[in_range] - start) // step
+        values = values[in_range]
+        numeric = ~np.isnan(values)
+
+        counts = np.bincount(window, minlength=num_windows)
+        numeric_counts = np.bincount(window[numeric], minlength=num_windows)
+        sums = np.bincount(window[numeric], weights=values[numeric], minlength=num_windows)
+        results = {'count': counts}
+        if 'sum' in functions:
+            results['sum'] = sums
+        if 'avg' in functions:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                results['avg'] = sums / numeric_counts
+        if 'min' in functions:
+            results['min'] = np.full(num_windows, np.inf)
+            np.minimum.at(results['min'], window[numeric], values[numeric])
+        if 'max' in functions:
+            results['max'] = np.full(num_windows, -np.inf)
+            np.maximum.at(results['max'], window[numeric], values[numeric])
+
+        for i in range(num_windows):
+            if counts[i] == 0 and not query.fill_empty_windows:
+                continue
+            window_start = start + i * step
+            row = _row(sensor, window_start, min(window_start + step, end))
+            for function in functions:
+                if function == 'count':
+                    row['count'] = int(counts[i])
+                elif numeric_counts[i] == 0:
+                    row[function] = None
+                else:
+                    row[function] = float(results[function][i])
+            rows.append(row)
+    return _sort_rows(rows, query)
+
+
+def _first(row: dict, *keys):
+    for key in keys:
+        if row.get(key) is not None:
+            return row[key]
+    return None
+
+
+def server_rows(response, query: StreamQueryAggregate) -> List[dict]:
+    """Rows of a ``query_stream_aggregate`` response in the shape of ``aggregate_events`` rows, so results of the
+    server and the local engine can be used alike.  Function values may be keys of the row or of its ``values``."""
+    functions = [f.lower() for f in query.functions]
+    step, end = interval_ms(query.interval), to_epoch_ms(query.end_time)
+    requested = list(query.sensors or [])
+    rows = []
+    for raw in response_data(response) or []:
+        if not isinstance(raw, dict):
+            continue
+        window_start = _first(raw, 'windowStart', 'startTime', 'start', 'timestamp', 'time', 'timeCollected')
+        if window_start is None:
+            raise ValueError(f'Aggregate row without a window start: {raw}')
+        window_start = to_epoch_ms(window_start)
+        window_end = _first(raw, 'windowEnd', 'endTime', 'end')
+        window_end = min(window_start + step, end) if window_end is None else to_epoch_ms(window_end)
+        sensor = requested_sensor(_first(raw, 'sensor', 'sensorName', 'name'), raw.get('sensorId'), requested)
+        row = _row(sensor, window_start, window_end)
+        values = raw['values'] if isinstance(raw.get('values'), dict) else raw
+        for function in functions:
+            value = values.get(function)
+            if function == 'count':
+                row['count'] = int(value or 0)
+            else:
+                row[function] = None if value is None else float(value)
+        rows.append(row)
+    return _sort_rows(rows, query)
+
+
+class AggregatePlanner:
+    """Routes aggregate queries to the server aggregate endpoint, falling back to aggregating events locally.
+
+    When a ``store`` (an ``EventStore``) is given, queries are aggregated locally from the stored events without
+    any request.  Otherwise the local fallback aggregates events fetched with ``query_stream_flat`` without meta.
+    An ``event_filter`` (see filters.py) is applied to the events before aggregating, which always happens locally.
+    Once the server reports the aggregate endpoint as unavailable, later queries go straight to the local engine.
+    Either way the result is a list of rows as described in ``aggregate_events`` (see ``server_rows``).
+    """
+
+    def __init__(self, client: DataApiClient, store=None, use_server: bool = True, event_filter=None):
+        self.client = client
+        self.store = store
+        self.use_server = use_server and event_filter is None
+        self.event_filter = event_filter
+        self.last_source = None
+
+    def aggregate(self, query: StreamQueryAggregate):
+        if self.use_server and self.store is None:
+            try:
+                result = self.client.query_stream_aggregate(query)
+                self.last_source = 'server'
+                return server_rows(result, query)
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code not in UNSUPPORTED_STATUS:
+                    raise
+                print(f'Aggregate endpoint unavailable ({e.response.status_code}), aggregating locally')
+                self.use_server = False
+
+        flat_query = StreamQuery(stream_id=query.stream_id, device_id=query.device_id, sensors=query.sensors,
+                                 start_time=query.start_time, end_time=query.end_time,
+                                 with_meta=bool(self.event_filter and self.event_filter.uses_meta))
+        if self.store is not None:
+            events = self.store.query_stream_flat(flat_query)
+            self.last_source = 'store'
+        elif hasattr(self.client, 'query_stream_flat_typed'):
+            # decoded into compact structs, which matters for the large responses aggregated locally
+            events = self.client.query_stream_flat_typed(flat_query)
+            self.last_source = 'local'
+        else:
+            events = self.client.query_stream_flat(flat_query)
+            self.last_source = 'local'
+        if self.event_filter:
+            events = self.event_filter.apply(events)
+        return aggregate_events(events, query)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Aggregate stream events into time windows.')
+    parser.add_argument('--stream_id', dest='stream_id', help='stream_id to aggregate', required=True)
+    parser.add_argument('--sensors', dest='sensors', help='comma separated sensors to aggregate', required=True)
+    parser.add_argument('--interval', default='1h', help='window size, e.g. 15m, 1h, 1d or PT15M.  Defaults to 1h.')
+    parser.add_argument('--functions', default='count',
+                        help=f'comma separated aggregation functions out of {", ".join(FUNCTIONS)}.  '
+                             'Defaults to count.')
+    parser.add_argument('--lastHours', type=int, default=24, help='number of hours to aggregate.  Defaults to 24.')
+    parser.add_argument('--fill_empty_windows', action='store_true', help='include windows with no events')
+    parser.add_argument('--order', default='asc', help='order of windows, asc or desc')
+    parser.add_argument('--local', action='store_true',
+                        help='aggregate locally instead of using the server aggregate endpoint')
+    parser.add_argument('--store', help='aggregate events from this local event store directory')
+    add_where_argument(parser)
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) == 0:
+        parser.print_help()
+        sys.exit(1)
+    args = parser.parse_args(argv)
+
+    client = client_from_env()
+    store = None
+    if args.store:
+        from event_store import EventStore
+        store = EventStore(args.store)
+
+    end = datetime.utcnow()
+    query = StreamQueryAggregate(stream_id=args.stream_id, device_id=None, sensors=args.sensors.split(','),
+                                 start_time=end - timedelta(hours=args.lastHours), end_time=end,
+                                 interval=args.interval, functions=args.functions.split(','),
+                                 fill_empty_windows=args.fill_empty_windows, order=args.order)
+    # the server can't filter, so filtered aggregates are computed locally
+    planner = AggregatePlanner(client, store=store, use_server=not args.local, event_filter=where_filter(args.where))
+    result = planner.aggregate(query)
+    print(json.dumps(result, indent=2))
+    print(f'Aggregated by {planner.last_source}')
+
+
+if __name__ == '__main__':
+    main()
@@ -38,6 +38,38 @@ class JsonObject:
 
         return json.dumps(self, default=json_default, sort_keys=True, indent=4)
 
+    def to_dict(self) -> dict:
+        """
+        The query's attributes as a JSON compatible dict, for passing queries between processes.
+
+        Datetimes and enums are tagged so ``from_dict`` can restore them.
+        """
+        def encode(value):
+            if isinstance(value, datetime.datetime):
+                return {'__datetime__': value.isoformat()}
+            if isinstance(value, Enum):
+                return {'__enum__': type(value).__name__, 'name': value.name}
+            return value
+
+        return {key: encode(value) for key, value in self.__dict__.items()}
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        """
+        Rebuild a query from ``to_dict`` output without calling ``__init__``, so attributes converted by the
+        constructor (e.g. ``SensorsByDeviceQuery`` times) are restored as they were.
+        """
+        def decode(value):
+            if isinstance(value, dict) and '__datetime__' in value:
+                return datetime.datetime.fromisoformat(value['__datetime__'])
+            if isinstance(value, dict) and '__enum__' in value:
+                return globals()[value['__enum__']][value['name']]
+            return value
+
+        query = cls.__new__(cls)
+        query.__dict__.update({key: decode(value) for key, value in d.items()})
+        return query
+
 
 class InProgressEvents(Enum):
     NONE = 1
@@ -185,6 +217,31 @@ class LatestStatusByWorkspaceQuery(JsonObject):
     def __init__(self, workspace_id):
         self.workspace_id = workspace_id
 
+
+class SensorQuery(JsonObject):
+    """
+
+    """
+
+    device_id: str
+    sensors: List[str]
+    start_time: str
+    end_time: str
+    with_meta: bool
+
+    def __init__(self,
+                 device_id: str,
+                 sensors: List[str],
+                 start_time: str,
+                 end_time: str,
+                 with_meta: bool = None):
+        self.device_id = device_id
+        self.sensors = sensors
+        self.start_time = start_time
+        self.end_time = end_time
+        self.with_meta = with_meta
+
+
 class SensorsByDeviceQuery(JsonObject):
     """
 
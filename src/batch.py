@@ -0,0 +1,333 @@
+import argparse
+import bisect
+import datetime
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List
+
+from media_cache import MediaCache, cache_key, link_or_copy, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE_MB
+from profiling import profiler
+from storage import StorageBackend, backend_for
+
+DEFAULT_JOBS = 4
+# seconds a cached listing is used for; a day's prefix keeps growing while the day is being recorded
+DEFAULT_LISTING_TTL = 300
+
+
+class SharedBackend(StorageBackend):
+    """Wraps the storage backend of a batch so jobs share its work.
+
+    Each ``(bucket, prefix)`` is listed once (for ``listing_ttl`` seconds) and offset ranges are answered from the
+    sorted listing, and source videos are downloaded once into a ``MediaCache`` and linked to where each job wants
+    them.  Concurrent requests for the same listing or video wait for the first one, and a cached video is pinned
+    until it is linked so no other job's eviction removes it.
+    """
+
+    def __init__(self, backend: StorageBackend, cache: MediaCache = None, listing_ttl: float = DEFAULT_LISTING_TTL):
+        self.backend = backend
+        self.cache = cache
+        self.listing_ttl = listing_ttl
+        self.listings = {'hits': 0, 'misses': 0}
+        self._listings: Dict[tuple, tuple] = {}
+        self._locks: Dict[tuple, threading.Lock] = {}
+        self._lock = threading.Lock()
+        # cache keys being downloaded or linked, with the number of jobs using each
+        self._pinned: Dict[str, int] = {}
+
+    def _key_lock(self, key: tuple) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def list(self, bucket, prefix, start_offset=None, end_offset=None):
+        key = ('list', bucket, prefix)
+        with self._key_lock(key):
+            cached = self._listings.get(key)
+            if cached and time.monotonic() - cached[0] < self.listing_ttl:
+                self.listings['hits'] += 1
+                profiler.count('batch.listing_hits')
+            else:
+                self.listings['misses'] += 1
+                profiler.count('batch.listing_misses')
+                cached = self._listings[key] = (time.monotonic(), self.backend.list(bucket, prefix))
+        names = cached[1]
+        start = bisect.bisect_left(names, start_offset) if start_offset else 0
+        end = bisect.bisect_left(names, end_offset) if end_offset else len(names)
+        return names[start:end]
+
+    def download(self, bucket, name, filename):
+        if self.cache is None:
+            return self.backend.download(bucket, name, filename)
+        key = cache_key(url=f'gs://{bucket}/{name}')
+        # pinned before it is looked up, and evictions run under the same lock, so the file stays until it is linked
+        with self._lock:
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+        try:
+            with self._key_lock(('download', key)):
+                path = self.cache.get(key)
+                if path:
+                    self.cache.hits += 1
+                    profiler.count('media_cache.hits')
+                else:
+                    self.cache.misses += 1
+                    profiler.count('media_cache.misses')
+                    path = self.cache.put(key, lambda partial: self.backend.download(bucket, name, partial))
+                    with self._lock:
+                        self.cache.evict(keep={self.cache.path(pinned) for pinned in self._pinned})
+            link_or_copy(path, filename)
+        finally:
+            with self._lock:
+                self._pinned[key] -= 1
+                if not self._pinned[key]:
+                    del self._pinned[key]
+
+    def read(self, bucket, name, start=0, end=None):
+        return self.backend.read(bucket, name, start, end)
+
+    def upload(self, filename, bucket, name):
+        return self.backend.upload(filename, bucket, name)
+
+    def open_read(self, bucket, name):
+        return self.backend.open_read(bucket, name)
+
+    def upload_stream(self, stream, bucket, name):
+        return self.backend.upload_stream(stream, bucket, name)
+
+    def link(self, bucket, name):
+        return self.backend.link(bucket, name)
+
+    def size(self, bucket, name):
+        return self.backend.size(bucket, name)
+
+
+def load_manifest(path: str) -> List[dict]:
+    """Jobs of a manifest: a JSON lines file with one job per line, or a YAML file with a list of jobs or
+    ``{defaults: {...}, jobs: [...]}``.  A job maps ``data-api.py query`` options to values, plus an optional ``id``.
+    """
+    defaults = {}
+    if path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise SystemExit('YAML manifests need PyYAML: pip install pyyaml')
+        with open(path) as f:
+            document = yaml.safe_load(f) or []
+        if isinstance(document, dict):
+            defaults = document.get('defaults') or {}
+            document = document.get('jobs') or []
+        jobs = document
+    else:
+        with open(path) as f:
+            jobs = [json.loads(line) for line in f if line.strip() and not line.lstrip().startswith('#')]
+    return [{**defaults, **job} for job in jobs]
+
+
+def job_id(job: dict) -> str:
+    """The job's ``id``, or a hash of its options, so a job keeps its ID across runs of the same manifest."""
+    if job.get('id'):
+        return str(job['id'])
+    return hashlib.sha1(json.dumps(job, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+def job_arguments(job: dict) -> List[str]:
+    """``data-api.py query`` arguments of a job: ``true`` is a flag, lists are comma separated and dates (which YAML
+    parses) are ISO formatted."""
+    argv = []
+    for option, value in job.items():
+        if option == 'id' or value is None or value is False:
+            continue
+        if value is True:
+            argv.append(f'--{option}')
+        elif isinstance(value, datetime.date):
+            argv.append(f'--{option}={value.isoformat()}')
+        elif isinstance(value, (list, tuple)):
+            argv.append(f'--{option}={",".join(str(v) for v in value)}')
+        else:
+            argv.append(f'--{option}={value}')
+    return argv
+
+
+def schedule(jobs: List[dict]) -> List[List[dict]]:
+    """Group jobs for locality: one group per output (or per device for jobs without one), run in order by one worker.
+
+    Jobs writing to the same output must not run concurrently since clips are trimmed in <output>/tmp, which each job
+    removes when it ends.  Within a group jobs run by device and start time, so consecutive jobs share a device's
+    video listings and source videos, and the biggest groups are started first.
+    """
+    groups = {}
+    for job in jobs:
+        output = str(job.get('output') or '')
+        groups.setdefault(('output', output) if output else ('device', str(job.get('deviceId') or '')), []).append(job)
+    for group in groups.values():
+        group.sort(key=lambda job: (str(job.get('deviceId') or ''), str(job.get('startTime') or '')))
+    return sorted(groups.values(), key=len, reverse=True)
+
+
+def read_status(path: str) -> set:
+    """IDs of the jobs a previous run completed."""
+    done = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry.get('status') == 'done':
+                    done.add(entry['job'])
+    return done
+
+
+class _ThreadOutput:
+    """sys.stdout (or stderr) replacement sending each thread's output to the file it set, so concurrent jobs get
+    their own logs."""
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def _target(self):
+        return getattr(self.local, 'file', None) or self.default
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+
+def run_job(job: dict, client, backend, log_dir: str, outputs: List[_ThreadOutput]) -> dict:
+    import sensor_query
+    identifier = job_id(job)
+    started = time.perf_counter()
+    entry = {'job': identifier}
+    with open(os.path.join(log_dir, f'{identifier}.log'), 'w') as log:
+        for output in outputs:
+            output.local.file = log
+        try:
+            with profiler.span('job', 'batch', id=identifier):
+                events = sensor_query.main(job_arguments(job), client=client, backend=backend)
+            entry.update(status='done', events=len(events or []))
+        except SystemExit as e:
+            # the query tool exits on invalid arguments and failed uploads
+            entry.update(status='failed', error=f'exited with {e.code}')
+        except Exception as e:
+            entry.update(status='failed', error=f'{type(e).__name__}: {e}')
+        finally:
+            for output in outputs:
+                output.local.file = None
+    entry['seconds'] = round(time.perf_counter() - started, 3)
+    return entry
+
+
+def run_batch(jobs: List[dict], client, backend, status_path: str, log_dir: str, workers: int = DEFAULT_JOBS,
+              rerun: bool = False) -> dict:
+    """Run jobs in ``workers`` threads sharing the client and backend, appending each outcome to the status file.
+
+    Jobs recorded as done in the status file are skipped (unless ``rerun``), so running a manifest again only runs
+    the jobs which failed or didn't run.
+    """
+    done = set() if rerun else read_status(status_path)
+    pending = [job for job in jobs if job_id(job) not in done]
+    summary = {'jobs': len(jobs), 'skipped': len(jobs) - len(pending), 'done': 0, 'failed': 0, 'events': 0}
+    if not pending:
+        return summary
+    os.makedirs(log_dir, exist_ok=True)
+    groups = schedule(pending)
+    output, errors = _ThreadOutput(sys.stdout), _ThreadOutput(sys.stderr)
+    lock = threading.Lock()
+    started = time.perf_counter()
+
+    def run_group(group: List[dict]):
+        for job in group:
+            entry = run_job(job, client, backend, log_dir, [output, errors])
+            with lock:
+                summary[entry['status']] += 1
+                summary['events'] += entry.get('events', 0)
+                status.write(json.dumps(entry) + '\n')
+                status.flush()
+                finished = summary['done'] + summary['failed']
+                error = f': {entry["error"]}' if 'error' in entry else ''
+                print(f'[{finished}/{len(pending)}] {entry["job"]} {entry["status"]} in {entry["seconds"]}s{error}',
+                      file=output.default)
+
+    sys.stdout, sys.stderr = output, errors
+    try:
+        with open(status_path, 'a') as status, ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in as_completed([executor.submit(run_group, group) for group in groups]):
+                future.result()
+    finally:
+        sys.stdout, sys.stderr = output.default, errors.default
+    summary['seconds'] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+def explain_batch(jobs: List[dict], client, backend, status_path: str, workers: int = DEFAULT_JOBS,
+                  rerun: bool = False) -> dict:
+    """Estimate of running the jobs which ``run_batch`` would run, from each job's ``--explain`` estimate."""
+    import explain
+    import sensor_query
+    done = set() if rerun else read_status(status_path)
+    estimates = []
+    for job in jobs:
+        if job_id(job) in done:
+            continue
+        estimate = sensor_query.main(job_arguments(job) + ['--explain'], client=client, backend=backend)
+        estimates.append(estimate)
+    summary = explain.total(estimates, workers)
+    explain.print_estimate(summary)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a manifest of data-api.py query and clip jobs in one process, sharing the API connection '
+                    'pool, video listings and a source video cache between them.')
+    parser.add_argument('manifest', help='JSON lines or YAML file of jobs.  Each job maps `data-api.py query` options '
+                                         '(deviceId, sensors, startTime, lastDays, downloadEventClips, output, ...) '
+                                         'to values, and may have an id.')
+    parser.add_argument('--jobs', '-j', type=int, default=DEFAULT_JOBS,
+                        help=f'number of jobs run concurrently.  Defaults to {DEFAULT_JOBS}.')
+    parser.add_argument('--status', help='JSON lines file to append each job\'s outcome to.  Jobs done according to '
+                                         'it are skipped.  Defaults to <manifest>.status.jsonl.')
+    parser.add_argument('--logs', help='directory for the output of each job.  Defaults to <manifest>.logs/.')
+    parser.add_argument('--rerun', action='store_true', help='run every job, even those already done')
+    parser.add_argument('--explain', action='store_true',
+                        help='estimate what the jobs would cost (see `data-api.py query --explain`) without running them')
+    parser.add_argument('--key', help='API key.  Defaults to $API_KEY.')
+    parser.add_argument('--mediaRoot', default=os.environ.get('DATA_API_MEDIA_ROOT'),
+                        help='local directory mirroring the GCP buckets, used instead of Google Cloud Storage')
+    parser.add_argument('--cache_dir', default=DEFAULT_CACHE_DIR, help='source video cache directory')
+    parser.add_argument('--cache_size_mb', type=int, default=DEFAULT_CACHE_SIZE_MB,
+                        help=f'maximum size of the source video cache.  Defaults to {DEFAULT_CACHE_SIZE_MB}.')
+    parser.add_argument('--listing_ttl', type=float, default=DEFAULT_LISTING_TTL,
+                        help=f'seconds a video listing is reused for.  Defaults to {DEFAULT_LISTING_TTL}.')
+    args = parser.parse_args(argv)
+
+    from client import client_from_env
+    jobs = load_manifest(args.manifest)
+    base = os.path.splitext(args.manifest)[0]
+    client = client_from_env(args.key)
+    backend = SharedBackend(backend_for(args.mediaRoot, use_service_account=True),
+                            MediaCache(args.cache_dir, args.cache_size_mb * 1024 * 1024), args.listing_ttl)
+    status_path = args.status or base + '.status.jsonl'
+    if args.explain:
+        explain_batch(jobs, client, backend, status_path, args.jobs, args.rerun)
+        return
+    print(f'Running {len(jobs)} job(s) from {args.manifest} with {args.jobs} worker(s)')
+    summary = run_batch(jobs, client, backend, status_path, args.logs or base + '.logs', args.jobs, args.rerun)
+    summary['listings'] = backend.listings
+    summary['videoCache'] = {'hits': backend.cache.hits, 'misses': backend.cache.misses}
+    if hasattr(client, 'transfer_summary'):
+        summary['transfer'] = client.transfer_summary()
+    print(json.dumps(summary, indent=2))
+    if summary['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import dateutil.parser
+import dateutil.tz
+
+from profiling import profiler
+from sensor_query import VIDEO_LENTH_MINUTES, downloadEventClips, uploadEventClips, video_file_name, video_prefix
+from storage import LocalBackend
+
+DEVICE_ID = 'BAI_BENCH01'
+
+
+def generate_videos(backend: LocalBackend, args, start: datetime.datetime, count: int, size: str, rate: int):
+    """Write ``count`` consecutive synthetic videos of VIDEO_LENTH_MINUTES each, laid out as in bai-rawdata.
+
+    Existing videos are kept, so repeated runs only pay for generation once.  Returns the time covered.
+    """
+    import ffmpeg
+    video_time = start
+    for _ in range(count):
+        bucket, prefix = video_prefix(args, video_time)
+        path = backend.path(bucket, prefix + video_file_name(video_time))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            (
+                ffmpeg
+                .input(f'testsrc=size={size}:rate={rate}', f='lavfi', t=VIDEO_LENTH_MINUTES * 60)
+                # faststart puts the moov atom first, so --stream can pipe the videos into ffmpeg
+                .output(path, vcodec='libx264', preset='ultrafast', pix_fmt='yuv420p', movflags='+faststart')
+                .overwrite_output()
+                .run(quiet=True)
+            )
+        video_time += datetime.timedelta(minutes=VIDEO_LENTH_MINUTES)
+    return video_time - start
+
+
+def synthetic_events(start: datetime.datetime, span: datetime.timedelta, count: int, seed: int):
+    """Events spread uniformly over the generated videos, in time order as the Data API returns them."""
+    rng = random.Random(seed)
+    # keep clear of video boundaries, where findVideo depends on millisecond naming
+    offsets = sorted(rng.uniform(1, span.total_seconds() - 1) for _ in range(count))
+    return [{'id': f'bench-{i:05d}',
+             'timeCollected': (start + datetime.timedelta(seconds=offset)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'}
+            for i, offset in enumerate(offsets)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the event clip pipeline of data-api.py (find video, '
+                                                 'download, trim, upload) offline, on synthetic videos in a local '
+                                                 'media root.  Requires ffmpeg.')
+    parser.add_argument('--media_root', default=os.path.join(tempfile.gettempdir(), 'data-api-bench-media'),
+                        help='local media root holding the synthetic videos, kept between runs.  '
+                             'Defaults to <tmp>/data-api-bench-media.')
+    parser.add_argument('--videos', type=int, default=4, help='number of synthetic videos.  Defaults to 4.')
+    parser.add_argument('--events', type=int, default=40, help='number of synthetic events.  Defaults to 40.')
+    parser.add_argument('--size', default='640x360', help='video frame size.  Defaults to 640x360.')
+    parser.add_argument('--rate', type=int, default=15, help='video frame rate.  Defaults to 15.')
+    parser.add_argument('--start', default='2021-07-20T16:00:00Z', help='start time of the first video.')
+    parser.add_argument('--upload', action='store_true', help='also upload the clips to the media root')
+    parser.add_argument('--stream', action='store_true',
+                        help='benchmark --streamClips: no temporary files, clips streamed to the upload with --upload')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the event times')
+    args = parser.parse_args(argv)
+
+    backend = LocalBackend(args.media_root)
+    start = dateutil.parser.parse(args.start).astimezone(dateutil.tz.UTC)
+    output = tempfile.mkdtemp(prefix='data-api-bench-clips-')
+    pipeline_args = argparse.Namespace(deviceId=DEVICE_ID, sourceGCPpath=None, output=output, csv=None, streamClips=args.stream,
+                                       uploadEventClips='bench-uploads/clips/' if args.upload else None)
+
+    started = time.perf_counter()
+    span = generate_videos(backend, pipeline_args, start, args.videos, args.size, args.rate)
+    generated = time.perf_counter() - started
+    events = synthetic_events(start, span, args.events, args.seed)
+
+    source_bytes = 0
+    for video in range(args.videos):
+        video_time = start + datetime.timedelta(minutes=VIDEO_LENTH_MINUTES * video)
+        bucket, prefix = video_prefix(pipeline_args, video_time)
+        source_bytes += os.path.getsize(backend.path(bucket, prefix + video_file_name(video_time)))
+
+    # the pipeline records a profiling span per stage
+    profiler.enable()
+    try:
+        started = time.perf_counter()
+        downloaded, uploaded = downloadEventClips(backend, pipeline_args, events)
+        uploadEventClips(pipeline_args, downloaded, {}, backend, uploaded)
+        elapsed = time.perf_counter() - started
+        clips = len(downloaded) + len(uploaded)
+        clip_bytes = (sum(os.path.getsize(filename) for filename in downloaded) +
+                      sum(os.path.getsize(backend.path(bucket, name)) for bucket, name in uploaded))
+    finally:
+        profiler.disable()
+        shutil.rmtree(output, ignore_errors=True)
+
+    print()
+    print(f'{args.videos} source video(s), {source_bytes / 1e6:.1f} MB (generated in {generated:.1f}s) '
+          f'in {args.media_root}')
+    print(f'{clips}/{len(events)} clips, {clip_bytes / 1e6:.1f} MB, in {elapsed:.2f}s: {clips / elapsed:.2f} clips/s')
+    for row in profiler.summary():
+        if row['name'] != 'event':
+            print(f'  {row["name"]:<14}{row["seconds"]:>8.2f}s  {row["seconds"] * 1000 / len(events):>8.1f} ms/event'
+                  f'  {row["bytes"] / 1e6:>8.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
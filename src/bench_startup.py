@@ -0,0 +1,55 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINT = os.path.join(ROOT, 'data-api.py')
+SUBCOMMANDS = ['query', 'clips', 'media', 'status', 'correlate', 'events', 'in-progress', 'follow', 'aggregate']
+
+
+def time_startup(args, runs):
+    """Run ``data-api.py <args>`` ``runs`` times and return the wall time of each run in milliseconds."""
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, ENTRY_POINT] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - started) * 1000)
+    return times
+
+
+def import_times(args, top):
+    """Return the ``top`` slowest imports (cumulative microseconds, module) reported by ``python -X importtime``."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', ENTRY_POINT] + args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of each data-api.py subcommand.')
+    parser.add_argument('--runs', type=int, default=5, help='number of runs per subcommand.  Defaults to 5.')
+    parser.add_argument('--subcommands', default=','.join(SUBCOMMANDS),
+                        help='comma separated subcommands to benchmark.  Defaults to all of them.')
+    parser.add_argument('--imports', type=int, default=0,
+                        help='also list the N slowest imports of each subcommand')
+    args = parser.parse_args(argv)
+
+    print(f'{"subcommand":<12}{"median ms":>12}{"min ms":>12}')
+    for subcommand in args.subcommands.split(','):
+        # --help exercises argument parsing and every import made before a request is sent
+        times = time_startup([subcommand, '--help'], args.runs)
+        print(f'{subcommand:<12}{statistics.median(times):>12.1f}{min(times):>12.1f}')
+        for cumulative, name in import_times([subcommand, '--help'], args.imports):
+            print(f'{"":<12}{cumulative / 1000:>12.1f}  {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,14 @@
+import gzip
+import os
+import sys
+import threading
+
 from api_types import *
-import requests
+from profiling import profiler, traced
+
+DEFAULT_API_BASE = 'https://data-api.boulderai.com/'
+# request bodies smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = 1024
 
 
 class DataApiClient:
@@ -7,68 +16,208 @@ class DataApiClient:
     api_base: str
     api_key: str
     headers: dict
+    session: 'requests.Session'
 
     def set_headers(self):
+        # no Accept-Encoding: requests already asks for gzip and deflate, plus br (and zstd) when brotli (zstandard)
+        # is installed, which urllib3 then decodes
         self.headers = {'Content-type': 'application/json', 'X-API-Key': f'{self.api_key}'}
 
+    def _post(self, path: str, query):
+        body = query.toJSON().encode()
+        headers = self.headers
+        self.stats['sent_bytes'] += len(body)
+        if self.compress_requests and len(body) >= COMPRESS_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=6)
+            headers = {**headers, 'Content-Encoding': 'gzip'}
+        self.stats['sent_wire_bytes'] += len(body)
+        return self.session.post(f'{self.api_base}{path}', data=body, headers=headers)
+
+    def _record_response(self, response, *args, **kwargs):
+        """Session hook counting the decoded and on the wire size of each response, for ``transfer_summary`` and the
+        current profiling span."""
+        size = len(response.content)
+        try:
+            # bytes urllib3 read from the socket, before decompression
+            wire = response.raw.tell() or size
+        except (AttributeError, TypeError):
+            wire = size
+        self.stats['requests'] += 1
+        self.stats['bytes'] += size
+        self.stats['wire_bytes'] += wire
+        if profiler.enabled:
+            profiler.add(bytes=size, wire_bytes=wire)
+            profiler.count('http.bytes_saved', size - wire)
+
+    def transfer_summary(self) -> str:
+        stats = self.stats
+        saved = stats['bytes'] - stats['wire_bytes']
+        summary = (f'{stats["requests"]} request(s) received {stats["wire_bytes"] / 1e6:.2f} MB for '
+                   f'{stats["bytes"] / 1e6:.2f} MB of responses ({saved / 1e6:.2f} MB, '
+                   f'{100 * saved / max(stats["bytes"], 1):.0f}% saved by compression)')
+        if stats['events_without_meta']:
+            summary += (f'; {stats["events_without_meta"]} event(s) fetched without meta, '
+                        f'meta fetched later for {stats["meta_fetched"]}')
+        return summary
+
+    def _without_meta(self, operation: str, query):
+        from projection import lazy_meta, without_meta
+        return lazy_meta(getattr(self, operation)(without_meta(query)), self, query)
+
+    # Define Sensor Endpoints
+    @traced('api.query_sensor_flat', 'api')
+    def query_sensor_flat(self, query: SensorQuery, meta: bool = True):
+        """http://docs.data-api.boulderai.com/#query-flattened-sensor-data
+
+        Callers which don't need the events' meta pass ``meta=False``: events are then fetched without it, and the
+        meta of an event is fetched on its own if it is read after all (see projection.py).
+        """
+        if not meta:
+            return self._without_meta('query_sensor_flat', query)
+        r = self._post('data/sensor/query', query)
+        r.raise_for_status()
+        return r.json()
+
     # Define Stream Endpoints
+    @traced('api.get_latest_stream_event', 'api')
     def get_latest_stream_event(self, query: LatestSensorEventQuery):
         """http://docs.data-api.boulderai.com/#get-latest-stream-data"""
-        r = requests.get(
+        r = self.session.get(
             f'{self.api_base}data/stream/{query.stream_id}/latest?sensorId={query.sensor_id}',
             headers=self.headers)
         r.raise_for_status()
         return r.json()
 
+    @traced('api.query_stream_aggregate', 'api')
     def query_stream_aggregate(self, query: StreamQueryAggregate):
         """http://docs.data-api.boulderai.com/#query-aggregated-stream-data"""
         print(f'Query => {query.toJSON()}')
-        r = requests.post(f'{self.api_base}data/stream/aggregate/query', data=query.toJSON(), headers=self.headers)
+        r = self._post('data/stream/aggregate/query', query)
         r.raise_for_status()
         return r.json()
 
-    def query_stream_flat(self, query: StreamQuery):
-        """http://docs.data-api.boulderai.com/#query-flattened-stream-data"""
+    @traced('api.query_stream_flat', 'api')
+    def query_stream_flat(self, query: StreamQuery, meta: bool = True):
+        """http://docs.data-api.boulderai.com/#query-flattened-stream-data
+
+        ``meta=False`` fetches events without meta, see ``query_sensor_flat``.
+        """
+        if not meta:
+            return self._without_meta('query_stream_flat', query)
         print(f'Query => {query.toJSON()}')
-        r = requests.post(f'{self.api_base}data/stream/query', data=query.toJSON(), headers=self.headers)
+        r = self._post('data/stream/query', query)
         r.raise_for_status()
         return r.json()
 
+    @traced('api.query_stream_flat_typed', 'api')
+    def query_stream_flat_typed(self, query: StreamQuery) -> list:
+        """``query_stream_flat`` decoded into ``SensorEvent`` structs straight from the response bytes."""
+        from events import decode_sensor_events
+        print(f'Query => {query.toJSON()}')
+        r = self._post('data/stream/query', query)
+        r.raise_for_status()
+        return decode_sensor_events(r.content)
+
+    @traced('api.get_sensors_by_workspace', 'api')
     def get_sensors_by_workspace(self, query: SensorsByWorkspaceQuery):
         """http://docs.data-api.boulderai.com/#get-sensors-by-workspace"""
-        r = requests.get(
+        r = self.session.get(
             f'{self.api_base}workspace/{query.workspace_id}/stream/sensor?startTime={query.start_time}&endTime={query.end_time}',
             headers=self.headers)
         r.raise_for_status()
         return r.json()
 
     # Define Media Endpoints
+    @traced('api.query_media_data', 'api')
     def query_media_data(self, query: MediaQuery):
         """http://docs.data-api.boulderai.com/#query-media-data"""
         print(f'Query => {query.toJSON()}')
-        r = requests.post(f'{self.api_base}media/query', data=query.toJSON(), headers=self.headers)
+        r = self._post('media/query', query)
         r.raise_for_status()
         return r.json()
 
+    @traced('api.query_media_data_typed', 'api')
+    def query_media_data_typed(self, query: MediaQuery) -> list:
+        """``query_media_data`` decoded into ``MediaEvent`` structs straight from the response bytes."""
+        from events import decode_media_events
+        print(f'Query => {query.toJSON()}')
+        r = self._post('media/query', query)
+        r.raise_for_status()
+        return decode_media_events(r.content)
+
+    @traced('api.query_status_by_workspace', 'api')
     def query_status_by_workspace(self, query: LatestStatusByWorkspaceQuery):
         """https://storage.googleapis.com/bai-data-api-docs/index.html#get-latest-status-by-workspace"""
-        r = requests.get(
+        r = self.session.get(
             f'{self.api_base}workspace/{query.workspace_id}/devices/status',
             headers=self.headers
         )
         r.raise_for_status()
         return r.json()
 
+    @traced('api.query_sensors_by_device', 'api')
     def query_sensors_by_device(self, query: SensorsByDeviceQuery):
         """https://storage.googleapis.com/bai-data-api-docs/index.html#get-sensors-by-device"""
-        r = requests.get(
+        r = self.session.get(
             f'{self.api_base}device/{query.device_id}/sensors?startTime={query.start_time}&endTime={query.end_time}',
             headers=self.headers
         )
         r.raise_for_status()
         return r.json()
 
-    def __init__(self, api_key: str, api_base: str = 'https://data-api.boulderai.com/'):
+    def download_gcs(self, url: str, filename: str, use_service_account: bool = False):
+        """Download a gs:// media URL to ``filename``, the same as DaemonClient.download_gcs."""
+        from storage import StoragePool
+        with self._storage_lock:
+            if use_service_account not in self._storage:
+                self._storage[use_service_account] = StoragePool(use_service_account)
+        self._storage[use_service_account].download(url, filename)
+
+    def __init__(self, api_key: str, api_base: str = DEFAULT_API_BASE, pool_size: int = 32,
+                 compress_requests: bool = None):
+        # requests is imported here so scripts talking to a running daemon (see daemon.py) never load it
+        import requests
         self.api_key = api_key
         self.api_base = api_base
+        # gzip request bodies, for servers which accept Content-Encoding: gzip.  Off unless asked for
+        if compress_requests is None:
+            compress_requests = bool(os.environ.get('DATA_API_COMPRESS_REQUESTS'))
+        self.compress_requests = compress_requests
+        self.stats = {'requests': 0, 'bytes': 0, 'wire_bytes': 0, 'sent_bytes': 0, 'sent_wire_bytes': 0,
+                      'events_without_meta': 0, 'meta_fetched': 0}
         self.set_headers()
+        # one keep-alive session per client, so consecutive requests reuse the same TLS connection(s)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.hooks['response'].append(self._record_response)
+        # Google Cloud storage clients for download_gcs, created on first use
+        self._storage = {}
+        self._storage_lock = threading.Lock()
+
+
+def client_from_env(api_key: str = None) -> DataApiClient:
+    """Create a DataApiClient from the API_KEY and API_BASE environment variables (or a .env file).
+
+    If DATA_API_DAEMON is set to the address of a running data-api daemon (see daemon.py) a DaemonClient with the
+    same methods is returned instead.
+    """
+    from dotenv import load_dotenv
+    load_dotenv()
+    api_key = api_key or os.environ.get("API_KEY")
+    api_base = os.environ.get("API_BASE")
+
+    if not api_key:
+        print('Please set the API_KEY environment variable.')
+        print('e.g. `export API_KEY="38ed7729792c48489945c8060255fa45"`')
+        sys.exit(1)
+
+    if not api_base:
+        api_base = DEFAULT_API_BASE
+
+    from daemon_client import find_daemon, DaemonClient
+    address = find_daemon()
+    if address:
+        return DaemonClient(address, api_key=api_key, api_base=api_base)
+    return DataApiClient(api_key=api_key, api_base=api_base)
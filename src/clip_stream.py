@@ -0,0 +1,219 @@
+import os
+import shutil
+import struct
+import subprocess
+import threading
+
+from storage import StorageBackend, STREAM_CHUNK_SIZE
+
+# fragmented MP4 can be written to a pipe: the moov atom is written up front and media follows in fragments
+FRAGMENTED_MP4 = 'frag_keyframe+empty_moov'
+
+
+def moov_first(backend: StorageBackend, bucket: str, name: str, max_atoms: int = 16) -> bool:
+    """True if an MP4's moov atom comes before its media data, using ranged reads of the top level atom headers.
+
+    ffmpeg can only decode an MP4 from a pipe when it is laid out this way ("faststart"); when the moov atom is at the
+    end of the file ffmpeg needs to seek, so the video has to be downloaded to a file first.
+    """
+    offset = 0
+    for _ in range(max_atoms):
+        header = backend.read(bucket, name, offset, offset + 16)
+        if len(header) < 8:
+            return False
+        size, kind = struct.unpack('>I4s', header[:8])
+        if kind == b'moov':
+            return True
+        if kind == b'mdat':
+            return False
+        if size == 1:
+            if len(header) < 16:
+                return False
+            size = struct.unpack('>Q', header[8:16])[0]
+        if size < 8:
+            # size 0 means the atom runs to the end of the file
+            return False
+        offset += size
+    return False
+
+
+class SourceFeeder(threading.Thread):
+    """Background thread streaming a stored object into a process's stdin, which it closes at the end."""
+
+    def __init__(self, backend: StorageBackend, bucket: str, name: str, stdin):
+        super().__init__(daemon=True)
+        self.backend = backend
+        self.bucket = bucket
+        self.name = name
+        self.stdin = stdin
+        self.bytes_read = 0
+        self.error = None
+
+    def run(self):
+        try:
+            with self.backend.open_read(self.bucket, self.name) as source:
+                while True:
+                    chunk = source.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.stdin.write(chunk)
+                    self.bytes_read += len(chunk)
+        except BrokenPipeError:
+            # the process stopped reading, its exit status tells whether that was an error
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                self.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def check(self, returncode: int, stderr: bytes):
+        """Raise an ``ffmpeg.Error`` if the source couldn't be read or ffmpeg failed."""
+        import ffmpeg
+        if returncode != 0 or self.error is not None:
+            if self.error is not None:
+                stderr += f'\nreading {self.bucket}/{self.name}: {self.error}'.encode('utf-8')
+            raise ffmpeg.Error('ffmpeg', b'', stderr)
+
+
+class _ClipPipe:
+    """Read end of the pipe one clip of ``trim_many`` is written to.  At the end of the clip it waits for ffmpeg and
+    raises its error, if any, so a consumer such as an upload doesn't complete with a broken clip."""
+
+    def __init__(self, fd: int, finished: threading.Event, errors: list):
+        self._file = os.fdopen(fd, 'rb')
+        self._finished = finished
+        self._errors = errors
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._file.read(size)
+        if not data:
+            self._finished.wait()
+            if self._errors:
+                raise self._errors[0]
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+def trim_many(backend: StorageBackend, bucket: str, name: str, clips) -> int:
+    """Trim several clips of a stored video with one ffmpeg process, which reads the video once from a stream, without
+    intermediate files.
+
+    ``clips`` are ``(start, end, consume)``.  ffmpeg writes each clip, as fragmented MP4, to a pipe of its own, and
+    ``consume(stream)`` reads it in a thread of its own, e.g. with ``backend.upload_stream``.  Returns the number of
+    bytes of the video read, and raises an ``ffmpeg.Error`` if the video couldn't be read or ffmpeg failed, or the
+    first error of a consumer.
+    """
+    import ffmpeg
+    pipes = [os.pipe() for _ in clips]
+    source = ffmpeg.input('pipe:', format='mp4')
+    command = (
+        ffmpeg
+        .merge_outputs(*[source.trim(start=start, end=end).output(f'pipe:{write}', format='mp4',
+                                                                  movflags=FRAGMENTED_MP4)
+                         for (start, end, _), (_, write) in zip(clips, pipes)])
+        .global_args('-loglevel', 'error')
+        .compile()
+    )
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   pass_fds=[write for _, write in pipes])
+    except BaseException:
+        for read, _ in pipes:
+            os.close(read)
+        raise
+    finally:
+        # ffmpeg has its own copies of the write ends; a clip's reader sees its end once ffmpeg closes it
+        for _, write in pipes:
+            os.close(write)
+    finished = threading.Event()
+    ffmpeg_errors = []
+    consumer_errors = []
+
+    def run(consume, stream):
+        try:
+            consume(stream)
+        except Exception as e:
+            consumer_errors.append(e)
+        finally:
+            stream.close()
+
+    feeder = SourceFeeder(backend, bucket, name, process.stdin)
+    feeder.start()
+    consumers = [threading.Thread(target=run, args=(consume, _ClipPipe(read, finished, ffmpeg_errors)), daemon=True)
+                 for (_, _, consume), (read, _) in zip(clips, pipes)]
+    for consumer in consumers:
+        consumer.start()
+    try:
+        stderr = process.stderr.read()
+        feeder.join()
+        feeder.check(process.wait(), stderr)
+    except Exception as e:
+        ffmpeg_errors.append(e)
+    finally:
+        finished.set()
+        process.stderr.close()
+    for consumer in consumers:
+        consumer.join()
+    if ffmpeg_errors or consumer_errors:
+        raise (ffmpeg_errors + consumer_errors)[0]
+    return feeder.bytes_read
+
+
+class TrimStream:
+    """Trim a stored video with ffmpeg without intermediate files.
+
+    The source object is streamed into ffmpeg's stdin by a background thread and the trimmed clip, as fragmented MP4,
+    is read from ``stream`` (ffmpeg's stdout).  Reading raises an ``ffmpeg.Error`` at the end of the stream if the
+    source couldn't be read or ffmpeg failed, so a consumer such as an upload doesn't complete with a broken clip.
+    """
+
+    def __init__(self, backend: StorageBackend, bucket: str, name: str, start: str, end: str):
+        import ffmpeg
+        self._process = (
+            ffmpeg
+            .input('pipe:', format='mp4')
+            .trim(start=start, end=end)
+            .output('pipe:', format='mp4', movflags=FRAGMENTED_MP4)
+            .global_args('-loglevel', 'error')
+            .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True)
+        )
+        self._feeder = SourceFeeder(backend, bucket, name, self._process.stdin)
+        self._feeder.start()
+
+    @property
+    def bytes_read(self) -> int:
+        return self._feeder.bytes_read
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._process.stdout.read(size)
+        if not data:
+            self._finish()
+        return data
+
+    def _finish(self):
+        self._feeder.join()
+        stderr = self._process.stderr.read()
+        self._feeder.check(self._process.wait(), stderr)
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        self._feeder.join()
+        self._process.stdout.close()
+        self._process.stderr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def save(self, filename: str):
+        with open(filename, 'wb') as f:
+            shutil.copyfileobj(self, f, STREAM_CHUNK_SIZE)
@@ -0,0 +1,259 @@
+import argparse
+import hmac
+import json
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import api_types
+from client import DataApiClient, DEFAULT_API_BASE
+from daemon_client import OPERATIONS, TOKEN_HEADER, daemon_address, token_path
+from storage import StoragePool
+from utils import to_epoch_ms
+
+DEFAULT_CACHE_TTL = 60          # seconds a response is served from the cache
+DEFAULT_CACHE_SIZE = 1000       # maximum number of cached responses
+# operations whose answer is "now" (latest events, device status), which are never cached
+UNCACHED_OPERATIONS = ('get_latest_stream_event', 'query_status_by_workspace')
+# queries of windows which ended less than this many seconds ago may still get new events, so aren't cached
+OPEN_WINDOW_SECONDS = 300
+
+
+class ResponseCache:
+    """Thread-safe LRU cache of API responses with a time to live."""
+
+    def __init__(self, ttl: float, size: int):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+class DataApiDaemon:
+    """Long-lived state shared by every request: one keep-alive DataApiClient per API key, the response cache and
+    the Google Cloud storage clients.
+
+    Requests must carry ``token`` and may only use the Data API bases in ``api_bases``.  GCS downloads go to
+    ``download_dir``, which the daemon owns, and are streamed back to the client.
+    """
+
+    def __init__(self, cache_ttl: float = DEFAULT_CACHE_TTL, cache_size: int = DEFAULT_CACHE_SIZE, token: str = None,
+                 api_bases=(DEFAULT_API_BASE,), download_dir: str = None):
+        self.cache = ResponseCache(cache_ttl, cache_size)
+        self.token = token or secrets.token_urlsafe(32)
+        self.api_bases = set(api_bases)
+        self.download_dir = download_dir or tempfile.mkdtemp(prefix='data-api-daemon-')
+        self._clients = {}
+        self._storage = {}
+        self._lock = threading.Lock()
+
+    def client(self, api_key: str, api_base: str) -> DataApiClient:
+        with self._lock:
+            key = (api_key, api_base)
+            if key not in self._clients:
+                self._clients[key] = DataApiClient(api_key=api_key, api_base=api_base)
+            return self._clients[key]
+
+    def authorized(self, token: str) -> bool:
+        return hmac.compare_digest((token or '').encode(), self.token.encode())
+
+    @staticmethod
+    def cacheable(operation: str, query) -> bool:
+        """Whether a response can be served again: not for latest/status operations, nor windows still open."""
+        if operation in UNCACHED_OPERATIONS:
+            return False
+        end = getattr(query, 'end_time', None)
+        if end is None:
+            return False
+        try:
+            end_ms = to_epoch_ms(end)
+        except (TypeError, ValueError):
+            return False
+        return end_ms < (time.time() - OPEN_WINDOW_SECONDS) * 1000
+
+    def call(self, api_key: str, api_base: str, operation: str, body: dict):
+        query_type = getattr(api_types, body['type'], None)
+        if not (isinstance(query_type, type) and issubclass(query_type, api_types.JsonObject)):
+            raise ValueError(f"Unknown query type {body['type']}")
+        query = query_type.from_dict(body['query'])
+        cacheable = self.cacheable(operation, query)
+        cache_key = (api_key, api_base, operation, json.dumps(body, sort_keys=True))
+        result = self.cache.get(cache_key) if cacheable else None
+        if result is None:
+            result = getattr(self.client(api_key, api_base), operation)(query)
+            if cacheable:
+                self.cache.put(cache_key, result)
+        return result
+
+    def download_gcs(self, body: dict) -> str:
+        """Download a gs:// URL into the daemon's download directory and return the file, which the caller removes."""
+        use_service_account = body.get('useServiceAccount', False)
+        with self._lock:
+            if use_service_account not in self._storage:
+                self._storage[use_service_account] = StoragePool(use_service_account)
+        fd, path = tempfile.mkstemp(dir=self.download_dir, suffix='.download')
+        os.close(fd)
+        try:
+            self._storage[use_service_account].download(body['url'], path)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path
+
+    def stats(self):
+        stats = {'cacheHits': self.cache.hits, 'cacheMisses': self.cache.misses, 'clients': len(self._clients)}
+        with self._lock:
+            clients = list(self._clients.values())
+        # what the daemon's connections to the Data API transferred, compressed and decoded
+        stats['wireBytes'] = sum(client.stats['wire_bytes'] for client in clients)
+        stats['bytes'] = sum(client.stats['bytes'] for client in clients)
+        return stats
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'     # keep the thin client's connection open between calls
+    daemon: DataApiDaemon = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status: int, body, reason: str = None):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status, reason)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _reject(self, status: int, error: str):
+        # the request body isn't read, so the connection can't be reused
+        self.close_connection = True
+        self._respond(status, {'error': error})
+
+    def do_GET(self):
+        if self.path == '/ping':
+            self._respond(200, {'ok': True})
+        elif not self.daemon.authorized(self.headers.get(TOKEN_HEADER)):
+            self._reject(401, 'Missing or wrong daemon token')
+        elif self.path == '/stats':
+            self._respond(200, self.daemon.stats())
+        else:
+            self._respond(404, {'error': f'Unknown path {self.path}'})
+
+    def _send_file(self, path: str):
+        try:
+            self.send_response(200)
+            self.send_header('Content-type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile, 1 << 20)
+        finally:
+            os.remove(path)
+
+    def do_POST(self):
+        # a token, which only the daemon's user can read, and a JSON content type, which a browser can't send to
+        # another origin without a preflight, keep other users and web pages from using the daemon
+        if not self.daemon.authorized(self.headers.get(TOKEN_HEADER)):
+            return self._reject(401, 'Missing or wrong daemon token')
+        if self.headers.get_content_type() != 'application/json':
+            return self._reject(415, 'Requests must be application/json')
+        api_base = self.headers.get('X-API-Base') or DEFAULT_API_BASE
+        if api_base not in self.daemon.api_bases:
+            return self._reject(403, f'API base {api_base} is not allowed, start the daemon with --api_base')
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        api_key = self.headers.get('X-API-Key')
+        try:
+            if self.path.startswith('/call/') and self.path[len('/call/'):] in OPERATIONS:
+                self._respond(200, self.daemon.call(api_key, api_base, self.path[len('/call/'):], body))
+            elif self.path == '/gcs/download':
+                self._send_file(self.daemon.download_gcs(body))
+            else:
+                self._respond(404, {'error': f'Unknown path {self.path}'})
+        except requests.HTTPError as e:
+            # relay Data API errors with their original status so the thin client can re-raise them
+            self._respond(e.response.status_code, e.response.content, e.response.reason)
+        except Exception as e:
+            self._respond(500, {'error': str(e)})
+
+
+def write_token(address: str, token: str) -> str:
+    """Write the daemon's token to its token file, readable only by the current user."""
+    path = token_path(address)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # O_CREAT leaves the mode of an existing file as it was
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return path
+
+
+def serve(address: str, cache_ttl: float = DEFAULT_CACHE_TTL, cache_size: int = DEFAULT_CACHE_SIZE,
+          api_bases=(DEFAULT_API_BASE,)):
+    host, port = address.rsplit(':', 1)
+    daemon = DataApiDaemon(cache_ttl, cache_size, api_bases=api_bases)
+    handler = type('Handler', (DaemonRequestHandler,), {'daemon': daemon})
+    server = ThreadingHTTPServer((host, int(port)), handler)
+    server.daemon_threads = True
+    token_file = write_token(address, daemon.token)
+    print(f'Serving the Data API on {address} (cache ttl {cache_ttl}s, token in {token_file}).  '
+          f'Scripts run with DATA_API_DAEMON={address} will use it.')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(token_file)
+        shutil.rmtree(daemon.download_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a local daemon which serves Data API queries over a shared '
+                                                 'connection pool and response cache.')
+    parser.add_argument('--address', default=daemon_address(),
+                        help='host:port to listen on.  Defaults to $DATA_API_DAEMON or 127.0.0.1:8765.')
+    parser.add_argument('--cache_ttl', type=float, default=DEFAULT_CACHE_TTL,
+                        help=f'seconds to serve repeated queries from the cache.  0 disables the cache.  '
+                             f'Defaults to {DEFAULT_CACHE_TTL}.')
+    parser.add_argument('--cache_size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help=f'maximum number of cached responses.  Defaults to {DEFAULT_CACHE_SIZE}.')
+    parser.add_argument('--api_base', action='append', default=[],
+                        help=f'Data API base URL clients may use, besides {DEFAULT_API_BASE} and $API_BASE.  '
+                             f'May be repeated.')
+    args = parser.parse_args(argv)
+    api_bases = [DEFAULT_API_BASE] + ([os.environ['API_BASE']] if os.environ.get('API_BASE') else []) + args.api_base
+    serve(args.address, args.cache_ttl, args.cache_size, api_bases)
+
+
+if __name__ == '__main__':
+    main()
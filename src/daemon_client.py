@@ -0,0 +1,160 @@
+import http.client
+import json
+import os
+import shutil
+import socket
+import sys
+import threading
+
+from profiling import profiler
+
+DEFAULT_DAEMON_ADDRESS = '127.0.0.1:8765'
+# directory of the token files daemons write for their user
+TOKEN_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'data-api-utils')
+TOKEN_HEADER = 'X-Daemon-Token'
+# DataApiClient methods the daemon serves
+OPERATIONS = (
+    'query_sensor_flat',
+    'get_latest_stream_event',
+    'query_stream_aggregate',
+    'query_stream_flat',
+    'get_sensors_by_workspace',
+    'query_media_data',
+    'query_status_by_workspace',
+    'query_sensors_by_device',
+)
+
+
+def daemon_address() -> str:
+    return os.environ.get('DATA_API_DAEMON') or DEFAULT_DAEMON_ADDRESS
+
+
+def token_path(address: str) -> str:
+    """File with the token the daemon listening on address requires, readable only by the user who started it."""
+    return os.path.join(TOKEN_DIR, f'daemon-{address.replace(":", "-")}.token')
+
+
+def read_token(address: str):
+    try:
+        with open(token_path(address)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def find_daemon():
+    """Return the address of the daemon to route queries through, or None.
+
+    Routing through a daemon is opt-in: scripts only use one when ``DATA_API_DAEMON`` is set to its host:port, and
+    the daemon is running with a token file this user can read.
+    """
+    address = os.environ.get('DATA_API_DAEMON')
+    if not address:
+        return None
+    host, port = address.rsplit(':', 1)
+    try:
+        with socket.create_connection((host, int(port)), timeout=0.05):
+            pass
+    except OSError:
+        print(f'No data-api daemon at {address} (DATA_API_DAEMON), querying the Data API directly', file=sys.stderr)
+        return None
+    if read_token(address) is None:
+        print(f'Can\'t read the token of the data-api daemon at {address} ({token_path(address)}), querying the '
+              f'Data API directly', file=sys.stderr)
+        return None
+    return address
+
+
+class DaemonClient:
+    """Thin client with the query methods of ``DataApiClient`` which forwards calls to a running daemon.
+
+    Only the standard library is used so short-lived scripts don't pay for importing ``requests``.
+    """
+
+    def __init__(self, address: str, api_key: str, api_base: str, timeout: float = 300):
+        self.address = address
+        self.api_key = api_key
+        self.api_base = api_base
+        self.timeout = timeout
+        self.token = read_token(address)
+        # http.client connections can't be shared between threads, so each thread keeps its own
+        self._local = threading.local()
+
+    @property
+    def _connection(self) -> http.client.HTTPConnection:
+        if not hasattr(self._local, 'connection'):
+            host, port = self.address.rsplit(':', 1)
+            self._local.connection = http.client.HTTPConnection(host, int(port), timeout=self.timeout)
+        return self._local.connection
+
+    def _request(self, path: str, body: dict):
+        return json.loads(self._request_bytes(path, body))
+
+    def _send(self, path: str, body: dict) -> http.client.HTTPResponse:
+        headers = {'Content-type': 'application/json', 'X-API-Key': self.api_key, 'X-API-Base': self.api_base,
+                   TOKEN_HEADER: self.token or ''}
+        connection = self._connection
+        connection.request('POST', path, json.dumps(body), headers)
+        return connection.getresponse()
+
+    def _request_bytes(self, path: str, body: dict) -> bytes:
+        with profiler.span(f'daemon{path.replace("/", ".")}', 'api'):
+            response = self._send(path, body)
+            data = response.read()
+            profiler.add(bytes=len(data))
+        if response.status != 200:
+            raise_http_error(response.status, response.reason, data)
+        return data
+
+    @staticmethod
+    def _body(query) -> dict:
+        return {'type': type(query).__name__, 'query': query.to_dict()}
+
+    def call(self, operation: str, query):
+        return self._request(f'/call/{operation}', self._body(query))
+
+    def query_stream_flat(self, query, meta: bool = True):
+        """``meta=False`` fetches events without meta, fetching an event's meta only if it is read (projection.py)."""
+        if not meta:
+            from projection import lazy_meta, without_meta
+            return lazy_meta(self.call('query_stream_flat', without_meta(query)), self, query)
+        return self.call('query_stream_flat', query)
+
+    def query_sensor_flat(self, query, meta: bool = True):
+        if not meta:
+            from projection import lazy_meta, without_meta
+            return lazy_meta(self.call('query_sensor_flat', without_meta(query)), self, query)
+        return self.call('query_sensor_flat', query)
+
+    def query_stream_flat_typed(self, query):
+        """``query_stream_flat`` decoded into ``SensorEvent`` structs, see ``DataApiClient``."""
+        from events import decode_sensor_events
+        return decode_sensor_events(self._request_bytes('/call/query_stream_flat', self._body(query)))
+
+    def query_media_data_typed(self, query):
+        from events import decode_media_events
+        return decode_media_events(self._request_bytes('/call/query_media_data', self._body(query)))
+
+    def download_gcs(self, url: str, filename: str, use_service_account: bool = False):
+        """Download a gs:// URL to filename.  The daemon downloads it with its storage client and streams it back."""
+        with profiler.span('daemon.gcs.download', 'storage', url=url):
+            response = self._send('/gcs/download', {'url': url, 'useServiceAccount': use_service_account})
+            if response.status != 200:
+                raise_http_error(response.status, response.reason, response.read())
+            with open(filename, 'wb') as f:
+                shutil.copyfileobj(response, f, 1 << 20)
+
+    def __getattr__(self, name):
+        if name in OPERATIONS:
+            return lambda query: self.call(name, query)
+        raise AttributeError(name)
+
+
+def raise_http_error(status: int, reason: str, content: bytes):
+    """Raise a requests.HTTPError for an error relayed by the daemon, as DataApiClient would."""
+    import requests
+    response = requests.Response()
+    response.status_code = status
+    response.reason = reason
+    response._content = content
+    raise requests.HTTPError(f'{status} Error: {reason} (via data-api daemon)', response=response)
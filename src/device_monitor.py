@@ -0,0 +1,95 @@
+import datetime
+import time
+from typing import Callable, List
+
+from api_types import LatestStatusByWorkspaceQuery
+from client import DataApiClient
+from device_status_check import evaluate_fleet, LOW_STORAGE_THRESHOLD
+
+
+def diff_fleet(previous: dict, current: dict) -> List[dict]:
+    """Compare two evaluate_fleet reports and return a change event for everything that differs."""
+    changes = []
+    for device_id in previous.keys() - current.keys():
+        changes.append({'type': 'deviceRemoved', 'deviceId': device_id})
+    for device_id, device in current.items():
+        before = previous.get(device_id)
+        if before is None:
+            changes.append({'type': 'deviceAdded', 'deviceId': device_id, 'online': device['online'],
+                            'lowStorage': device['lowStorage'], 'services': device['services']})
+            continue
+        for name in before['services'].keys() | device['services'].keys():
+            old_status = before['services'].get(name)
+            new_status = device['services'].get(name)
+            if old_status != new_status:
+                changes.append({'type': 'serviceStatus', 'deviceId': device_id, 'service': name,
+                                'from': old_status, 'to': new_status})
+        if before['online'] != device['online']:
+            changes.append({'type': 'online' if device['online'] else 'offline', 'deviceId': device_id,
+                            'secondsSinceLastSeen': device['secondsSinceLastSeen']})
+        if before['lowStorage'] != device['lowStorage']:
+            changes.append({'type': 'lowStorage' if device['lowStorage'] else 'storageRecovered',
+                            'deviceId': device_id, 'storagePercentUsed': device['storagePercentUsed']})
+    return changes
+
+
+def describe(change: dict) -> str:
+    device_id = change['deviceId']
+    kind = change['type']
+    if kind == 'serviceStatus':
+        return f"{device_id}: {change['service']} {change['from']} -> {change['to']}"
+    if kind == 'offline':
+        return f"{device_id}: offline, last seen ~{int(change['secondsSinceLastSeen']/60)} minutes ago"
+    if kind == 'online':
+        return f"{device_id}: back online"
+    if kind == 'lowStorage':
+        return f"{device_id}: storage is {change['storagePercentUsed']}% full (> {LOW_STORAGE_THRESHOLD}%)"
+    if kind == 'storageRecovered':
+        return f"{device_id}: storage is {change['storagePercentUsed']}% full, no longer low"
+    if kind == 'deviceAdded':
+        return f"{device_id}: added to workspace"
+    return f"{device_id}: removed from workspace"
+
+
+class FleetMonitor:
+    """Keeps the state of a workspace's devices in memory and reports only what changes between polls.
+
+    Each poll is a single query_status_by_workspace call.  ``callback`` is called with every change event, each a
+    dict with a ``type``, ``deviceId`` and ``time``.
+    """
+
+    def __init__(self,
+                 client: DataApiClient,
+                 workspace_id: str,
+                 callback: Callable[[dict], None],
+                 devices: list = None,
+                 state: dict = None):
+        self.client = client
+        self.workspace_id = workspace_id
+        self.callback = callback
+        self.devices = devices
+        self.state = state
+
+    def poll(self) -> List[dict]:
+        data = self.client.query_status_by_workspace(
+            LatestStatusByWorkspaceQuery(
+                workspace_id=self.workspace_id
+            )
+        )["data"]
+        current = evaluate_fleet(data, self.devices)
+        changes = diff_fleet(self.state, current) if self.state is not None else []
+        self.state = current
+        now = datetime.datetime.utcnow().isoformat() + 'Z'
+        for change in changes:
+            change['time'] = now
+            self.callback(change)
+        return changes
+
+    def run(self, interval: float):
+        while True:
+            started = time.monotonic()
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Status poll failed: {e}")
+            time.sleep(max(interval - (time.monotonic() - started), 0))
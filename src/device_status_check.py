@@ -1,19 +1,22 @@
 import argparse
-from dotenv import load_dotenv
-import os
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import json
 
-from client import DataApiClient
-from api_types import LatestStatusByWorkspaceQuery, SensorsByDeviceQuery
+import numpy as np
+import requests
+
+from client import DataApiClient, client_from_env
+from api_types import LatestStatusByWorkspaceQuery, SensorsByDeviceQuery, SensorsByWorkspaceQuery
 from utils import *
 
 LOW_STORAGE_THRESHOLD = 90      # % storage used to mark low storage
 LAST_SEEN_THRESHOLD = 60*20     # number of seconds since last ping to consider a device offline
 CHECK_FOR_DATA_HOURS = 24       # how far back to check for device data
+MAX_CONCURRENT_REQUESTS = 16    # per-device sensor queries in flight when the workspace query can't be used
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         description='Device status check example.',
         formatter_class=argparse.RawDescriptionHelpFormatter
@@ -24,10 +27,25 @@ def parse_args():
     parser.add_argument('-d', '--device_list',
                         help='A JSON file which contains a list of deviceIds of interest.',
                         type=str)
-    if len(sys.argv) == 1:
+    parser.add_argument('-j', '--json',
+                        help='Write a machine-readable JSON report to this file (use - for stdout).',
+                        type=str)
+    parser.add_argument('-c', '--concurrency',
+                        help='Maximum number of concurrent per-device requests.',
+                        type=int, default=MAX_CONCURRENT_REQUESTS)
+    parser.add_argument('--watch',
+                        help='After the initial check, keep polling device status every WATCH seconds and report '
+                             'only the changes (service state, online/offline, low storage).',
+                        type=float)
+    parser.add_argument('--events',
+                        help='With --watch, append change events as JSON lines to this file.',
+                        type=str)
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) == 0:
         parser.print_help()
         sys.exit(1)
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def service_status(service_name: str, devices: dict):
@@ -49,94 +67,169 @@ def service_status(service_name: str, devices: dict):
             print(f"\t\t- In {status} state on {', '.join(not_running[status])}")
 
 
-if __name__ == '__main__':
-    print(f"Running device status check...")
-    load_dotenv()
-    api_key = os.environ.get("API_KEY")
-    api_base = os.environ.get("API_BASE")
-
-    if not api_key:
-        print('Please set the API_KEY environment variable.')
-        print('e.g. `export API_KEY="38ed7729792c48489945c8060255fa45"`')
-        exit(1)
-    if not api_base:
-        api_base = 'https://data-api.boulderai.com/'
-
-    args = parse_args()
-    client = DataApiClient(api_key=api_key, api_base=api_base)
-    data = client.query_status_by_workspace(
-        LatestStatusByWorkspaceQuery(
-            workspace_id=args.workspace_id
-        )
-    )["data"]
-    # print(f"Data => {json.dumps(data, indent=2)}")
-
-    devices = None
-    if args.device_list:
-        with open(args.device_list, 'r') as f:
-            devices = json.load(f)
-    services = {}
-    low_storage = {}
-    not_low_storage = []
-    online = []
-    offline = {}
-    for device in data:
-        device_id = device['deviceId']
-        # check services
-        if devices and device_id not in devices:
-            continue
-        for service in device['services']:
-            if service['name'] not in services:
-                services[service['name']] = {}
-            services[service['name']][device_id] = service['status']['status']
-        # check low storage
-        if device['dataMemoryStorage']['percentageUse'] > LOW_STORAGE_THRESHOLD:
-            low_storage[device_id] = device['dataMemoryStorage']['percentageUse']
-        else:
-            not_low_storage.append(device_id)
-        # check last seen
-        last_seen = datetime.datetime.strptime(device['lastSeen'].split(".")[0], "%Y-%m-%dT%H:%M:%S")
-        time_since_last_seen = datetime.datetime.utcnow() - last_seen
-        if time_since_last_seen.seconds > LAST_SEEN_THRESHOLD:
-            offline[device_id] = time_since_last_seen.seconds
+def devices_with_recent_data(client: DataApiClient, workspace_id: str, device_ids: list,
+                             concurrency: int = MAX_CONCURRENT_REQUESTS) -> set:
+    """Return the subset of device_ids which reported sensor data in the last CHECK_FOR_DATA_HOURS hours.
+
+    A single workspace level sensor query is used where possible, falling back to bounded-concurrency
+    per-device queries if the workspace query fails or doesn't report device IDs.
+    """
+    query_start, query_end = get_media_range(datetime.datetime.utcnow(), CHECK_FOR_DATA_HOURS*60, 0)
+    try:
+        sensors = response_data(client.get_sensors_by_workspace(
+            SensorsByWorkspaceQuery(
+                workspace_id=workspace_id,
+                start_time=query_start.isoformat(),
+                end_time=query_end.isoformat()
+            )
+        ))
+        if not sensors:
+            # an empty response can't be told apart from a workspace lookup which didn't work
+            print('Workspace sensor query returned no sensors, querying devices individually')
+        elif all('deviceId' in sensor for sensor in sensors):
+            return {sensor['deviceId'] for sensor in sensors} & set(device_ids)
         else:
-            online.append(device_id)
-
+            print('Workspace sensor query did not include device IDs, querying devices individually')
+    except (requests.HTTPError, TypeError) as e:
+        print(f'Workspace sensor query failed ({e}), querying devices individually')
 
-    has_sensor_data = []
-    no_sensor_data = []
-    for device_id in devices:
-        query_start, query_end = get_media_range(datetime.datetime.utcnow(), CHECK_FOR_DATA_HOURS*60, 0)
-        sensors = client.query_sensors_by_device(
+    def has_data(device_id):
+        return client.query_sensors_by_device(
             SensorsByDeviceQuery(
                 device_id=device_id,
                 start_time=query_start,
                 end_time=query_end
             )
         )
-        [has_sensor_data.append(device_id) if sensors else no_sensor_data.append(device_id)]
 
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return {device_id for device_id, sensors in zip(device_ids, executor.map(has_data, device_ids)) if sensors}
+
+
+def evaluate_fleet(data: list, devices: list = None, now: datetime.datetime = None) -> dict:
+    """Evaluate service status, storage and last seen thresholds for every device in one pass.
+
+    Returns a report keyed by device ID.  ``devices`` optionally restricts the report to a list of device IDs.
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    data = [device for device in data if not devices or device['deviceId'] in devices]
+    device_ids = [device['deviceId'] for device in data]
+    storage_used = np.array([device.get('dataMemoryStorage', {}).get('percentageUse', np.nan) for device in data],
+                            dtype=float)
+    # lastSeen is UTC, truncated to whole seconds
+    last_seen = np.array([device['lastSeen'][:19] for device in data], dtype='datetime64[s]')
+    seconds_since_seen = (np.datetime64(now.replace(microsecond=0), 's') - last_seen).astype(np.int64)
+    low_storage = storage_used > LOW_STORAGE_THRESHOLD
+    offline = seconds_since_seen > LAST_SEEN_THRESHOLD
+
+    report = {}
+    for i, device in enumerate(data):
+        report[device_ids[i]] = {
+            'services': {service['name']: service['status']['status'] for service in device['services']},
+            'storagePercentUsed': device.get('dataMemoryStorage', {}).get('percentageUse'),
+            'lowStorage': bool(low_storage[i]),
+            'secondsSinceLastSeen': int(seconds_since_seen[i]),
+            'online': not offline[i],
+        }
+    return report
+
+
+def print_report(report: dict):
+    services = {}
+    for device_id, device in report.items():
+        for name, status in device['services'].items():
+            services.setdefault(name, {})[device_id] = status
     print(f"\nServices Status Check:")
     for name, device in services.items():
         service_status(name, device)
 
+    has_sensor_data = [device_id for device_id, device in report.items() if device['hasRecentData']]
+    no_sensor_data = [device_id for device_id, device in report.items() if not device['hasRecentData']]
     print(f"\nRecent Data Check:")
     print(f"=> {len(has_sensor_data)} device(s) have sensor data in the last {CHECK_FOR_DATA_HOURS} hours.")
     if no_sensor_data:
         print(f"=> The following device(s) have no sensor data in the last {CHECK_FOR_DATA_HOURS} hours: {no_sensor_data}")
 
+    low_storage = {device_id: device['storagePercentUsed'] for device_id, device in report.items()
+                   if device['lowStorage']}
     print(f"\nLow Storage Check:")
     if low_storage:
         print(f"=> {len(low_storage)} device(s) are low on storage:")
         for device, percentage_used in low_storage.items():
             print(f"\t- {device} storage is {percentage_used}% full")
     else:
-        print(f"=> All {len(not_low_storage)} devices are not low on storage.")
+        print(f"=> All {len(report)} devices are not low on storage.")
 
+    offline = {device_id: device['secondsSinceLastSeen'] for device_id, device in report.items()
+               if not device['online']}
     print(f"\nDevice Connectivity Check:")
-    print(f"=> {len(online)} device(s) are online.")
+    print(f"=> {len(report) - len(offline)} device(s) are online.")
     if offline:
         print(f"=> {len(offline)} device(s) appear offline:")
         for device, time_since in offline.items():
             print(f"\t- {device} was last seen ~{int(time_since/60)} minutes ago")
 
+
+def main(argv=None):
+    print(f"Running device status check...")
+    args = parse_args(argv)
+    client = client_from_env()
+    data = client.query_status_by_workspace(
+        LatestStatusByWorkspaceQuery(
+            workspace_id=args.workspace_id
+        )
+    )["data"]
+
+    devices = None
+    if args.device_list:
+        with open(args.device_list, 'r') as f:
+            devices = json.load(f)
+
+    report = evaluate_fleet(data, devices)
+    recent = devices_with_recent_data(client, args.workspace_id, list(report), args.concurrency)
+    for device_id, device in report.items():
+        device['hasRecentData'] = device_id in recent
+
+    print_report(report)
+
+    if args.json:
+        output = {
+            'workspaceId': args.workspace_id,
+            'generatedAt': datetime.datetime.utcnow().isoformat() + 'Z',
+            'thresholds': {
+                'lowStoragePercent': LOW_STORAGE_THRESHOLD,
+                'lastSeenSeconds': LAST_SEEN_THRESHOLD,
+                'checkForDataHours': CHECK_FOR_DATA_HOURS,
+            },
+            'devices': report,
+        }
+        if args.json == '-':
+            print(json.dumps(output, indent=2))
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(output, f, indent=2)
+
+    if args.watch:
+        from device_monitor import FleetMonitor, describe
+
+        events_file = open(args.events, 'a') if args.events else None
+
+        def on_change(change):
+            print(f"[{change['time']}] {describe(change)}")
+            if events_file:
+                events_file.write(json.dumps(change) + '\n')
+                events_file.flush()
+
+        print(f"\nWatching {len(report)} device(s) for changes every {args.watch} seconds...")
+        try:
+            FleetMonitor(client, args.workspace_id, on_change, devices, state=report).run(args.watch)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if events_file:
+                events_file.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+import bisect
+import heapq
+import json
+import mmap
+import os
+from typing import Dict, Iterable, Iterator, List, Tuple
+from urllib.parse import quote, unquote
+
+from api_types import StreamQuery
+from utils import to_epoch_ms
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+INDEX_INTERVAL = 64     # number of events between sparse index entries
+
+
+def sensor_key(event: dict) -> str:
+    return event.get('sensorId') or event.get('sensorName')
+
+
+class Segment:
+    """An immutable, time-ordered file of events for a single stream/sensor.
+
+    Each line of the data file is ``<epoch ms>\\t<event json>`` so that range scans can compare times without
+    decoding JSON.  The ``.idx`` file next to it holds the time bounds and a sparse index of
+    ``(epoch ms, byte offset)`` pairs, one every ``INDEX_INTERVAL`` events.
+    """
+
+    path: str
+    start: int
+    end: int
+    count: int
+    sensor_names: List[str]
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path + INDEX_SUFFIX, 'r') as f:
+            header = json.load(f)
+        self.start = header['start']
+        self.end = header['end']
+        self.count = header['count']
+        self.sensor_names = header['sensorNames']
+        self._index_times = [entry[0] for entry in header['index']]
+        self._index_offsets = [entry[1] for entry in header['index']]
+
+    @staticmethod
+    def write(path: str, events: List[Tuple[int, dict]]):
+        """Write ``(epoch ms, event)`` pairs, already sorted by time, to a new segment at ``path``."""
+        index = []
+        offset = 0
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for i, (ts, event) in enumerate(events):
+                if i % INDEX_INTERVAL == 0:
+                    index.append([ts, offset])
+                line = f'{ts}\t{json.dumps(event, separators=(",", ":"))}\n'.encode('utf-8')
+                f.write(line)
+                offset += len(line)
+        header = {
+            'start': events[0][0],
+            'end': events[-1][0],
+            'count': len(events),
+            'sensorNames': sorted({e.get('sensorName') for _, e in events if e.get('sensorName')}),
+            'index': index,
+        }
+        with open(path + INDEX_SUFFIX, 'w') as f:
+            json.dump(header, f)
+        # the data file is renamed last so a half-written segment is never picked up
+        os.replace(tmp_path, path)
+
+    def overlaps(self, start: int, end: int) -> bool:
+        return self.start <= end and start <= self.end
+
+    def scan(self, start: int, end: int) -> Iterator[Tuple[int, bytes]]:
+        """Yield ``(epoch ms, raw event json)`` for events with start <= time <= end, in time order."""
+        i = max(bisect.bisect_left(self._index_times, start) - 1, 0)
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            m.seek(self._index_offsets[i])
+            for line in iter(m.readline, b''):
+                tab = line.index(b'\t')
+                ts = int(line[:tab])
+                if ts < start:
+                    continue
+                if ts > end:
+                    break
+                yield ts, line[tab + 1:]
+
+
+class EventStore:
+    """Local append-only store of ``query_stream_flat`` results.
+
+    Events are kept in time-ordered segment files under ``<root>/<streamId>/<sensorId>/``.  Every call to
+    ``append`` writes new segments (existing files are never modified), and ``query_stream_flat`` answers a
+    ``StreamQuery`` from the stored segments so scripts can re-query data they've already pulled without a round
+    trip to the Data API.
+    """
+
+    root: str
+
+    def __init__(self, root: str):
+        self.root = root
+        self._segments: Dict[Tuple[str, str], List[Segment]] = {}
+        os.makedirs(root, exist_ok=True)
+
+    def _dir(self, stream_id: str, sensor: str) -> str:
+        return os.path.join(self.root, quote(stream_id, safe=''), quote(sensor, safe=''))
+
+    def _load(self, stream_id: str, sensor: str) -> List[Segment]:
+        key = (stream_id, sensor)
+        if key not in self._segments:
+            directory = self._dir(stream_id, sensor)
+            segments = []
+            if os.path.isdir(directory):
+                for name in sorted(os.listdir(directory)):
+                    if name.endswith(SEGMENT_SUFFIX):
+                        segments.append(Segment(os.path.join(directory, name)))
+            self._segments[key] = segments
+        return self._segments[key]
+
+    def streams(self) -> List[str]:
+        return sorted(unquote(name) for name in os.listdir(self.root))
+
+    def sensors(self, stream_id: str) -> List[str]:
+        directory = os.path.join(self.root, quote(stream_id, safe=''))
+        if not os.path.isdir(directory):
+            return []
+        # directory names are quoted IDs (see _dir)
+        return sorted(unquote(name) for name in os.listdir(directory))
+
+    def append(self, events: Iterable[dict]) -> int:
+        """Persist events returned by ``query_stream_flat``.  Events already in the store are skipped.
+
+        Returns the number of new events written.
+        """
+        groups: Dict[Tuple[str, str], List[Tuple[int, dict]]] = {}
+        for event in events:
+            groups.setdefault((event['streamId'], sensor_key(event)), []).append(
+                (to_epoch_ms(event['timeCollected']), event))
+
+        written = 0
+        for (stream_id, sensor), group in groups.items():
+            group.sort(key=lambda pair: pair[0])
+            segments = self._load(stream_id, sensor)
+            start, end = group[0][0], group[-1][0]
+            stored_ids = set()
+            for segment in segments:
+                if segment.overlaps(start, end):
+                    for _, raw in segment.scan(start, end):
+                        stored_ids.add(json.loads(raw)['id'])
+            seen = set()
+            new_events = []
+            for ts, event in group:
+                if event['id'] in stored_ids or event['id'] in seen:
+                    continue
+                seen.add(event['id'])
+                new_events.append((ts, event))
+            if not new_events:
+                continue
+
+            directory = self._dir(stream_id, sensor)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f'{len(segments):08d}{SEGMENT_SUFFIX}')
+            Segment.write(path, new_events)
+            segments.append(Segment(path))
+            written += len(new_events)
+        return written
+
+    def query_stream_flat(self, query: StreamQuery) -> List[dict]:
+        """Answer a ``StreamQuery`` from the local store.
+
+        Sensors match on either the stored ``sensorId`` or ``sensorName``.  ``in_progress_events`` is not
+        evaluated locally; the store returns whatever was persisted for the window.
+        """
+        start, end = to_epoch_ms(query.start_time), to_epoch_ms(query.end_time)
+        wanted = set(query.sensors or [])
+        runs = []
+        for sensor in self.sensors(query.stream_id):
+            for segment in self._load(query.stream_id, sensor):
+                if wanted and not (wanted & ({sensor} | set(segment.sensor_names))):
+                    continue
+                if segment.overlaps(start, end):
+                    runs.append(segment.scan(start, end))
+
+        descending = bool(query.order) and query.order.lower().startswith('desc')
+        results = []
+        seen = set()
+        merged = heapq.merge(*runs, key=lambda pair: pair[0])
+        if descending:
+            merged = reversed(list(merged))
+        for _, raw in merged:
+            event = json.loads(raw)
+            if event['id'] in seen:
+                continue
+            seen.add(event['id'])
+            if query.with_meta is False:
+                event.pop('meta', None)
+            results.append(event)
+            if query.limit and len(results) >= query.limit:
+                break
+        return results
+
+
+class StoreBackedClient:
+    """Wraps a ``DataApiClient`` so ``query_stream_flat`` results are written to an ``EventStore``.
+
+    With ``offline=True`` stream queries are answered from the store only.  All other calls are passed through
+    to the wrapped client.
+    """
+
+    def __init__(self, client, store: EventStore, offline: bool = False):
+        self.client = client
+        self.store = store
+        self.offline = offline
+
+    def query_stream_flat(self, query: StreamQuery):
+        if self.offline:
+            return self.store.query_stream_flat(query)
+        events = self.client.query_stream_flat(query)
+        self.store.append(events)
+        return events
+
+    def query_stream_flat_typed(self, query: StreamQuery):
+        from events import sensor_events
+        if self.offline:
+            return sensor_events(self.store.query_stream_flat(query))
+        # the store keeps the events as the API returned them: structs drop any field they don't declare
+        events = self.client.query_stream_flat(query)
+        self.store.append(events)
+        return sensor_events(events)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
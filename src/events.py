@@ -0,0 +1,86 @@
+import sys
+from datetime import datetime
+from typing import Any, List, Optional
+
+import msgspec
+
+from utils import to_epoch_ms
+
+
+class SensorEvent(msgspec.Struct, rename='camel', gc=False):
+    """A stream or sensor event, as returned by ``query_stream_flat`` and ``query_sensor_flat``.
+
+    Structs are slotted and untracked by the garbage collector, ``timeCollected`` is parsed while decoding and the
+    identifiers repeated by every event are interned, so a large response takes a fraction of the memory of the
+    equivalent dicts.  Fields the Data API adds later are ignored.
+    """
+    id: str
+    time_collected: datetime
+    stream_id: Optional[str] = None
+    device_id: Optional[str] = None
+    sensor_id: Optional[str] = None
+    sensor_name: Optional[str] = None
+    value: Any = None
+    meta: Optional[dict] = None
+
+    def __post_init__(self):
+        for name in ('stream_id', 'device_id', 'sensor_id', 'sensor_name'):
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, sys.intern(value))
+
+    @property
+    def time_ms(self) -> int:
+        return to_epoch_ms(self.time_collected)
+
+    def to_dict(self) -> dict:
+        """The event as the Data API returns it, for code which works on dicts."""
+        return msgspec.to_builtins(self)
+
+
+class MediaEvent(msgspec.Struct, rename='camel', gc=False):
+    """A media segment, as returned by ``query_media_data``.  ``timeCollected`` is the end of the recording."""
+    id: str
+    time_collected: datetime
+    duration_ms: int
+    url: str
+    stream_id: Optional[str] = None
+    device_id: Optional[str] = None
+    sensor_id: Optional[str] = None
+    meta: Optional[dict] = None
+
+    def __post_init__(self):
+        for name in ('stream_id', 'device_id', 'sensor_id'):
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, sys.intern(value))
+
+    @property
+    def end_ms(self) -> int:
+        return to_epoch_ms(self.time_collected)
+
+    @property
+    def start_ms(self) -> int:
+        return self.end_ms - self.duration_ms
+
+    def to_dict(self) -> dict:
+        return msgspec.to_builtins(self)
+
+
+# decoders are reusable and thread-safe; building them once keeps the schema compiled
+_sensor_events = msgspec.json.Decoder(List[SensorEvent])
+_media_events = msgspec.json.Decoder(List[MediaEvent])
+
+
+def decode_sensor_events(data: bytes) -> List[SensorEvent]:
+    """Decode a JSON array of events straight from response bytes."""
+    return _sensor_events.decode(data)
+
+
+def decode_media_events(data: bytes) -> List[MediaEvent]:
+    return _media_events.decode(data)
+
+
+def sensor_events(events: List[dict]) -> List[SensorEvent]:
+    """Convert already decoded event dicts, e.g. from an EventStore."""
+    return msgspec.convert(events, List[SensorEvent])
@@ -0,0 +1,155 @@
+import datetime
+import time
+from typing import List
+
+import dateutil.parser
+import dateutil.tz
+
+from api_types import SensorQuery, StreamQueryAggregate
+from utils import response_data, to_epoch_ms
+
+# bytes read from a sampled video to measure storage throughput
+PROBE_BYTES = 4 * 1024 * 1024
+SAMPLE_VIDEOS = 5
+# window sampled with a sensor query when the aggregate endpoint can't count events
+SAMPLE_HOURS = 24
+# rough ffmpeg time to trim one clip
+TRIM_SECONDS = 1.0
+
+
+def _timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def _window(args):
+    start = dateutil.parser.parse(args.startTime).astimezone(dateutil.tz.UTC).replace(tzinfo=None)
+    end = dateutil.parser.parse(args.endTime).astimezone(dateutil.tz.UTC).replace(tzinfo=None)
+    return start, end
+
+
+def event_counts(client, args, sensors: str, video_minutes: int) -> dict:
+    """Number of events and of video length windows with events, from one aggregate query counting events per
+    video length window, or extrapolated from a query of the last SAMPLE_HOURS if that isn't available."""
+    start, end = _window(args)
+    try:
+        result, seconds = _timed(client.query_stream_aggregate, StreamQueryAggregate(
+            stream_id=None, device_id=args.deviceId, sensors=[sensors], start_time=start, end_time=end,
+            interval=f'{video_minutes}m', functions=['count'], fill_empty_windows=False, order='asc'))
+    except Exception:
+        # any client's error (an HTTP error, or the daemon being unreachable): count from a sample instead
+        result = None
+    if result is not None:
+        counts = [int(row.get('count') or 0) for row in response_data(result) if isinstance(row, dict)]
+        return {'events': sum(counts), 'windows': sum(1 for count in counts if count), 'source': 'aggregate',
+                'latency': seconds}
+    sample_start = max(start, end - datetime.timedelta(hours=SAMPLE_HOURS))
+    events, seconds = _timed(client.query_sensor_flat, SensorQuery(
+        device_id=args.deviceId, sensors=[sensors], start_time=sample_start.isoformat(), end_time=end.isoformat(),
+        with_meta=False))
+    scale = (end - start) / max(end - sample_start, datetime.timedelta(seconds=1))
+    window_ms = video_minutes * 60 * 1000
+    windows = {to_epoch_ms(event['timeCollected']) // window_ms for event in events}
+    return {'events': round(len(events) * scale), 'windows': round(len(windows) * scale),
+            'source': f'last {SAMPLE_HOURS}h sample', 'latency': seconds}
+
+
+def sample_videos(backend, args, end: datetime.datetime) -> dict:
+    """Videos per day, mean video size and storage throughput, from listing the video prefix of the last day with
+    videos (of up to 3) and reading part of a few of them."""
+    from sensor_query import video_prefix
+    for days_back in range(3):
+        day = end - datetime.timedelta(days=days_back)
+        bucket, prefix = video_prefix(args, day)
+        names, listing_seconds = _timed(backend.list, bucket, prefix)
+        if names:
+            break
+    else:
+        return {'videosPerDay': 0, 'prefix': f'{bucket}/{prefix}', 'listingLatency': listing_seconds}
+    sampled = names[::max(len(names) // SAMPLE_VIDEOS, 1)][:SAMPLE_VIDEOS]
+    sizes = [backend.size(bucket, name) for name in sampled]
+    data, read_seconds = _timed(backend.read, bucket, sampled[0], 0, PROBE_BYTES)
+    return {'videosPerDay': len(names), 'prefix': f'{bucket}/{prefix}', 'sampled': len(sampled),
+            'videoBytes': sum(sizes) / len(sizes), 'listingLatency': listing_seconds,
+            'bytesPerSecond': len(data) / max(read_seconds, 1e-6)}
+
+
+def explain(client, args, backend=None, concurrency: int = 1) -> dict:
+    """Estimate what a `data-api.py query` job (args after ``time_parse``) costs without running it: events, API
+    requests, storage listings, bytes downloaded and uploaded and wall time at ``concurrency`` jobs at once."""
+    from sensor_query import SECONDS_AFTER_EVENT, SECONDS_BEFORE_EVENT, VIDEO_LENTH_MINUTES
+    start, end = _window(args)
+    counts = event_counts(client, args, args.sensors, VIDEO_LENTH_MINUTES)
+    # events kept by --filterMinutesModulo/--filterMinutesRestrict, if given
+    kept = 1.0
+    if args.filterMinutesModulo and args.filterMinutesRestrict:
+        kept = min(args.filterMinutesRestrict / args.filterMinutesModulo, 1.0)
+    events = round(counts['events'] * kept)
+    estimate = {
+        'deviceId': args.deviceId, 'sensors': args.sensors, 'startTime': args.startTime, 'endTime': args.endTime,
+        'countSource': counts['source'], 'events': events,
+        # the planner answers the query and the cross reference query with one request
+        'apiRequests': 1, 'listings': 0, 'downloads': 0, 'downloadBytes': 0, 'uploads': 0, 'uploadBytes': 0,
+        'concurrency': concurrency,
+    }
+    seconds = counts['latency']
+    if args.where:
+        estimate['notes'] = ['--where is applied after querying, so events are an upper bound']
+    if args.downloadEventClips and backend is not None and events:
+        videos = sample_videos(backend, args, end)
+        estimate['videoSample'] = videos
+        # a video covers VIDEO_LENTH_MINUTES, so every window with events needs about one source video
+        source_videos = min(counts['windows'], events)
+        video_bytes = videos.get('videoBytes', 0)
+        clip_fraction = (SECONDS_BEFORE_EVENT + SECONDS_AFTER_EVENT) / (VIDEO_LENTH_MINUTES * 60)
+        estimate.update(listings=events, downloads=source_videos, downloadBytes=round(source_videos * video_bytes))
+        if args.uploadEventClips:
+            estimate.update(uploads=events, uploadBytes=round(events * video_bytes * clip_fraction))
+        throughput = videos.get('bytesPerSecond') or float('inf')
+        seconds += (events * videos['listingLatency'] + (estimate['downloadBytes'] + estimate['uploadBytes']) / throughput
+                    + events * TRIM_SECONDS)
+    estimate['seconds'] = round(seconds / max(concurrency, 1), 1)
+    return estimate
+
+
+def _duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds < 60:
+        return f'{seconds}s'
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h{minutes:02d}m' if hours else f'{minutes}m{seconds:02d}s'
+
+
+def print_estimate(estimate: dict):
+    if 'deviceId' in estimate:
+        print(f'\nEstimate for {estimate["deviceId"]} {estimate["sensors"]} from {estimate["startTime"]} to '
+              f'{estimate["endTime"]} (event counts from {estimate["countSource"]}):')
+    else:
+        print(f'\nEstimate for {estimate["countSource"]}:')
+    print(f'  {"events":<18}{estimate["events"]:>12}')
+    print(f'  {"API requests":<18}{estimate["apiRequests"]:>12}')
+    print(f'  {"video listings":<18}{estimate["listings"]:>12}')
+    print(f'  {"source videos":<18}{estimate["downloads"]:>12}{estimate["downloadBytes"] / 1e9:>10.2f} GB')
+    print(f'  {"uploaded clips":<18}{estimate["uploads"]:>12}{estimate["uploadBytes"] / 1e9:>10.2f} GB')
+    print(f'  {"wall time":<18}{_duration(estimate["seconds"]):>12}  at concurrency {estimate["concurrency"]}')
+    sample = estimate.get('videoSample')
+    if sample:
+        if sample['videosPerDay']:
+            print(f'  sampled {sample["sampled"]} of {sample["videosPerDay"]} videos in {sample["prefix"]}: '
+                  f'{sample["videoBytes"] / 1e6:.0f} MB each, read at {sample["bytesPerSecond"] / 1e6:.1f} MB/s')
+        else:
+            print(f'  no videos found in {sample["prefix"]} (or the 2 days before)')
+    for note in estimate.get('notes', []):
+        print(f'  note: {note}')
+
+
+def total(estimates: List[dict], concurrency: int) -> dict:
+    """Estimate of running several jobs ``concurrency`` at a time (e.g. a batch manifest)."""
+    keys = ('events', 'apiRequests', 'listings', 'downloads', 'downloadBytes', 'uploads', 'uploadBytes')
+    summed = {key: sum(estimate[key] for estimate in estimates) for key in keys}
+    summed['seconds'] = round(sum(estimate['seconds'] for estimate in estimates) / max(concurrency, 1), 1)
+    summed['concurrency'] = concurrency
+    summed['countSource'] = f'{len(estimates)} jobs'
+    return summed
@@ -0,0 +1,261 @@
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from datetime import datetime
+from typing import List, NamedTuple
+from urllib.parse import quote
+
+from dateutil import parser as date_parser
+
+from api_types import SensorsByWorkspaceQuery, StreamQuery
+from aggregation import interval_ms
+from client import DataApiClient, DEFAULT_API_BASE
+from filters import add_where_argument, where_filter
+from utils import from_epoch_ms, response_data, to_epoch_ms
+
+DEFAULT_SHARD = '1d'
+DEFAULT_RETRIES = 3
+CHECKPOINT_FILE = 'checkpoint.jsonl'
+
+
+class ExportTask(NamedTuple):
+    """One (stream, sensor, time shard) of an export, written to its own file.
+
+    A shard is named by its aligned ``[shard_start_ms, shard_end_ms)``; the first and last shards of an export only
+    query the part ``[start_ms, end_ms)`` inside the export's window.
+    """
+    stream_id: str
+    sensor: str
+    shard_start_ms: int
+    shard_end_ms: int
+    start_ms: int
+    end_ms: int
+    attempt: int = 0
+
+    @property
+    def key(self) -> str:
+        return f'{self.stream_id}/{self.sensor}/{self.shard_start_ms}-{self.shard_end_ms}'
+
+    def path(self, root: str) -> str:
+        return os.path.join(root, quote(self.stream_id, safe=''), quote(self.sensor, safe=''),
+                            f'{self.shard_start_ms}-{self.shard_end_ms}.jsonl')
+
+
+def workspace_streams(client, workspace_id: str, start: datetime, end: datetime) -> List[tuple]:
+    """(stream ID, sensor) pairs of a workspace which have data between start and end."""
+    sensors = response_data(client.get_sensors_by_workspace(
+        SensorsByWorkspaceQuery(workspace_id=workspace_id, start_time=start.isoformat(), end_time=end.isoformat())))
+    pairs = set()
+    for sensor in sensors:
+        stream_id = sensor.get('streamId') or sensor.get('deviceId')
+        name = sensor.get('sensorId') or sensor.get('sensorName') or sensor.get('name')
+        if stream_id and name:
+            pairs.add((stream_id, name))
+    return sorted(pairs)
+
+
+def plan_tasks(pairs: List[tuple], start_ms: int, end_ms: int, shard_ms: int) -> List[ExportTask]:
+    """Split each (stream, sensor) pair into shards of shard_ms, aligned to multiples of shard_ms so re-planning an
+    overlapping export produces the same shards."""
+    tasks = []
+    first = start_ms - start_ms % shard_ms
+    for stream_id, sensor in pairs:
+        for shard_start in range(first, end_ms, shard_ms):
+            shard_end = shard_start + shard_ms
+            tasks.append(ExportTask(stream_id, sensor, shard_start, shard_end,
+                                    max(shard_start, start_ms), min(shard_end, end_ms)))
+    return tasks
+
+
+def read_checkpoint(root: str) -> dict:
+    """``{key: (start_ms, end_ms)}`` of the part of each shard a previous run completed last."""
+    done = {}
+    path = os.path.join(root, CHECKPOINT_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry.get('status') == 'done' and 'startMs' in entry:
+                    done[entry['task']] = (entry['startMs'], entry['endMs'])
+    return done
+
+
+def completed(task: ExportTask, done: dict) -> bool:
+    """Whether a previous run wrote the whole window of a task; a shard whose window has grown, e.g. the last shard
+    of an export resumed later, is exported again."""
+    if task.key not in done:
+        return False
+    start_ms, end_ms = done[task.key]
+    return start_ms <= task.start_ms and end_ms >= task.end_ms
+
+
+def export_shard(client, task: ExportTask, root: str, event_filter=None) -> int:
+    """Query one shard and write its events (those matching event_filter, if given), oldest first, as JSON lines.
+    Returns the number of events written."""
+    import msgspec
+    events = client.query_stream_flat_typed(StreamQuery(
+        stream_id=task.stream_id, sensors=[task.sensor],
+        start_time=from_epoch_ms(task.start_ms).replace(tzinfo=None),
+        end_time=from_epoch_ms(task.end_ms).replace(tzinfo=None)))
+    if event_filter:
+        events = event_filter.apply(events)
+    events.sort(key=lambda event: event.time_collected)
+    path = task.path(root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # written next to the shard first, so a shard file is always complete
+    partial = f'{path}.{os.getpid()}.part'
+    encoder = msgspec.json.Encoder()
+    with open(partial, 'wb') as f:
+        for event in events:
+            f.write(encoder.encode(event))
+            f.write(b'\n')
+    os.replace(partial, path)
+    return len(events)
+
+
+def worker(api_key: str, api_base: str, root: str, tasks, results, where: str = None):
+    """Process loop: take tasks from the shared queue until a None arrives, reporting each outcome."""
+    import contextlib
+    client = DataApiClient(api_key=api_key, api_base=api_base)
+    # compiled once per process; the expression itself is what's sent to the workers
+    event_filter = where_filter(where)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        started = time.perf_counter()
+        try:
+            # the client prints every query, which would interleave across processes
+            with contextlib.redirect_stdout(None):
+                count = export_shard(client, task, root, event_filter)
+            results.put(('done', task, count, time.perf_counter() - started))
+        except Exception as e:
+            results.put(('failed', task, f'{type(e).__name__}: {e}', time.perf_counter() - started))
+
+
+def export(api_key: str, api_base: str, tasks: List[ExportTask], root: str, processes: int,
+           retries: int = DEFAULT_RETRIES, where: str = None) -> dict:
+    """Run tasks in a pool of worker processes fed by a shared work queue.
+
+    Failed tasks go back on the queue after an exponential backoff, up to ``retries`` times.  Every outcome is appended
+    to the checkpoint file in root, and tasks recorded there as done are skipped, so an interrupted export resumes
+    where it stopped.  ``where`` is a filter expression (see filters.py) applied to every shard's events.
+    """
+    done = read_checkpoint(root)
+    pending = [task for task in tasks if not completed(task, done)]
+    summary = {'tasks': len(tasks), 'skipped': len(tasks) - len(pending), 'done': 0, 'failed': 0, 'events': 0}
+    if not pending:
+        return summary
+    os.makedirs(root, exist_ok=True)
+    work = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for task in pending:
+        work.put(task)
+    workers = [multiprocessing.Process(target=worker, args=(api_key, api_base, root, work, results, where), daemon=True)
+               for _ in range(min(processes, len(pending)))]
+    for process in workers:
+        process.start()
+
+    started = time.perf_counter()
+    outstanding = len(pending)
+    # failed tasks waiting out their backoff, as (time they're due, task), so no worker sleeps on one
+    delayed = []
+    try:
+        with open(os.path.join(root, CHECKPOINT_FILE), 'a') as checkpoint:
+            while outstanding:
+                while delayed and delayed[0][0] <= time.time():
+                    work.put(heapq.heappop(delayed)[1])
+                timeout = min(5, max(delayed[0][0] - time.time(), 0)) if delayed else 5
+                try:
+                    status, task, detail, seconds = results.get(timeout=timeout)
+                except queue.Empty:
+                    if not any(process.is_alive() for process in workers):
+                        raise RuntimeError('all export workers exited')
+                    continue
+                entry = {'task': task.key, 'status': status, 'attempt': task.attempt, 'seconds': round(seconds, 3),
+                         'startMs': task.start_ms, 'endMs': task.end_ms}
+                if status == 'done':
+                    summary['done'] += 1
+                    summary['events'] += detail
+                    entry['events'] = detail
+                    outstanding -= 1
+                elif task.attempt < retries:
+                    entry['error'] = detail
+                    status = 'retrying'
+                    heapq.heappush(delayed, (time.time() + 2 ** task.attempt, task._replace(attempt=task.attempt + 1)))
+                else:
+                    entry['error'] = detail
+                    summary['failed'] += 1
+                    outstanding -= 1
+                    print(f'Failed exporting {task.key} after {task.attempt + 1} attempts: {detail}', file=sys.stderr)
+                checkpoint.write(json.dumps(entry) + '\n')
+                checkpoint.flush()
+                finished = summary['done'] + summary['failed']
+                elapsed = time.perf_counter() - started
+                print(f'[{finished}/{len(pending)}] {task.key} {status} '
+                      f'({summary["events"]} events, {summary["events"] / elapsed:.0f} events/s)')
+    finally:
+        for _ in workers:
+            work.put(None)
+        for process in workers:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+    summary['seconds'] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the stream events of a workspace to JSON lines files, one '
+                                                 'per stream, sensor and time shard, using a pool of processes.')
+    parser.add_argument('--workspace_id', '-w', required=True, help='workspace to export')
+    parser.add_argument('--output', '-o', required=True,
+                        help='directory to write <streamId>/<sensor>/<shardStartMs>-<shardEndMs>.jsonl files and the '
+                             'checkpoint to.  Rerunning with the same output resumes an interrupted export.')
+    parser.add_argument('--startTime', help='start of the export, in any format dateutil supports')
+    parser.add_argument('--endTime', help='end of the export.  Defaults to now.')
+    parser.add_argument('--lastDays', type=int, default=7,
+                        help='days before the end to export when --startTime isn\'t given.  Defaults to 7.')
+    parser.add_argument('--shard', default=DEFAULT_SHARD,
+                        help=f'time span of each task, e.g. 6h or 1d.  Defaults to {DEFAULT_SHARD}.')
+    parser.add_argument('--stream_ids', help='comma separated streams to export instead of all of the workspace\'s')
+    parser.add_argument('--processes', '-p', type=int, default=os.cpu_count(),
+                        help='number of worker processes.  Defaults to the number of CPUs.')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help=f'times a failed task is retried.  Defaults to {DEFAULT_RETRIES}.')
+    add_where_argument(parser)
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    api_key = os.environ.get('API_KEY')
+    api_base = os.environ.get('API_BASE') or DEFAULT_API_BASE
+    if not api_key:
+        print('Please set the API_KEY environment variable.')
+        sys.exit(1)
+
+    end_ms = to_epoch_ms(date_parser.parse(args.endTime)) if args.endTime else to_epoch_ms(datetime.utcnow())
+    start_ms = to_epoch_ms(date_parser.parse(args.startTime)) if args.startTime else end_ms - args.lastDays * 24 * 60 * 60 * 1000
+    start, end = from_epoch_ms(start_ms).replace(tzinfo=None), from_epoch_ms(end_ms).replace(tzinfo=None)
+
+    client = DataApiClient(api_key=api_key, api_base=api_base)
+    pairs = workspace_streams(client, args.workspace_id, start, end)
+    if args.stream_ids:
+        stream_ids = set(args.stream_ids.split(','))
+        pairs = [pair for pair in pairs if pair[0] in stream_ids]
+    tasks = plan_tasks(pairs, start_ms, end_ms, interval_ms(args.shard))
+    print(f'Exporting {len(pairs)} stream sensor(s) from {start.isoformat()} to {end.isoformat()} as {len(tasks)} '
+          f'task(s) with {args.processes} process(es)')
+    summary = export(api_key, api_base, tasks, args.output, args.processes, args.retries, args.where)
+    print(json.dumps(summary, indent=2))
+    if summary['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
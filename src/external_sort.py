@@ -0,0 +1,163 @@
+import heapq
+import os
+import shutil
+import struct
+import tempfile
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+
+import msgspec
+
+from profiling import profiler
+
+DEFAULT_MEMORY_MB = 256
+# runs merged at once; more runs are merged in several passes so the number of open files stays bounded
+MAX_FAN_IN = 64
+READ_BUFFER_SIZE = 1 << 20
+# rough per item cost of the buffer's list entries and key, on top of the encoded item
+ITEM_OVERHEAD = 100
+
+_LENGTH = struct.Struct('<I')
+
+
+class ExternalSorter:
+    """Sorts more items than fit in memory.
+
+    Items are encoded with msgpack as they are added and kept in a buffer; when the buffer's size passes
+    ``memory_mb`` it is sorted and spilled to a temporary file as a run of length-prefixed ``[key, item]`` records.
+    Iterating k-way merges the runs (and what is still buffered) with ``heapq.merge``, streaming items back in
+    ``key`` order, so memory use is bounded by the budget plus one record per run.  The sort is stable.
+
+    Keys must be msgpack types (numbers, strings, datetimes, or tuples of them, which come back as lists).  Items come
+    back as decoded by msgspec: dicts, unless ``type`` (e.g. ``events.SensorEvent``) is given.
+    """
+
+    def __init__(self, key: Callable[[Any], Any], memory_mb: float = DEFAULT_MEMORY_MB, reverse: bool = False,
+                 directory: str = None, type: Any = Any):
+        self.key = key
+        self.memory_limit = memory_mb * 1024 * 1024
+        self.reverse = reverse
+        self.directory = directory
+        self.count = 0
+        self.runs: List[str] = []
+        self.spills = 0
+        self.spilled_bytes = 0
+        self._buffer: List[Tuple[Any, bytes]] = []
+        self._buffered_bytes = 0
+        self._encoder = msgspec.msgpack.Encoder()
+        self._decoder = msgspec.msgpack.Decoder(Tuple[Any, type])
+        self._item_decoder = msgspec.msgpack.Decoder(type)
+        self._tmp = None
+        self._files = 0
+
+    def add(self, item):
+        key = self.key(item)
+        data = self._encoder.encode(item)
+        self._buffer.append((key, data))
+        self._buffered_bytes += len(data) + ITEM_OVERHEAD
+        self.count += 1
+        if self._buffered_bytes >= self.memory_limit:
+            self._spill()
+
+    def add_all(self, items: Iterable):
+        for item in items:
+            self.add(item)
+
+    def _run_path(self) -> str:
+        if self._tmp is None:
+            self._tmp = tempfile.mkdtemp(prefix='external-sort-', dir=self.directory)
+        self._files += 1
+        return os.path.join(self._tmp, f'run-{self._files:06d}')
+
+    def _spill(self):
+        if not self._buffer:
+            return
+        with profiler.span('external_sort.spill', 'sort', items=len(self._buffer)):
+            self._buffer.sort(key=lambda entry: entry[0], reverse=self.reverse)
+            path = self._run_path()
+            size = 0
+            with open(path, 'wb') as f:
+                for key, data in self._buffer:
+                    # the key is encoded next to the already encoded item, as a 2 element msgpack array
+                    record = b'\x92' + self._encoder.encode(key) + data
+                    f.write(_LENGTH.pack(len(record)))
+                    f.write(record)
+                    size += _LENGTH.size + len(record)
+            profiler.add(bytes=size)
+        self.runs.append(path)
+        self.spills += 1
+        self.spilled_bytes += size
+        self._buffer = []
+        self._buffered_bytes = 0
+
+    def _read_run(self, path: str) -> Iterator[tuple]:
+        decode = self._decoder.decode
+        with open(path, 'rb', buffering=READ_BUFFER_SIZE) as f:
+            while True:
+                header = f.read(_LENGTH.size)
+                if not header:
+                    return
+                yield decode(f.read(_LENGTH.unpack(header)[0]))
+
+    def _merge(self, sources: List[Iterable[tuple]]) -> Iterator[tuple]:
+        # sources are in insertion order and heapq.merge takes equal keys from earlier sources first: stable
+        return heapq.merge(*sources, key=lambda entry: entry[0], reverse=self.reverse)
+
+    def _reduce_runs(self):
+        """Merge consecutive runs (keeping the sort stable) in passes until at most MAX_FAN_IN are left."""
+        while len(self.runs) > MAX_FAN_IN:
+            with profiler.span('external_sort.merge_pass', 'sort', runs=len(self.runs)):
+                runs = []
+                for i in range(0, len(self.runs), MAX_FAN_IN):
+                    group = self.runs[i:i + MAX_FAN_IN]
+                    if len(group) == 1:
+                        runs.append(group[0])
+                        continue
+                    path = self._run_path()
+                    with open(path, 'wb') as f:
+                        for entry in self._merge([self._read_run(run) for run in group]):
+                            record = self._encoder.encode(entry)
+                            f.write(_LENGTH.pack(len(record)))
+                            f.write(record)
+                    for run in group:
+                        os.remove(run)
+                    runs.append(path)
+                self.runs = runs
+
+    def __iter__(self) -> Iterator:
+        """Items in key order.  The sorter can be iterated once; its files are removed when iteration ends."""
+        try:
+            if not self.runs:
+                self._buffer.sort(key=lambda entry: entry[0], reverse=self.reverse)
+                decode = self._item_decoder.decode
+                for _, data in self._buffer:
+                    yield decode(data)
+                return
+            # what is still buffered becomes the last run, keeping insertion order across sources
+            self._spill()
+            self._reduce_runs()
+            for _, item in self._merge([self._read_run(run) for run in self.runs]):
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._buffer = []
+        self._buffered_bytes = 0
+        self.runs = []
+        if self._tmp is not None:
+            shutil.rmtree(self._tmp, ignore_errors=True)
+            self._tmp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def external_sorted(items: Iterable, key: Callable[[Any], Any], memory_mb: float = DEFAULT_MEMORY_MB,
+                    reverse: bool = False, directory: str = None, type: Any = Any) -> Iterator:
+    """Like ``sorted``, but spilling to disk past ``memory_mb`` and returning an iterator.  See ``ExternalSorter``."""
+    sorter = ExternalSorter(key, memory_mb=memory_mb, reverse=reverse, directory=directory, type=type)
+    sorter.add_all(items)
+    return iter(sorter)
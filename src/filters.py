@@ -0,0 +1,247 @@
+import argparse
+import ast
+import fnmatch
+import functools
+import math
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+from utils import to_epoch_ms
+
+MS_PER_DAY = 24 * 60 * 60 * 1000
+WHERE_HELP = ('only keep events matching a filter expression, e.g. "minute %% 10 < 3 and weekday < 5", '
+              '"timeOn > 1.5", "numObjectsInRegion >= 2 and matches(sensor, \'PRESENCE_*\')".  Time fields '
+              '(minute, hour, second, weekday with Monday 0, time as HH:MM:SS, date as YYYY-MM-DD) are in UTC; other '
+              'names are event fields (id, sensor, sensorId, sensorName, streamId, deviceId, value) or meta fields.')
+
+_ALLOWED_NODES = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn,
+    ast.Name, ast.Load, ast.Constant, ast.List, ast.Tuple, ast.Call, ast.Attribute,
+)
+_FUNCTIONS = ('matches',)
+TIME_FIELDS = ('minute', 'hour', 'second', 'weekday', 'time', 'date')
+EVENT_FIELDS = ('sensor', 'id', 'sensorId', 'sensorName', 'streamId', 'deviceId', 'value', 'timeCollected')
+
+
+def _time_fields(ms: int) -> dict:
+    moment = datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+    return {'minute': moment.minute, 'hour': moment.hour, 'second': moment.second, 'weekday': moment.weekday(),
+            'time': moment.strftime('%H:%M:%S'), 'date': moment.strftime('%Y-%m-%d')}
+
+
+def event_getter(name: str) -> Callable:
+    """Function reading the field ``name`` from an event dict or typed ``SensorEvent``."""
+    if name == 'sensor':
+        return lambda event: _get(event, 'sensorName') or _get(event, 'sensorId')
+    if name in EVENT_FIELDS:
+        return lambda event: _get(event, name)
+    meta_name = name[len('meta.'):] if name.startswith('meta.') else name
+    return lambda event: (_get(event, 'meta') or {}).get(meta_name)
+
+
+def _get(event, name: str):
+    if isinstance(event, dict):
+        return event.get(name)
+    # typed events (see events.py) use snake case attributes
+    return getattr(event, ''.join('_' + c.lower() if c.isupper() else c for c in name), None)
+
+
+def matches(value, pattern: str) -> bool:
+    """Shell-style pattern match, e.g. ``matches(sensor, 'PRESENCE_*')``."""
+    return isinstance(value, str) and fnmatch.fnmatchcase(value, pattern)
+
+
+class _Validate(ast.NodeTransformer):
+    """Reject everything but the filter language, and turn ``meta.<field>`` into the name ``meta.<field>``."""
+
+    def generic_visit(self, node):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ValueError(f'Unsupported syntax in filter expression: {type(node).__name__}')
+        return super().generic_visit(node)
+
+    def visit_Name(self, node):
+        if node.id.startswith('_'):
+            raise ValueError(f'Invalid name {node.id} in filter expression')
+        return node
+
+    def visit_Attribute(self, node):
+        if not (isinstance(node.value, ast.Name) and node.value.id == 'meta'):
+            raise ValueError('Only meta.<field> attributes are supported in filter expressions')
+        return ast.copy_location(ast.Name(id=f'meta.{node.attr}', ctx=ast.Load()), node)
+
+    def visit_Call(self, node):
+        if not (isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS) or node.keywords:
+            raise ValueError(f'Only the functions {", ".join(_FUNCTIONS)} can be called in filter expressions')
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+
+class _Vectorize(ast.NodeTransformer):
+    """Rewrite a validated expression to work on numpy columns: and/or/not become logical_and/or/not (not &/|, which
+    are bitwise on integer columns), comparison chains are split, membership uses np.isin and function calls are
+    mapped over the column."""
+
+    def visit_BoolOp(self, node):
+        values = [self.visit(value) for value in node.values]
+        name = '_and' if isinstance(node.op, ast.And) else '_or'
+        return ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=values, keywords=[])
+
+    def visit_UnaryOp(self, node):
+        operand = self.visit(node.operand)
+        if isinstance(node.op, ast.Not):
+            return ast.Call(func=ast.Name(id='_not', ctx=ast.Load()), args=[operand], keywords=[])
+        return ast.UnaryOp(op=node.op, operand=operand)
+
+    def visit_Compare(self, node):
+        left = self.visit(node.left)
+        parts = []
+        for op, comparator in zip(node.ops, node.comparators):
+            right = self.visit(comparator)
+            if isinstance(op, (ast.In, ast.NotIn)):
+                part = ast.Call(func=ast.Name(id='_isin', ctx=ast.Load()), args=[left, right], keywords=[])
+                if isinstance(op, ast.NotIn):
+                    part = ast.Call(func=ast.Name(id='_not', ctx=ast.Load()), args=[part], keywords=[])
+            else:
+                part = ast.Compare(left=left, ops=[op], comparators=[right])
+            parts.append(part)
+            left = right
+        result = parts[0]
+        for part in parts[1:]:
+            result = ast.BinOp(left=result, op=ast.BitAnd(), right=part)
+        return result
+
+    def visit_Call(self, node):
+        node.args = [self.visit(arg) for arg in node.args]
+        node.func = ast.Name(id='_v' + node.func.id, ctx=ast.Load())
+        return node
+
+
+def _vmatches(column, pattern):
+    import numpy as np
+    return np.fromiter((matches(value, pattern) for value in np.ravel(column)), dtype=bool, count=np.size(column))
+
+
+_SCALAR_GLOBALS = {'__builtins__': {}, 'matches': matches}
+
+
+@functools.lru_cache(maxsize=None)
+def _vector_globals() -> dict:
+    # numpy is imported on the first batch evaluation, so scripts only adding --where don't load it
+    import numpy as np
+    return {'__builtins__': {}, '_vmatches': _vmatches, '_not': np.logical_not, '_isin': np.isin,
+            '_and': lambda *columns: functools.reduce(np.logical_and, columns),
+            '_or': lambda *columns: functools.reduce(np.logical_or, columns)}
+
+
+class EventFilter:
+    """A filter expression compiled once, evaluated per event (``filter(event)``) while streaming or over a batch
+    (``mask(events)``/``apply(events)``) with numpy.
+
+    The language is a subset of Python expressions: comparisons, ``and``/``or``/``not``, arithmetic (``%`` for
+    minute modulo filters), ``in`` lists and ``matches(field, 'glob')``.  An event which lacks a field the expression
+    uses doesn't match.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f'Invalid filter expression {expression!r}: {e.msg}') from None
+        tree = ast.fix_missing_locations(_Validate().visit(tree))
+        self.names = sorted({node.id for node in ast.walk(tree)
+                             if isinstance(node, ast.Name) and node.id not in _FUNCTIONS})
+        self._time_names = [name for name in self.names if name in TIME_FIELDS]
+        self._getters = {name: event_getter(name) for name in self.names if name not in TIME_FIELDS}
+        self._scalar = compile(tree, '<where>', 'eval')
+        self._vector = compile(ast.fix_missing_locations(_Vectorize().visit(tree)), '<where>', 'eval')
+
+    def __repr__(self):
+        return f'EventFilter({self.expression!r})'
+
+    @property
+    def uses_meta(self) -> bool:
+        """Whether the expression reads meta fields, so events must be queried with meta."""
+        return any(name not in TIME_FIELDS and name not in EVENT_FIELDS for name in self.names)
+
+    def _values(self, event) -> Dict[str, object]:
+        values = {name: getter(event) for name, getter in self._getters.items()}
+        if self._time_names:
+            time_fields = _time_fields(to_epoch_ms(_get(event, 'timeCollected')))
+            values.update((name, time_fields[name]) for name in self._time_names)
+        return values
+
+    def __call__(self, event) -> bool:
+        values = self._values(event)
+        if any(value is None for value in values.values()):
+            return False
+        try:
+            result = eval(self._scalar, _SCALAR_GLOBALS, values)
+        except (TypeError, ZeroDivisionError):
+            return False
+        # a non-finite number (e.g. an overflow) doesn't match, as in mask()
+        if isinstance(result, float) and not math.isfinite(result):
+            return False
+        return bool(result)
+
+    def mask(self, events: List) -> 'numpy.ndarray':
+        """Boolean array of which events match, evaluating the expression once over columns of the batch."""
+        import numpy as np
+        count = len(events)
+        if count == 0:
+            return np.zeros(0, dtype=bool)
+        columns = {}
+        present = np.ones(count, dtype=bool)
+        if self._time_names:
+            times = np.array([to_epoch_ms(_get(event, 'timeCollected')) for event in events], dtype=np.int64)
+            # 1970-01-01 was a Thursday
+            numeric = {'second': times // 1000 % 60, 'minute': times // 60000 % 60, 'hour': times // 3600000 % 24,
+                       'weekday': (times // MS_PER_DAY + 3) % 7}
+            for name in self._time_names:
+                columns[name] = numeric[name] if name in numeric else np.array(
+                    [_time_fields(ms)[name] for ms in times.tolist()], dtype=object)
+        for name, getter in self._getters.items():
+            values = [getter(event) for event in events]
+            missing = np.fromiter((value is None for value in values), dtype=bool, count=count)
+            present &= ~missing
+            if all(isinstance(value, (int, float)) and not isinstance(value, bool)
+                   for value, absent in zip(values, missing) if not absent):
+                columns[name] = np.array([np.nan if value is None else value for value in values], dtype=float)
+            else:
+                columns[name] = np.array(values, dtype=object)
+        try:
+            # numpy divides by zero into inf, nan or 0 where __call__ doesn't match, so it raises here instead
+            with np.errstate(divide='raise', invalid='raise', over='ignore'):
+                result = np.asarray(eval(self._vector, _vector_globals(), columns))
+        except (TypeError, ZeroDivisionError, FloatingPointError):
+            # e.g. a comparison between incompatible types or a division by zero somewhere in the batch: fall back to
+            # events one by one
+            return np.fromiter((self(event) for event in events), dtype=bool, count=count)
+        if result.dtype.kind == 'f':
+            result = np.isfinite(result) & (result != 0)
+        return np.broadcast_to(result.astype(bool), (count,)) & present
+
+    def apply(self, events: List) -> List:
+        """The events which match, in order."""
+        mask = self.mask(events)
+        return [event for event, keep in zip(events, mask) if keep]
+
+
+def where_filter(expression: str = None):
+    """An EventFilter for a --where option, or None if it wasn't given."""
+    return EventFilter(expression) if expression else None
+
+
+def _expression(value: str) -> str:
+    try:
+        EventFilter(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
+def add_where_argument(parser):
+    # compiled while parsing, so argparse reports a bad expression as a usage error
+    parser.add_argument('--where', type=_expression, help=WHERE_HELP)
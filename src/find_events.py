@@ -1,17 +1,16 @@
 import json
-import os
 from datetime import datetime, timedelta
 from typing import List
 from dateutil import parser as date_parser
 
-from dotenv import load_dotenv
-
 from api_types import StreamQuery, InProgressEvents, MediaQuery
-from client import DataApiClient
+from client import DataApiClient, client_from_env
+from event_store import EventStore, StoreBackedClient
+from filters import add_where_argument, where_filter
 import argparse
 
 
-def run(stream_id: str, sensors: List[str]):
+def run(client: DataApiClient, stream_id: str, sensors: List[str]):
     start =  datetime.now() - timedelta(days=1)
     end = datetime.now()
     query = StreamQuery(stream_id=stream_id, sensors=sensors, start_time=start, end_time=end)
@@ -22,48 +21,26 @@ def run(stream_id: str, sensors: List[str]):
     print(f'Response length => {length}')
 
 
-def objects_in_region(input: json):
-    try:
-        return int(input['meta']['numObjectsInRegion'])
-    except KeyError:
-        return 0
-
-
-def get_object_id(event: json):
-    return event['meta']['object']['uniqueId']
-
-
-def get_event_by_object_id(events, object_id):
-    events_with_object = []
-    for event in events:
-        if (get_object_id(event) == object_id):
-            events_with_object.append(event)
-    return events_with_object
-
-
-if __name__ == '__main__':
-    print('Running in object correlation example...')
-    load_dotenv()
-    api_key = os.environ.get("API_KEY")
-    api_base = os.environ.get("API_BASE")
-
-    if not api_key:
-        print('Please set the API_KEY environment variable.')
-        print('e.g. `export API_KEY="38ed7729792c48489945c8060255fa45"`')
-        exit(1)
-
-    if not api_base:
-        api_base = 'https://data-api.boulderai.com/'
-
-    parser = argparse.ArgumentParser(description='In progress example.')
+def main(argv=None):
+    print('Running find events example...')
+    parser = argparse.ArgumentParser(description='Find events example.')
     parser.add_argument('--stream_id', dest='stream_id',
                         help='stream_id to demonstrate', required=True)
 
     parser.add_argument('--sensors', dest='sensors', help='sensors to query', required=True)
-
-    args = parser.parse_args()
-
-    client = DataApiClient(api_key=api_key, api_base=api_base)
+    parser.add_argument('--store', dest='store',
+                        help='directory of a local event store.  Queried events are saved to it for re-querying.')
+    parser.add_argument('--offline', dest='offline', action='store_true',
+                        help='answer stream queries from --store without calling the Data API')
+    add_where_argument(parser)
+
+    args = parser.parse_args(argv)
+    if args.offline and not args.store:
+        parser.error('--offline requires --store')
+
+    client = client_from_env()
+    if args.store:
+        client = StoreBackedClient(client, EventStore(args.store), offline=args.offline)
     stream_id = args.stream_id
     sensors = args.sensors.split(',')
 
@@ -77,7 +54,14 @@ if __name__ == '__main__':
         start_time=start,
         end_time=end
     ))
+    event_filter = where_filter(args.where)
+    if event_filter:
+        results = event_filter.apply(results)
 
     print(f'Found {len(results)} events.')
     for result in results[:10]:
         print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,20 +5,21 @@ from datetime import datetime, timedelta
 from typing import List
 from dateutil import parser as date_parser
 
-from dotenv import load_dotenv
-
 from api_types import StreamQuery, InProgressEvents, MediaQuery
-from client import DataApiClient
+from client import DataApiClient, client_from_env
 import argparse
 
-from google.cloud import storage
-import google.auth
 import subprocess
 
+from media_cache import MediaCache, cache_key, link_or_copy, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE_MB
+from filters import add_where_argument, where_filter
+from media_index import MediaIndex
+from progressive import iter_events_backward
+from storage import LocalBackend, DEFAULT_DOWNLOAD_WORKERS
 from utils import get_media_range
 
 
-def run(stream_id: str, sensors: List[str]):
+def run(client: DataApiClient, stream_id: str, sensors: List[str]):
     start = datetime.now() - timedelta(days=1)
     end = datetime.now()
     query = StreamQuery(stream_id=stream_id, sensors=sensors, start_time=start, end_time=end)
@@ -29,25 +30,6 @@ def run(stream_id: str, sensors: List[str]):
     print(f'Response length => {length}')
 
 
-def objects_in_region(input: json):
-    try:
-        return int(input['meta']['numObjectsInRegion'])
-    except KeyError:
-        return 0
-
-
-def get_object_id(event: json):
-    return event['meta']['object']['uniqueId']
-
-
-def get_event_by_object_id(events, object_id):
-    events_with_object = []
-    for event in events:
-        if (get_object_id(event) == object_id):
-            events_with_object.append(event)
-    return events_with_object
-
-
 # Python code to merge dict using update() method
 def merge(event, media):
     event.update(media)
@@ -57,60 +39,14 @@ def pretty_print(data):
     print(json.dumps(data, indent=2))
 
 
-credentials, project = None, None
-gcp_client = None
-bucket = None
-def download_video(url, filename, use_service_account):
-    global credentials, project, gcp_client, bucket
-    if not bucket:
-        if use_service_account:
-            credentials, project = google.auth.default()
-            gcp_client = storage.Client(project, credentials)
-        else:
-            gcp_client = storage.Client()
-        bucket = gcp_client.get_bucket(url.split("/")[2])
-    
-    print(f"Downloading {url.split('/')[-1]} to {filename}")
-    blob = bucket.get_blob("/".join(url.split("/")[3:]))
-    blob.download_to_filename(filename)
-
 # in my experience, this only works on Windows
 def download_video_shell(url, filename):
     cmd_line = [os.environ["CLOUDSDK_ROOT_DIR"] + '\\bin\\gsutil', 'cp', url, filename]
     print(f"Executing {' '.join(cmd_line)}")
     subprocess.call(cmd_line, shell=True)
 
-def get_closest_result(results, time_of_interest):
-    if not results:
-        return None 
-
-    closest, timeDifference = None, None
-    for result in results:
-        difference = date_parser.parse(result['timeCollected']) - time_of_interest
-        if not timeDifference:
-            timeDifference = difference
-            closest = result
-            continue
-
-        if difference < timeDifference:
-            timeDifference = difference
-            closest = result
-    return closest
-
-if __name__ == '__main__':
+def main(argv=None):
     print('Running find media by sensor example...')
-    load_dotenv()
-    api_key = os.environ.get("API_KEY")
-    api_base = os.environ.get("API_BASE")
-
-    if not api_key:
-        print('Please set the API_KEY environment variable.')
-        print('e.g. `export API_KEY="38ed7729792c48489945c8060255fa45"`')
-        exit(1)
-
-    if not api_base:
-        api_base = 'https://data-api.boulderai.com/'
-
     parser = argparse.ArgumentParser(description='Find media by sensor example.',
                                      formatter_class=argparse.RawDescriptionHelpFormatter,
                                      epilog=textwrap.dedent('''\
@@ -130,48 +66,57 @@ if __name__ == '__main__':
                         help='number of events to show/save to CSV.  Defaults to 10.', default=10)
     parser.add_argument('--download', '-d', dest='download', action='store_true',
                         help='Save media files to tmp/<eventId>.mp4 for each event', default=False)
+    parser.add_argument('--workers', '-w', dest='workers', type=int, default=DEFAULT_DOWNLOAD_WORKERS,
+                        help=f'number of media files to download concurrently.  Defaults to {DEFAULT_DOWNLOAD_WORKERS}.')
+    parser.add_argument('--cache_dir', dest='cache_dir', default=DEFAULT_CACHE_DIR,
+                        help=f'directory of the local media cache shared by all events and runs.  '
+                             f'Defaults to {DEFAULT_CACHE_DIR}.')
+    parser.add_argument('--cache_size_mb', dest='cache_size_mb', type=int, default=DEFAULT_CACHE_SIZE_MB,
+                        help=f'maximum size of the media cache in MB, least recently used media is removed first.  '
+                             f'Defaults to {DEFAULT_CACHE_SIZE_MB}.')
+    parser.add_argument('--media_root', dest='media_root', default=os.environ.get('DATA_API_MEDIA_ROOT'),
+                        help='local directory mirroring the media buckets, read instead of GCP: gs://<bucket>/path is '
+                             'copied from <media_root>/<bucket>/path.  Defaults to $DATA_API_MEDIA_ROOT.')
     parser.add_argument('--use_service_account', '-s', dest='use_service_account', action='store_true',
                         help='Use environment default GCP service account to download media files', default=False)
     parser.add_argument('--min_timeOn', '-m', dest='min_timeOn', type=float, default=1.5, 
                         help='Minimum amount of time (seconds) that an object must be present in presence zone.')
+    add_where_argument(parser)
     parser.add_argument('--csv', default='',
                         help='csv file to write to.  If not specified, will not write to anything')
 
-    if len(sys.argv) == 1:
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) == 0:
         parser.print_help()
         sys.exit(1)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    client = DataApiClient(api_key=api_key, api_base=api_base)
+    client = client_from_env()
     stream_id = args.stream_id
     sensors = args.sensors.split(',')
 
     # We want to look at the last numDays days of data
     numDays = 7
-    start = datetime.utcnow() - timedelta(days=numDays)
-    end = datetime.utcnow()
-
-    events = client.query_stream_flat(
-        StreamQuery(
-            stream_id=stream_id,
-            sensors=sensors,
-            start_time=start,
-            end_time=end
-        )
-    )
-
-    print(f'Found {len(events)} events in the last {numDays} days.')
+    # Walk backward from now in growing windows, only querying as far back as needed to find num_events events
+    events = iter_events_backward(client, stream_id, sensors, max_lookback=timedelta(days=numDays))
 
     if args.csv:
         data_file = open(args.csv, 'w')
         csv_writer = csv.writer(data_file)
         count = 0
 
+    event_filter = where_filter(args.where)
+    downloads = []
     valid_events = 0
+    found = 0
     for event in events:
+        found += 1
         # filter out events of 1 sec or less
         if "timeOn" in event["meta"] and event["meta"]["timeOn"] <= args.min_timeOn:
             continue
+        if event_filter and not event_filter(event):
+            continue
         valid_events += 1
         time_of_interest = date_parser.parse(event['timeCollected'])
         query_start, query_end = get_media_range(time_of_interest, 0, 1)
@@ -183,11 +128,13 @@ if __name__ == '__main__':
             )
         )
 
-        media_event = get_closest_result(results, time_of_interest)
+        media_index = MediaIndex(results)
+        media_event = media_index.nearest(time_of_interest)
 
         if media_event:
             print(f'Found media event for event {event["id"]}.')
             print(f"Event: {event}")
+            print(f"Offset in media: {media_index.offset(media_event, time_of_interest)}")
             print(f"Media Event:")
             pretty_print(media_event)
 
@@ -202,6 +149,7 @@ if __name__ == '__main__':
                     "media_timeCollected": media_event['timeCollected'],
                     "media_durationMs": media_event['durationMs'],
                     "media_url": media_event['url'],
+                    "media_offsetMs": int(media_index.offset(media_event, time_of_interest).total_seconds() * 1000),
                 }
                 if "timeOn" in event["meta"]:
                     merged["event_timeOn"] = event["meta"]["timeOn"]
@@ -218,12 +166,32 @@ if __name__ == '__main__':
                 if not os.path.isdir("tmp"):
                     os.mkdir("tmp")
                 if not os.path.exists(f'tmp/{event["id"]}.mp4'):
-                    if "CLOUDSDK_ROOT_DIR" in os.environ:
-                        download_video_shell(media_event['url'], f'tmp/{event["id"]}.mp4')
-                    else:
-                        download_video(media_event['url'], f'tmp/{event["id"]}.mp4', args.use_service_account)
+                    downloads.append((media_event, f'tmp/{event["id"]}.mp4'))
             if valid_events == args.num_events:
                 break
 
+    # events are only queried as far back as needed, so this counts the events looked at
+    print(f'Found {found} events in the last {numDays} days.')
+
     if args.csv:
         data_file.close()
+
+    if downloads:
+        # Each media object is downloaded into the cache once, then linked to the output of every event that uses it
+        if args.media_root:
+            download = LocalBackend(args.media_root).download_url
+        elif "CLOUDSDK_ROOT_DIR" in os.environ:
+            download = download_video_shell
+        else:
+            download = lambda url, filename: client.download_gcs(url, filename, args.use_service_account)
+        cache = MediaCache(args.cache_dir, args.cache_size_mb * 1024 * 1024)
+        keys = [cache_key(media_event.get('id'), media_event['url']) for media_event, _ in downloads]
+        paths = cache.fetch_many([(key, media_event['url']) for key, (media_event, _) in zip(keys, downloads)],
+                                 download, workers=args.workers)
+        for key, (media_event, filename) in zip(keys, downloads):
+            if key in paths:
+                link_or_copy(paths[key], filename)
+        print(f'Saved media for {len(downloads)} event(s), {cache.hits} from the media cache at {cache.root}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import argparse
+import heapq
+import json
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, List, Tuple
+
+from api_types import LatestSensorEventQuery
+from client import DataApiClient, client_from_env
+from filters import add_where_argument, where_filter
+from utils import to_epoch_ms
+
+MIN_POLL_INTERVAL = 1.0     # seconds
+MAX_POLL_INTERVAL = 60.0    # seconds
+IDLE_BACKOFF = 1.5          # interval multiplier after a poll with no new event
+RATE_SMOOTHING = 0.3        # weight of the newest inter-event gap in the moving average
+SEEN_HISTORY = 1000         # event ids remembered per stream for deduplication
+
+
+def latest_events(response) -> List[dict]:
+    """Normalize a get_latest_stream_event response to a list of events."""
+    if isinstance(response, dict) and 'data' in response:
+        response = response['data']
+    if not response:
+        return []
+    if isinstance(response, dict):
+        return [response]
+    return list(response)
+
+
+class FollowState:
+    """Polling state for a single (stream, sensor) pair."""
+
+    def __init__(self, stream_id: str, sensor_id: str, interval: float):
+        self.stream_id = stream_id
+        self.sensor_id = sensor_id
+        self.interval = interval
+        self.last_event_ms = None
+        self.mean_gap = None
+        self.seen = OrderedDict()
+
+    def is_new(self, event: dict) -> bool:
+        event_id = event['id']
+        if event_id in self.seen:
+            return False
+        self.seen[event_id] = True
+        if len(self.seen) > SEEN_HISTORY:
+            self.seen.popitem(last=False)
+        return True
+
+    def observe(self, new_events: List[dict], min_interval: float, max_interval: float):
+        """Adapt the poll interval to the observed event rate.
+
+        The latest endpoint only returns the most recent event, so a stream is polled at half of its mean
+        inter-event gap to avoid missing events.  Streams that go quiet back off towards ``max_interval``.
+        """
+        if not new_events:
+            self.interval = min(self.interval * IDLE_BACKOFF, max_interval)
+            return
+        for event in new_events:
+            event_ms = to_epoch_ms(event['timeCollected'])
+            if self.last_event_ms is not None and event_ms > self.last_event_ms:
+                gap = (event_ms - self.last_event_ms) / 1000
+                if self.mean_gap is None:
+                    self.mean_gap = gap
+                else:
+                    self.mean_gap = RATE_SMOOTHING * gap + (1 - RATE_SMOOTHING) * self.mean_gap
+            self.last_event_ms = max(event_ms, self.last_event_ms or event_ms)
+        if self.mean_gap is not None:
+            self.interval = min(max(self.mean_gap / 2, min_interval), max_interval)
+        else:
+            self.interval = min_interval
+
+
+class StreamFollower:
+    """Tails many (stream, sensor) pairs with ``get_latest_stream_event``.
+
+    Each pair is polled on its own adaptive interval by a bounded pool of worker threads.  New events (deduplicated
+    by event id) are passed to ``callback`` from the calling thread, in the order the polls complete.
+    """
+
+    def __init__(self,
+                 client: DataApiClient,
+                 pairs: List[Tuple[str, str]],
+                 callback: Callable[[dict], None],
+                 min_interval: float = MIN_POLL_INTERVAL,
+                 max_interval: float = MAX_POLL_INTERVAL,
+                 workers: int = 8):
+        self.client = client
+        self.callback = callback
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.workers = workers
+        self.states = [FollowState(stream_id, sensor_id, min_interval) for stream_id, sensor_id in pairs]
+        self.polls = 0
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    def _poll(self, state: FollowState) -> List[dict]:
+        return latest_events(self.client.get_latest_stream_event(
+            LatestSensorEventQuery(stream_id=state.stream_id, sensor_id=state.sensor_id)))
+
+    def run(self, duration: float = None):
+        """Follow until ``stop`` is called or ``duration`` seconds have elapsed."""
+        deadline = time.monotonic() + duration if duration else None
+        schedule = [(0.0, i) for i in range(len(self.states))]
+        heapq.heapify(schedule)
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self._stopped and (deadline is None or time.monotonic() < deadline):
+                now = time.monotonic()
+                while schedule and schedule[0][0] <= now and len(pending) < self.workers:
+                    _, i = heapq.heappop(schedule)
+                    pending[executor.submit(self._poll, self.states[i])] = i
+
+                timeout = schedule[0][0] - now if schedule and len(pending) < self.workers else self.max_interval
+                if deadline is not None:
+                    timeout = min(timeout, deadline - now)
+                timeout = max(timeout, 0)
+                if not pending:
+                    time.sleep(timeout or 0)
+                    continue
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = pending.pop(future)
+                    state = self.states[i]
+                    self.polls += 1
+                    try:
+                        new_events = [event for event in future.result() if state.is_new(event)]
+                    except Exception as e:
+                        print(f'Failed polling {state.stream_id}/{state.sensor_id}: {e}', file=sys.stderr)
+                        new_events = []
+                    state.observe(new_events, self.min_interval, self.max_interval)
+                    for event in new_events:
+                        self.callback(event)
+                    heapq.heappush(schedule, (time.monotonic() + state.interval, i))
+
+
+class JsonLinesSink:
+    """Callback which appends each event as a line of JSON to a file."""
+
+    def __init__(self, path: str):
+        self.file = open(path, 'a')
+
+    def __call__(self, event: dict):
+        self.file.write(json.dumps(event) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Follow the latest events of one or more stream sensors.')
+    parser.add_argument('--stream_id', dest='stream_id', help='stream_id to follow')
+    parser.add_argument('--sensors', dest='sensors', help='comma separated sensors of --stream_id to follow')
+    parser.add_argument('--pair', dest='pairs', nargs=2, action='append', default=[],
+                        metavar=('STREAM_ID', 'SENSOR_ID'),
+                        help='a (stream, sensor) pair to follow.  May be given multiple times.')
+    parser.add_argument('--output', '-o', dest='output',
+                        help='JSON lines file to append new events to.  Events are printed if not specified.')
+    parser.add_argument('--duration', type=float, help='number of seconds to follow for.  Runs until interrupted '
+                                                       'if not specified.')
+    parser.add_argument('--min_interval', type=float, default=MIN_POLL_INTERVAL,
+                        help='minimum seconds between polls of a single stream')
+    parser.add_argument('--max_interval', type=float, default=MAX_POLL_INTERVAL,
+                        help='maximum seconds between polls of a single stream')
+    parser.add_argument('--workers', type=int, default=8, help='maximum number of concurrent requests')
+    add_where_argument(parser)
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) == 0:
+        parser.print_help()
+        sys.exit(1)
+    args = parser.parse_args(argv)
+
+    pairs = [tuple(pair) for pair in args.pairs]
+    if args.stream_id and args.sensors:
+        pairs += [(args.stream_id, sensor) for sensor in args.sensors.split(',')]
+    if not pairs:
+        parser.error('specify --stream_id and --sensors, or at least one --pair')
+
+    client = client_from_env()
+    sink = JsonLinesSink(args.output) if args.output else print
+    event_filter = where_filter(args.where)
+    callback = (lambda event: event_filter(event) and sink(event)) if event_filter else sink
+    follower = StreamFollower(client, pairs, callback, min_interval=args.min_interval,
+                              max_interval=args.max_interval, workers=args.workers)
+    print(f'Following {len(pairs)} stream sensor(s)...')
+    try:
+        follower.run(duration=args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.output:
+            sink.close()
+    print(f'Issued {follower.polls} latest event requests.')
+
+
+if __name__ == '__main__':
+    main()
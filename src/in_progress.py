@@ -1,47 +1,57 @@
 import json
-import os
 from datetime import datetime, timedelta
 from typing import List
 
-from dotenv import load_dotenv
-
 from api_types import StreamQuery, InProgressEvents
-from client import DataApiClient
+from client import DataApiClient, client_from_env
+from filters import add_where_argument, where_filter
+from planner import QueryPlanner
 import argparse
 
 
-def run(stream_id: str, sensors: List[str], in_progress_events: InProgressEvents):
-    start = datetime.now() - timedelta(days=7)
-    end = datetime.now()
-    query = StreamQuery(stream_id=stream_id, sensors=sensors, start_time=start, end_time=end,
-                        in_progress_events=in_progress_events)
-    response = client.query_stream_flat(query)
-
+def show(response):
     print(json.dumps(response[:3], indent=2))
     length = len(response)
     print(f'Response length => {length}')
 
 
-if __name__ == '__main__':
+def run(client: DataApiClient, stream_id: str, sensors: List[str], modes: List[InProgressEvents], event_filter=None):
+    """Query the last 7 days with each in progress mode.  The planner answers them with as few requests as it can,
+    usually a single INCLUDE request."""
+    start = datetime.now() - timedelta(days=7)
+    end = datetime.now()
+    planner = QueryPlanner(client)
+    responses = [planner.submit('query_stream_flat',
+                                StreamQuery(stream_id=stream_id, sensors=sensors, start_time=start, end_time=end,
+                                            in_progress_events=mode))
+                 for mode in modes]
+    planner.execute()
+    for mode, response in zip(modes, responses):
+        print(f'{mode.name}:')
+        events = response.result()
+        show(event_filter.apply(events) if event_filter else events)
+    print(f'{planner.stats["queries"]} queries answered with {planner.stats["requests"]} request(s)')
+
+
+def main(argv=None):
     print('Running in progress example...')
-    load_dotenv()
-    api_key = os.environ.get("API_KEY")
-    api_base = os.environ.get("API_BASE")
-
     parser = argparse.ArgumentParser(description='In progress example.')
     parser.add_argument('--stream_id', dest='stream_id',
                         help='stream_id to demonstrate', required=True)
 
     parser.add_argument('--sensors', dest='sensors', nargs='+',
                         help='sensors to query', required=True)
+    add_where_argument(parser)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    client = DataApiClient(api_key=api_key, api_base=api_base)
+    client = client_from_env()
     stream_id = args.stream_id
     sensors = args.sensors
-    run(stream_id=stream_id, sensors=sensors, in_progress_events=InProgressEvents.ONLY)
+    run(client, stream_id=stream_id, sensors=sensors,
+        modes=[InProgressEvents.ONLY, InProgressEvents.NONE, InProgressEvents.INCLUDE],
+        event_filter=where_filter(args.where))
 
-    run(stream_id=stream_id, sensors=sensors, in_progress_events=InProgressEvents.NONE)
 
-    run(stream_id=stream_id, sensors=sensors, in_progress_events=InProgressEvents.INCLUDE)
+if __name__ == '__main__':
+    main()
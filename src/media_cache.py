@@ -0,0 +1,126 @@
+import hashlib
+import os
+import shutil
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from profiling import profiler
+from storage import download_many, DEFAULT_DOWNLOAD_WORKERS
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'data-api-utils', 'media')
+DEFAULT_CACHE_SIZE_MB = 10 * 1024
+
+
+def cache_key(media_id: str = None, url: str = None) -> str:
+    """Cache key of a media object: a hash of its media ID, or of its URL if it has no ID."""
+    return hashlib.sha256((media_id or url).encode('utf-8')).hexdigest()
+
+
+def link_or_copy(source: str, destination: str):
+    """Make destination refer to source, as a hardlink if possible, else a symlink, else a copy."""
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(source), destination)
+        except OSError:
+            shutil.copyfile(source, destination)
+
+
+class MediaCache:
+    """Local cache of downloaded media, keyed by media ID (or URL), shared across events and runs.
+
+    Files are stored as ``<root>/<key[:2]>/<key><ext>`` and their modification time is bumped on every use, so when
+    the cache grows past ``max_bytes`` the least recently used files are evicted first.
+    """
+
+    def __init__(self, root: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_SIZE_MB * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key: str, ext: str = '.mp4') -> str:
+        return os.path.join(self.root, key[:2], key + ext)
+
+    def get(self, key: str, ext: str = '.mp4'):
+        """Path of a cached object (marking it as recently used), or None."""
+        path = self.path(key, ext)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def put(self, key: str, download: Callable[[str], None], ext: str = '.mp4') -> str:
+        """Store an object by calling ``download(filename)``; the object only appears once it is complete."""
+        path = self.path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f'{path}.{threading.get_ident()}.part'
+        try:
+            download(partial)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        return path
+
+    def fetch_many(self,
+                   media: List[Tuple[str, str]],
+                   download: Callable[[str, str], None],
+                   workers: int = DEFAULT_DOWNLOAD_WORKERS,
+                   ext: str = '.mp4') -> Dict[str, str]:
+        """Make sure every ``(key, url)`` is cached, downloading each missing object once.
+
+        Returns a map of key to cached path for the objects which are available.
+        """
+        paths = {}
+        missing = {}
+        for key, url in media:
+            if key in paths or key in missing:
+                continue
+            path = self.get(key, ext)
+            if path:
+                paths[key] = path
+            else:
+                missing[key] = url
+        with self._lock:
+            self.hits += len(paths)
+            self.misses += len(missing)
+        profiler.count('media_cache.hits', len(paths))
+        profiler.count('media_cache.misses', len(missing))
+        if missing:
+            print(f'{len(paths)} media file(s) already cached, downloading {len(missing)}')
+            key_by_path = {self.path(key, ext): key for key in missing}
+            results = download_many(
+                [(url, self.path(key, ext)) for key, url in missing.items()],
+                lambda url, path: self.put(key_by_path[path], lambda partial: download(url, partial), ext),
+                workers=workers)
+            for url, path, error in results:
+                if error is None:
+                    paths[key_by_path[path]] = path
+        self.evict(keep=set(paths.values()))
+        return paths
+
+    def evict(self, keep=()):
+        """Remove least recently used files until the cache fits in max_bytes.  Paths in ``keep`` are never removed."""
+        files = []
+        total = 0
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith('.part'):
+                    continue
+                path = os.path.join(directory, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            os.remove(path)
+            total -= size
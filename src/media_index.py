@@ -0,0 +1,82 @@
+import bisect
+from datetime import timedelta
+from typing import List, Optional
+
+from utils import to_epoch_ms
+
+
+def media_bounds(media_event):
+    """Return the (start, end) of a media event in epoch milliseconds.
+
+    ``timeCollected`` of a media event is the end of the recording and ``durationMs`` its length.  Typed
+    ``MediaEvent`` structs are accepted too.
+    """
+    if not isinstance(media_event, dict):
+        return media_event.start_ms, media_event.end_ms
+    end = to_epoch_ms(media_event['timeCollected'])
+    return end - int(media_event['durationMs']), end
+
+
+class MediaIndex:
+    """Interval index over ``query_media_data`` results.
+
+    Answers which media segments contain a timestamp, and which segment is nearest to it, with a binary search on
+    segment starts.  ``containing`` then walks back over the segments which start earlier while the latest end among
+    them reaches the timestamp: O(log n) plus the segments returned for recordings which don't overlap much, but up to
+    O(n) when one long early segment overlaps many later ones.  Timestamps may be ISO strings, datetimes or epoch
+    milliseconds.
+    """
+
+    def __init__(self, media_events: List[dict]):
+        entries = sorted(((*media_bounds(event), event) for event in media_events), key=lambda e: e[0])
+        self.starts = [entry[0] for entry in entries]
+        self.ends = [entry[1] for entry in entries]
+        self.events = [entry[2] for entry in entries]
+        # index of the segment with the latest end among segments 0..i, so overlapping segments can be handled
+        self._latest_end = []
+        for i, end in enumerate(self.ends):
+            if i == 0 or end > self.ends[self._latest_end[-1]]:
+                self._latest_end.append(i)
+            else:
+                self._latest_end.append(self._latest_end[-1])
+
+    def __len__(self):
+        return len(self.events)
+
+    def containing(self, time) -> List[dict]:
+        """All media segments with start < time < end (the original check of the scripts), latest start first."""
+        time = to_epoch_ms(time)
+        found = []
+        i = bisect.bisect_left(self.starts, time) - 1
+        while i >= 0 and self.ends[self._latest_end[i]] > time:
+            if self.ends[i] > time:
+                found.append(self.events[i])
+            i -= 1
+        return found
+
+    def find(self, time) -> Optional[dict]:
+        """The media segment containing time, or None."""
+        found = self.containing(time)
+        return found[0] if found else None
+
+    def nearest(self, time) -> Optional[dict]:
+        """The media segment containing time, or else the segment whose start or end is closest to it."""
+        if not self.events:
+            return None
+        contained = self.find(time)
+        if contained:
+            return contained
+        time = to_epoch_ms(time)
+        i = bisect.bisect_right(self.starts, time) - 1
+        candidates = []
+        if i >= 0:
+            before = self._latest_end[i]
+            candidates.append((time - self.ends[before], before))
+        if i + 1 < len(self.starts):
+            candidates.append((self.starts[i + 1] - time, i + 1))
+        return self.events[min(candidates)[1]]
+
+    @staticmethod
+    def offset(media_event: dict, time) -> timedelta:
+        """Offset of time from the start of the media segment."""
+        return timedelta(milliseconds=to_epoch_ms(time) - media_bounds(media_event)[0])
@@ -1,19 +1,22 @@
 import json
-import os
 from datetime import datetime, timedelta
 from typing import List
 from dateutil import parser as date_parser
 
-from dotenv import load_dotenv
-
 from api_types import StreamQuery, InProgressEvents, MediaQuery
-from client import DataApiClient
+from client import DataApiClient, client_from_env
+from event_store import EventStore, StoreBackedClient
+from external_sort import ExternalSorter, DEFAULT_MEMORY_MB
+from filters import add_where_argument, where_filter
 import argparse
 
-from utils import get_media_range
+from media_index import MediaIndex
+from ranking import TopK, threshold
+from tracks import TrackBuilder, objects_in_region, get_object_id
+from utils import get_media_range, to_epoch_ms
 
 
-def run(stream_id: str, sensors: List[str]):
+def run(client: DataApiClient, stream_id: str, sensors: List[str]):
     start = datetime(2021, 11, 27)
     end = datetime.now()
     query = StreamQuery(stream_id=stream_id, sensors=sensors, start_time=start, end_time=end)
@@ -24,71 +27,92 @@ def run(stream_id: str, sensors: List[str]):
     print(f'Response length => {length}')
 
 
-def objects_in_region(input: json):
-    try:
-        return int(input['meta']['numObjectsInRegion'])
-    except KeyError:
-        return 0
-
-
-def get_object_id(event: json):
-    return event['meta']['object']['uniqueId']
-
-
-def get_event_by_object_id(events, object_id):
-    events_with_object = []
-    for event in events:
-        if (get_object_id(event) == object_id):
-            events_with_object.append(event)
-    return events_with_object
-
-
-if __name__ == '__main__':
+def replay_timeline(timeline: ExternalSorter, tracks: TrackBuilder, object_ids: set, filename: str = None):
+    """One pass over the events of every sensor in time order: the events of the objects in object_ids are added to
+    tracks, and every event is written to filename if given."""
+    import contextlib
+    import msgspec
+    encoder = msgspec.json.Encoder()
+    with open(filename, 'wb') if filename else contextlib.nullcontext() as f:
+        for event in timeline:
+            if f:
+                f.write(encoder.encode(event))
+                f.write(b'\n')
+            try:
+                if get_object_id(event) in object_ids:
+                    tracks.add(event)
+            except (KeyError, TypeError):
+                pass
+    if filename:
+        print(f'Wrote {timeline.count} events in time order to {filename} '
+              f'({timeline.spills} sorted runs spilled to disk)')
+
+
+def main(argv=None):
     print('Running in object correlation example...')
-    load_dotenv()
-    api_key = os.environ.get("API_KEY")
-    api_base = os.environ.get("API_BASE")
-
-    if not api_key:
-        print('Please set the API_KEY environment variable.')
-        print('e.g. `export API_KEY="38ed7729792c48489945c8060255fa45"`')
-        exit(1)
-
-    if not api_base:
-        api_base = 'https://data-api.boulderai.com/'
-
-    parser = argparse.ArgumentParser(description='In progress example.')
+    parser = argparse.ArgumentParser(description='Object correlation example.')
     parser.add_argument('--stream_id', dest='stream_id',
                         help='stream_id to demonstrate', required=True)
 
     parser.add_argument('--sensors', dest='sensors', help='sensors to query', required=True)
-
-    args = parser.parse_args()
-
-    client = DataApiClient(api_key=api_key, api_base=api_base)
+    parser.add_argument('--top', dest='top', type=int, default=5,
+                        help='number of events with the most objects in region to correlate.  Defaults to 5.')
+    parser.add_argument('--min_objects', dest='min_objects', type=int,
+                        help='only consider events with at least this many objects in region')
+    parser.add_argument('--store', dest='store',
+                        help='directory of a local event store.  Queried events are saved to it for re-querying.')
+    parser.add_argument('--offline', dest='offline', action='store_true',
+                        help='answer stream queries from --store without calling the Data API')
+    add_where_argument(parser)
+    parser.add_argument('--timeline', dest='timeline',
+                        help='JSON lines file to write the events of all sensors to, in time order')
+    parser.add_argument('--memory_mb', dest='memory_mb', type=float, default=DEFAULT_MEMORY_MB,
+                        help='memory to sort the events of all sensors in before spilling sorted runs to disk.  '
+                             f'Defaults to {DEFAULT_MEMORY_MB}.')
+
+    args = parser.parse_args(argv)
+    if args.offline and not args.store:
+        parser.error('--offline requires --store')
+
+    client = client_from_env()
+    if args.store:
+        client = StoreBackedClient(client, EventStore(args.store), offline=args.offline)
     stream_id = args.stream_id
     sensors = args.sensors.split(',')
 
     # We want to look at the last 24 hours of data
     start = datetime.now() - timedelta(hours=24)
     end = datetime.now()
-    all_events = []
+    event_filter = where_filter(args.where)
+    busiest = TopK(args.top, key=objects_in_region)
+    # the merged timeline of every sensor can be much larger than memory, so it is sorted externally, and only one
+    # sensor's response is held at a time
+    timeline = ExternalSorter(key=lambda event: to_epoch_ms(event['timeCollected']), memory_mb=args.memory_mb)
     # For each of the sensors in the provided input
     for sensor in sensors:
         # Query the last 24 hours
         json = client.query_stream_flat(
             StreamQuery(stream_id=stream_id, sensors=[sensor], start_time=start, end_time=end,
                         in_progress_events=InProgressEvents.ONLY))
+        if event_filter:
+            json = event_filter.apply(json)
         print(f'Length => {len(json)}')
-        for stream_data in json:
-            # We append each event to the overall list of events
-            all_events.append(stream_data)
-
-    # Sort the events by the number of objects in region
-    sort_events = sorted(all_events, key=objects_in_region, reverse=True)
-
-    print('Top 5 events by number of objects')
-    for event in sort_events[:5]:
+        # Rank each event by the number of objects in region as the sensor's events arrive
+        busiest.add_all(threshold(json, objects_in_region, minimum=args.min_objects))
+        timeline.add_all(json)
+    # only the tracks of the busiest events' objects are printed, so only those are built, from the merged timeline
+    object_ids = set()
+    for event in busiest.results():
+        try:
+            object_ids.add(get_object_id(event))
+        except (KeyError, TypeError):
+            pass
+    tracks = TrackBuilder()
+    replay_timeline(timeline, tracks, object_ids, args.timeline)
+    print(f'Built tracks for {len(tracks.tracks)} objects.')
+
+    print(f'Top {args.top} events by number of objects')
+    for event in busiest.results():
         time_of_interest = date_parser.parse(event['timeCollected'])
         # Construct a query that looks 15 minutes back and 5 minutes forward
         query_start, query_end = get_media_range(time_of_interest, 15, 5)
@@ -96,21 +120,23 @@ if __name__ == '__main__':
                                  start_time=query_start,
                                  end_time=query_end)
 
-        media_response = client.query_media_data(media_query)
-        for video_event in media_response:
-            video_end = date_parser.parse(video_event['timeCollected'])
-            video_start = video_end - timedelta(milliseconds=video_event['durationMs'])
-            # Check to see if the time of interest is in the video
-            if video_start < time_of_interest < video_end:
-                print(f'VIDEO FOUND @ {video_event["url"]}')
-                print(f'EVENT => {event}')
-                print(f'OFFSET => {time_of_interest - video_start}')
-                object_id = get_object_id(event)
-                print(f'OBJECT_ID => {object_id}')
-                events_with_object = sorted(get_event_by_object_id(all_events, object_id),
-                                            key=lambda e: e['timeCollected'])
-                print(f'Object Id\tTime Collected\tSensor Id\tObjects in Region\tVideo Offset')
-                for ewo in events_with_object:
-                    print(
-                        f'{object_id}\t{ewo["timeCollected"]}\t{ewo["sensorId"]}\t{objects_in_region(ewo)}\t{date_parser.parse(ewo["timeCollected"]) - video_start}'
-                    )
+        media_index = MediaIndex(client.query_media_data(media_query))
+        # Check to see if the time of interest is in any of the videos
+        for video_event in media_index.containing(time_of_interest):
+            print(f'VIDEO FOUND @ {video_event["url"]}')
+            print(f'EVENT => {event}')
+            print(f'OFFSET => {media_index.offset(video_event, time_of_interest)}')
+            object_id = get_object_id(event)
+            print(f'OBJECT_ID => {object_id}')
+            track = tracks.get(object_id)
+            print(f'TRACK => {track.summary()}')
+            events_with_object = track.events
+            print(f'Object Id\tTime Collected\tSensor Id\tObjects in Region\tVideo Offset')
+            for ewo in events_with_object:
+                print(
+                    f'{object_id}\t{ewo["timeCollected"]}\t{ewo["sensorId"]}\t{objects_in_region(ewo)}\t{media_index.offset(video_event, ewo["timeCollected"])}'
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import json
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from api_types import InProgressEvents, SensorQuery, StreamQuery
+
+# in progress modes which can be answered by filtering an INCLUDE result
+DERIVABLE = (InProgressEvents.ONLY, InProgressEvents.NONE)
+
+
+def in_progress(event: dict) -> Optional[bool]:
+    """Whether an event is in progress, or None if the event doesn't say (e.g. it was fetched without meta)."""
+    if 'inProgress' in event:
+        return bool(event['inProgress'])
+    meta = event.get('meta')
+    if isinstance(meta, dict) and 'inProgress' in meta:
+        return bool(meta['inProgress'])
+    return None
+
+
+def matches_sensor(event: dict, sensor: str) -> bool:
+    """Whether an event belongs to a requested sensor, which may be a name, a <stream>__<name> ID or a comma list."""
+    event_ids = {event.get('sensorId'), event.get('sensorName')}
+    for name in sensor.split(','):
+        if name in event_ids or any(isinstance(i, str) and i.endswith('__' + name) for i in event_ids):
+            return True
+    return False
+
+
+def split_by_sensor(events: List[dict], sensor_lists: List[tuple]) -> Optional[Dict[tuple, List[dict]]]:
+    """Events of a multi-sensor response for each requested sensor list, in response order, or None if some event
+    can't be attributed to a requested sensor."""
+    split = {sensor_list: [] for sensor_list in sensor_lists}
+    for event in events:
+        owners = [sensor_list for sensor_list in sensor_lists
+                  if any(matches_sensor(event, sensor) for sensor in sensor_list)]
+        if not owners:
+            return None
+        for sensor_list in owners:
+            split[sensor_list].append(event)
+    return split
+
+
+class _Pending:
+    def __init__(self, operation: str, query):
+        self.operation = operation
+        self.query = query
+        self.future = Future()
+
+
+class QueryPlanner:
+    """Sits in front of a DataApiClient and answers queries with as few requests as possible.
+
+    Queries are ``submit``-ted and answered together by ``execute``:
+
+    - stream (or sensor) queries over the same stream and window are merged into one multi-sensor request, and the
+      response is split by sensor;
+    - ``InProgressEvents.ONLY`` and ``NONE`` queries are derived from the ``INCLUDE`` query of the same window, when
+      the events say whether they are in progress (otherwise they are requested separately);
+    - identical requests, including ones issued concurrently by other threads through the planner, are sent once.
+
+    Queries with a limit aren't merged, since a limit applies to the merged request as a whole.  Other client
+    methods are passed through.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.stats = {'queries': 0, 'requests': 0}
+        self._pending = []
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def submit(self, operation: str, query) -> Future:
+        """Queue a ``query_stream_flat`` or ``query_sensor_flat`` query, answered when ``execute`` runs."""
+        pending = _Pending(operation, query)
+        with self._lock:
+            self._pending.append(pending)
+            self.stats['queries'] += 1
+        return pending.future
+
+    def query_stream_flat(self, query: StreamQuery):
+        future = self.submit('query_stream_flat', query)
+        self.execute()
+        return future.result()
+
+    def query_sensor_flat(self, query: SensorQuery):
+        future = self.submit('query_sensor_flat', query)
+        self.execute()
+        return future.result()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def execute(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        groups = {}
+        for item in pending:
+            groups.setdefault(self._group_key(item), []).append(item)
+        for key, items in groups.items():
+            try:
+                if key[0] is None:
+                    for item in items:
+                        item.future.set_result(self._request(item.operation, item.query))
+                else:
+                    self._execute_group(items)
+            except Exception as e:
+                for item in items:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+
+    @staticmethod
+    def _group_key(item: _Pending):
+        # JsonObject.toJSON deletes None attributes, so optional ones are read with getattr
+        query = item.query
+        if item.operation == 'query_sensor_flat':
+            return (item.operation, query.device_id, str(query.start_time), str(query.end_time),
+                    getattr(query, 'with_meta', None))
+        if item.operation == 'query_stream_flat' and getattr(query, 'limit', None) is None:
+            return (item.operation, query.stream_id, getattr(query, 'device_id', None), str(query.start_time),
+                    str(query.end_time), getattr(query, 'order', None), getattr(query, 'with_meta', None))
+        return None, id(item)
+
+    def _execute_group(self, items: List[_Pending]):
+        by_mode = {}
+        for item in items:
+            by_mode.setdefault(getattr(item.query, 'in_progress_events', None), []).append(item)
+        if InProgressEvents.INCLUDE in by_mode and any(mode in by_mode for mode in DERIVABLE):
+            included = self._fetch_merged(by_mode[InProgressEvents.INCLUDE] +
+                                          [item for mode in DERIVABLE for item in by_mode.get(mode, [])],
+                                          InProgressEvents.INCLUDE)
+            flags = [in_progress(event) for events in included.values() for event in events]
+            if None not in flags:
+                for mode, mode_items in by_mode.items():
+                    for item in mode_items:
+                        events = included[tuple(item.query.sensors)]
+                        if mode == InProgressEvents.ONLY:
+                            events = [event for event in events if in_progress(event)]
+                        elif mode == InProgressEvents.NONE:
+                            events = [event for event in events if not in_progress(event)]
+                        item.future.set_result(list(events))
+                return
+            for item in by_mode.pop(InProgressEvents.INCLUDE):
+                item.future.set_result(list(included[tuple(item.query.sensors)]))
+        for mode, mode_items in by_mode.items():
+            results = self._fetch_merged(mode_items, mode)
+            for item in mode_items:
+                item.future.set_result(list(results[tuple(item.query.sensors)]))
+
+    def _fetch_merged(self, items: List[_Pending], mode) -> Dict[tuple, List[dict]]:
+        """One request for the union of the items' sensors; the events of each item's sensors keyed by its sensors."""
+        sensor_lists = {tuple(item.query.sensors) for item in items}
+        sensors = sorted({sensor for sensor_list in sensor_lists for sensor in sensor_list})
+        first = items[0]
+        if len(sensor_lists) > 1:
+            query = self._with(first.query, sensors=sensors, in_progress_events=mode)
+            split = split_by_sensor(self._request(first.operation, query), list(sensor_lists))
+            if split is not None:
+                return split
+        # a single sensor list, or a response which can't be split: one request per sensor list
+        return {sensor_list: self._request(first.operation,
+                                           self._with(first.query, sensors=list(sensor_list), in_progress_events=mode))
+                for sensor_list in sensor_lists}
+
+    @staticmethod
+    def _with(query, **changes):
+        if isinstance(query, SensorQuery):
+            return SensorQuery(device_id=query.device_id, sensors=changes['sensors'],
+                               start_time=query.start_time, end_time=query.end_time,
+                               with_meta=getattr(query, 'with_meta', None))
+        return StreamQuery(stream_id=query.stream_id, device_id=getattr(query, 'device_id', None),
+                           sensors=changes['sensors'], start_time=query.start_time, end_time=query.end_time,
+                           limit=getattr(query, 'limit', None), order=getattr(query, 'order', None),
+                           with_meta=getattr(query, 'with_meta', None), in_progress_events=changes['in_progress_events'])
+
+    def _request(self, operation: str, query):
+        """Send a request, or wait for the identical one already in flight."""
+        key = (operation, json.dumps({k: v for k, v in query.to_dict().items() if v is not None},
+                                     sort_keys=True, default=str))
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+                self.stats['requests'] += 1
+        if not owner:
+            return future.result()
+        try:
+            future.set_result(getattr(self.client, operation)(query))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+        return future.result()
@@ -0,0 +1,190 @@
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import List, Tuple
+
+# arguments data-api.py takes out of any subcommand's arguments: option => takes a value
+PROFILE_OPTIONS = {'--profile': True, '--profile_cpu': False, '--profile_memory': False}
+
+
+class Profiler:
+    """Records timed spans (per stage, per event) and counters, for a Chrome trace and a summary table.
+
+    Disabled by default, in which case ``span`` returns a shared no-op context manager so instrumented code costs
+    next to nothing.  Spans nest per thread; ``add`` adds values such as ``bytes`` to the innermost open span.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started = time.perf_counter()
+        self.spans = []
+        self.counters = defaultdict(float)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        self.started = time.perf_counter()
+        self.spans = []
+        self.counters.clear()
+
+    def disable(self):
+        self.enabled = False
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def _span(self, name: str, category: str, args: dict):
+        stack = self._stack()
+        stack.append(args)
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                self.spans.append((name, category, start - self.started, duration, threading.get_ident(), args))
+
+    def span(self, name: str, category: str = 'stage', **args):
+        if not self.enabled:
+            return _NO_SPAN
+        return self._span(name, category, args)
+
+    def add(self, **values):
+        if not self.enabled:
+            return
+        stack = self._stack()
+        if stack:
+            for key, value in values.items():
+                stack[-1][key] = stack[-1].get(key, 0) + value
+
+    def count(self, name: str, value: float = 1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += value
+
+    def traced(self, name: str = None, category: str = 'stage'):
+        """Decorator recording a span for every call of a function."""
+        def decorator(function):
+            span_name = name or function.__name__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self._span(span_name, category, {}):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self) -> List[dict]:
+        """Per span name: count, total and maximum seconds and bytes, slowest total first."""
+        rows = {}
+        for name, _, _, duration, _, args in self.spans:
+            row = rows.setdefault(name, {'name': name, 'count': 0, 'seconds': 0.0, 'max': 0.0, 'bytes': 0})
+            row['count'] += 1
+            row['seconds'] += duration
+            row['max'] = max(row['max'], duration)
+            row['bytes'] += args.get('bytes', 0)
+        return sorted(rows.values(), key=lambda row: row['seconds'], reverse=True)
+
+    def print_summary(self, file=sys.stderr):
+        wall = time.perf_counter() - self.started
+        print(f'\n{"stage":<28}{"count":>8}{"total s":>10}{"mean ms":>10}{"max ms":>10}{"% wall":>8}{"MB":>10}',
+              file=file)
+        for row in self.summary():
+            print(f'{row["name"]:<28}{row["count"]:>8}{row["seconds"]:>10.2f}'
+                  f'{row["seconds"] * 1000 / row["count"]:>10.1f}{row["max"] * 1000:>10.1f}'
+                  f'{row["seconds"] * 100 / wall:>8.1f}{row["bytes"] / 1e6:>10.2f}', file=file)
+        for name, value in sorted(self.counters.items()):
+            print(f'{name:<28}{value:>8g}', file=file)
+        print(f'{"wall":<28}{"":>8}{wall:>10.2f}', file=file)
+
+    def write_chrome_trace(self, filename: str):
+        """Write the spans in the Chrome trace event format, which chrome://tracing and Perfetto open."""
+        pid = os.getpid()
+        events = [{'name': name, 'cat': category, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+                   'pid': pid, 'tid': tid, 'args': args}
+                  for name, category, start, duration, tid, args in self.spans]
+        end = (time.perf_counter() - self.started) * 1e6
+        events += [{'name': name, 'ph': 'C', 'ts': end, 'pid': pid, 'args': {'value': value}}
+                   for name, value in self.counters.items()]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+
+_NO_SPAN = contextlib.nullcontext({})
+
+profiler = Profiler()
+span = profiler.span
+add = profiler.add
+count = profiler.count
+traced = profiler.traced
+
+
+def extract_arguments(argv: List[str]) -> Tuple[dict, List[str]]:
+    """Take the profiling options out of a command line.  Returns ({option: value}, remaining arguments)."""
+    options = {}
+    remaining = []
+    arguments = iter(argv)
+    for argument in arguments:
+        option, equals, value = argument.partition('=')
+        if option not in PROFILE_OPTIONS:
+            remaining.append(argument)
+        elif not PROFILE_OPTIONS[option]:
+            options[option] = True
+        else:
+            options[option] = value if equals else next(arguments, None)
+            if not options[option]:
+                raise SystemExit(f'{option} requires a file name')
+    return options, remaining
+
+
+@contextlib.contextmanager
+def profiled(trace: str = None, cpu: bool = False, memory: bool = False):
+    """Record spans while the block runs, then write the Chrome trace (if a file name is given) and print the summary.
+
+    cpu also runs cProfile and prints the functions with the most cumulative time (saving the stats next to the trace
+    as <trace>.pstats); memory traces allocations with tracemalloc and prints the lines which allocated the most.
+    """
+    profiler.enable()
+    cpu_profile = None
+    if cpu:
+        import cProfile
+        cpu_profile = cProfile.Profile()
+        cpu_profile.enable()
+    if memory:
+        import tracemalloc
+        tracemalloc.start()
+    try:
+        yield profiler
+    finally:
+        if cpu_profile:
+            cpu_profile.disable()
+        profiler.disable()
+        if trace:
+            profiler.write_chrome_trace(trace)
+            print(f'\nWrote a trace of {len(profiler.spans)} spans to {trace} (open it in https://ui.perfetto.dev)',
+                  file=sys.stderr)
+        profiler.print_summary()
+        if cpu_profile:
+            import pstats
+            if trace:
+                cpu_profile.dump_stats(trace + '.pstats')
+            print('\nCPU hot spots:', file=sys.stderr)
+            pstats.Stats(cpu_profile, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            print('\nAllocation hot spots:', file=sys.stderr)
+            for statistic in snapshot.statistics('lineno')[:15]:
+                print(f'  {statistic}', file=sys.stderr)
@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+from typing import Iterator, List
+
+from dateutil import tz
+
+from api_types import StreamQuery
+from client import DataApiClient
+from utils import to_epoch_ms, from_epoch_ms
+
+INITIAL_WINDOW = timedelta(hours=1)     # size of the first window queried back from the end time
+GROWTH_FACTOR = 4                       # each following window is this many times larger than the last
+PAGE_LIMIT = 100                        # events requested per page
+
+
+def iter_events_backward(client: DataApiClient,
+                         stream_id: str,
+                         sensors: List[str],
+                         end: datetime = None,
+                         max_lookback: timedelta = timedelta(days=7),
+                         initial_window: timedelta = INITIAL_WINDOW,
+                         growth: float = GROWTH_FACTOR,
+                         page_limit: int = PAGE_LIMIT,
+                         **query_args) -> Iterator[dict]:
+    """Yield stream events newest first, walking backward from ``end`` (default now) in growing windows.
+
+    Each window is fetched in pages of ``page_limit`` events with ``order='desc'``.  Requests are only issued as
+    events are consumed, so a caller that stops iterating once it has what it needs stops querying the Data API.
+    Extra keyword arguments are passed to ``StreamQuery``.
+
+    Query windows are taken as ``[start, end)``.  A page ends just after the millisecond of the oldest event of the
+    previous page, so events of that millisecond which didn't fit are returned again (once) with the next page.  If a
+    page has nothing new (more than ``page_limit`` events in one millisecond), that millisecond is fetched on its own
+    without a limit and paging continues strictly below it.
+    """
+    if end is None:
+        end = datetime.utcnow()
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=tz.UTC)
+    earliest = end - max_lookback
+    window = initial_window
+    window_end = end
+    seen = set()
+
+    def query(start, stop, limit=None):
+        page = client.query_stream_flat(StreamQuery(stream_id=stream_id, sensors=sensors, start_time=start,
+                                                    end_time=stop, limit=limit, order='desc', **query_args))
+        return sorted(page, key=lambda e: to_epoch_ms(e['timeCollected']), reverse=True)
+
+    while window_end > earliest:
+        window_start = max(window_end - window, earliest)
+        page_end = window_end
+        while True:
+            page = query(window_start, page_end, page_limit)
+            new_events = [event for event in page if event['id'] not in seen]
+            if len(page) == page_limit:
+                oldest = to_epoch_ms(page[-1]['timeCollected'])
+                if new_events:
+                    page_end = from_epoch_ms(oldest + 1)
+                else:
+                    # the page is all one millisecond already seen: drain it, then page strictly below it
+                    new_events = [event for event in query(from_epoch_ms(oldest), from_epoch_ms(oldest + 1))
+                                  if event['id'] not in seen]
+                    page_end = from_epoch_ms(oldest)
+            for event in new_events:
+                seen.add(event['id'])
+                yield event
+            if len(page) < page_limit:
+                break
+        window_end = window_start
+        window = window * growth
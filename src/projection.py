@@ -0,0 +1,101 @@
+import threading
+from typing import List
+
+from api_types import SensorQuery
+from utils import from_epoch_ms, to_epoch_ms
+
+
+def without_meta(query):
+    """A copy of a stream or sensor query which asks for events without their ``meta``, unless the query already
+    says whether it wants meta.  Meta is usually most of an event's size."""
+    if getattr(query, 'with_meta', None) is not None:
+        return query
+    projected = type(query).from_dict(query.to_dict())
+    projected.with_meta = False
+    return projected
+
+
+class MetaLoader:
+    """Fetches the meta of single events of a query's response, by querying the event's sensor over the
+    millisecond it was collected in.  Meta of other events that response returns is kept for later."""
+
+    def __init__(self, client, query):
+        self.client = client
+        self.query = query
+        self.fetched = 0
+        self._meta = {}
+        self._lock = threading.Lock()
+
+    def _event_query(self, event: dict):
+        ms = to_epoch_ms(event['timeCollected'])
+        query = type(self.query).from_dict(self.query.to_dict())
+        query.with_meta = None
+        query.sensors = [event.get('sensorId') or event.get('sensorName')]
+        start, end = from_epoch_ms(ms).replace(tzinfo=None), from_epoch_ms(ms + 1).replace(tzinfo=None)
+        if isinstance(query, SensorQuery):
+            query.start_time, query.end_time = start.isoformat(), end.isoformat()
+        else:
+            query.start_time, query.end_time = start, end
+            query.limit = None
+        return query
+
+    def meta(self, event: dict):
+        with self._lock:
+            if event['id'] in self._meta:
+                return self._meta[event['id']]
+        query = self._event_query(event)
+        operation = 'query_sensor_flat' if isinstance(query, SensorQuery) else 'query_stream_flat'
+        response = getattr(self.client, operation)(query)
+        _count(self.client, 'meta_fetched', 1)
+        with self._lock:
+            self.fetched += 1
+            for other in response:
+                if 'meta' in other:
+                    self._meta[other['id']] = other['meta']
+            return self._meta.setdefault(event['id'], None)
+
+
+class LazyMetaEvent(dict):
+    """An event fetched without meta.  ``event['meta']`` (or ``.get('meta')``) fetches the event's meta the first
+    time it is read; every other key is read as usual."""
+    __slots__ = ('_loader',)
+
+    def __init__(self, event: dict, loader: MetaLoader):
+        super().__init__(event)
+        self._loader = loader
+
+    def _load(self):
+        meta = self._loader.meta(self)
+        self['meta'] = meta
+        return meta
+
+    def __missing__(self, key):
+        if key == 'meta':
+            return self._load()
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key == 'meta' or super().__contains__(key)
+
+    def get(self, key, default=None):
+        if key == 'meta' and not super().__contains__('meta'):
+            return self._load()
+        return super().get(key, default)
+
+
+def lazy_meta(events: List[dict], client, query) -> List[LazyMetaEvent]:
+    """Wrap the events of a query sent ``without_meta``, so the meta of an event is fetched only if it is read.
+
+    Events the server returned with meta anyway are left as they are.
+    """
+    loader = MetaLoader(client, query)
+    events = [event if 'meta' in event else LazyMetaEvent(event, loader) for event in events]
+    _count(client, 'events_without_meta', sum(isinstance(event, LazyMetaEvent) for event in events))
+    return events
+
+
+def _count(client, name: str, value: int):
+    # clients which keep transfer statistics (DataApiClient) report these in transfer_summary
+    stats = getattr(client, 'stats', None)
+    if isinstance(stats, dict) and 'wire_bytes' in stats:
+        stats[name] += value
@@ -0,0 +1,80 @@
+import heapq
+import itertools
+from typing import Callable, Dict, Iterable, Iterator, List
+
+
+class TopK:
+    """Keeps the ``k`` events with the largest ``key`` seen so far, in O(k) memory.
+
+    Events can be added one at a time or a batch at a time as they arrive from the client.  Ties keep the event
+    seen first.
+    """
+
+    def __init__(self, k: int, key: Callable[[dict], float]):
+        self.k = k
+        self.key = key
+        self._heap = []
+        # decreasing sequence numbers make earlier events win ties in the min-heap
+        self._sequence = itertools.count(0, -1)
+
+    def add(self, event: dict):
+        if self.k <= 0:
+            return
+        entry = (self.key(event), next(self._sequence), event)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif entry > self._heap[0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def add_all(self, events: Iterable[dict]):
+        for event in events:
+            self.add(event)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def results(self) -> List[dict]:
+        """The top events, largest key first."""
+        return [entry[2] for entry in sorted(self._heap, reverse=True)]
+
+
+class GroupedTopK:
+    """A ``TopK`` per group, e.g. the top events of each sensor with ``group=lambda e: e['sensorId']``."""
+
+    def __init__(self, k: int, key: Callable[[dict], float], group: Callable[[dict], str]):
+        self.k = k
+        self.key = key
+        self.group = group
+        self.groups: Dict[str, TopK] = {}
+
+    def add(self, event: dict):
+        group = self.group(event)
+        top = self.groups.get(group)
+        if top is None:
+            top = self.groups[group] = TopK(self.k, self.key)
+        top.add(event)
+
+    def add_all(self, events: Iterable[dict]):
+        for event in events:
+            self.add(event)
+
+    def results(self) -> Dict[str, List[dict]]:
+        return {group: top.results() for group, top in self.groups.items()}
+
+
+def threshold(events: Iterable[dict], key: Callable[[dict], float],
+              minimum: float = None, maximum: float = None) -> Iterator[dict]:
+    """Lazily yield the events whose key is within [minimum, maximum]."""
+    for event in events:
+        value = key(event)
+        if minimum is not None and value < minimum:
+            continue
+        if maximum is not None and value > maximum:
+            continue
+        yield event
+
+
+def top_k(events: Iterable[dict], k: int, key: Callable[[dict], float]) -> List[dict]:
+    top = TopK(k, key)
+    top.add_all(events)
+    return top.results()
@@ -0,0 +1,592 @@
+import argparse
+import datetime
+from time import time
+
+import dateutil.parser
+import dateutil.tz
+import pprint
+import textwrap
+import sys, os, subprocess
+import re
+import shutil
+import tempfile
+
+from api_types import SensorQuery
+from client import client_from_env
+from filters import add_where_argument, where_filter
+from planner import QueryPlanner
+from projection import lazy_meta
+from profiling import profiler, traced
+from storage import GCSBackend, backend_for
+
+VIDEO_LENTH_MINUTES = 5
+SECONDS_BEFORE_EVENT = 10
+SECONDS_AFTER_EVENT = 5
+
+def build_query(args, sensors, with_meta=None):
+    return SensorQuery(device_id=f'{args.deviceId}',
+                       sensors=[f'{sensors}'],
+                       start_time=f'{args.startTime}',
+                       end_time=f'{args.endTime}',
+                       with_meta=with_meta)
+
+def print_curl(client, args, sensors, with_meta=None):
+    """Print the request the planner sends for a list of sensors: one request for all of them, sorted as it merges."""
+    url = f'{client.api_base}data/sensor/query'
+    sensors = ','.join(f'"{sensor}"' for sensor in sorted(set(sensors)))
+    projection = '' if with_meta is None else f',"withMeta":{str(with_meta).lower()}'
+    print(f'Issuing curl "{url}" -d \'{{"deviceId":"{args.deviceId}","sensors":[{sensors}],'
+          f'"startTime":"{args.startTime}","endTime":"{args.endTime}"{projection}}}\' \\\n'
+          f'-X POST \\\n'
+          f'-H "Content-Type: application/json" \\\n'
+          f'-H "X-API-KEY: {args.key}"')
+
+def time_parse(args, parser):
+    format_str = "%Y-%m-%dT%H:%M:%S.000Z"
+    if args.startTime is not None:
+        passed_start_time = args.startTime
+        start_date = dateutil.parser.parse(args.startTime)
+        args.startTime = start_date.astimezone(dateutil.tz.UTC).strftime(format_str)
+        print(f'converted start time {passed_start_time} to UTC time value {args.startTime}')
+    if args.endTime is not None:
+        passed_end_time = args.endTime
+        end_date = dateutil.parser.parse(args.endTime)
+        args.endTime = end_date.astimezone(dateutil.tz.UTC).strftime(format_str)
+        print(f'converted end time {passed_end_time} to UTC time value {args.endTime}')
+    else:
+        args.endTime = datetime.datetime.now().astimezone(dateutil.tz.UTC).strftime(format_str)
+        end_date = dateutil.parser.parse(args.endTime)
+        print(f'endTime not specified, using time now ({args.endTime})')
+    if args.lastDays is not None:
+        args.startTime = (end_date - datetime.timedelta(days=args.lastDays)).strftime(format_str)
+        print(f'lastDays {args.lastDays} specified, used this to set startTime to {args.startTime}')
+    if args.lastHours is not None:
+        args.startTime = (end_date - datetime.timedelta(hours=args.lastHours)).strftime(format_str)
+        print(f'lastHours {args.lastHours} specified, used this to set startTime to {args.startTime}')
+    if args.lastMinutes is not None:
+        args.startTime = (end_date - datetime.timedelta(minutes=args.lastMinutes)).strftime(format_str)
+        print(f'lastMinutes {args.lastMinutes} specified, used this to set startTime to {args.startTime}')
+
+
+    if args.startTime is None or args.endTime is None:
+        print(f'Time range not specified for query')
+        parser.print_help()
+        raise ValueError('Invalid arguments')
+
+def split_path(path):
+    """Split <bucket>/pathTo/dir/ into (bucket, 'pathTo/dir')."""
+    bucket, _, base_path = path.strip("/").partition("/")
+    return bucket, base_path.strip("/")
+
+def video_prefix(args, time):
+    """Bucket and object prefix of the videos recorded by args.deviceId on the day of time."""
+    if args.sourceGCPpath:
+        bucket, basePath = split_path(args.sourceGCPpath)
+        prefix = f"{basePath}/{args.deviceId}/data_acq_video/" + time.strftime("%Y-%m-%d") + "/"
+    else:
+        bucket = "bai-rawdata"
+        basePath = "gcpbai"
+        prefix = f"{basePath}/{args.deviceId}/" + time.strftime("%Y-%m-%d") + "/"
+    # google cloud sdk doesn't like double // (or a leading / when there is no base path)
+    return bucket, prefix.replace("//","/").lstrip("/")
+
+def video_start(video_name):
+    format_str = "DataAcqVideo_%Y-%m-%d-%H-%M-%S.%f"
+    video_name = re.search("DataAcqVideo_.*mp4", video_name)
+    if not video_name:
+        return None
+    return datetime.datetime.strptime(video_name.group(0).replace(".mp4", "000"), format_str).replace(tzinfo=dateutil.tz.UTC)
+
+def video_file_name(time):
+    """Name of a video starting at time, e.g. DataAcqVideo_2021-07-20-16-49-41.123.mp4"""
+    return "DataAcqVideo_" + time.strftime("%Y-%m-%d-%H-%M-%S.%f")[:-3] + ".mp4"
+
+@traced()
+def findVideo(backend, args, time):
+    """Return (bucket, name) of the video containing time, or False."""
+    bucket, prefix = video_prefix(args, time)
+    after_time = time - datetime.timedelta(minutes=VIDEO_LENTH_MINUTES)
+    # video names sort by start time, so only list the ones which started in the VIDEO_LENTH_MINUTES before time
+    names = backend.list(bucket, prefix,
+                         start_offset=prefix + video_file_name(after_time)[:-len(".mp4")],
+                         end_offset=prefix + video_file_name(time)[:-len(".mp4")])
+    # search for matching video
+    for name in names:
+        video_time = video_start(name)
+        if video_time and video_time > after_time and video_time < time:
+            return bucket, name
+    return False
+
+@traced()
+def trim(start,end,input,output):
+    import ffmpeg
+    (
+        ffmpeg
+        .input(input)
+        .trim(start=start, end=end)
+        .output(output)
+        .overwrite_output()
+        .run(quiet=True)
+    )
+            
+def clipTimes(event, video_name):
+    """Start and end of the clip of an event, relative to the start of its video."""
+    # find corresponding time in video
+    event_time = dateutil.parser.parse(event['timeCollected']).astimezone(dateutil.tz.UTC)
+    video_time = video_start(video_name)
+    video_relative_time = event_time - video_time
+    format_str = "%H:%M:%S"
+    start_time = str(video_relative_time - datetime.timedelta(seconds=SECONDS_BEFORE_EVENT))
+    end_time = str(video_relative_time + datetime.timedelta(seconds=SECONDS_AFTER_EVENT))
+    # make sure we're not going out of bounds
+    if datetime.timedelta(seconds=SECONDS_BEFORE_EVENT) > video_relative_time:
+        start_time = "00:00:00.000"
+    if (video_relative_time + datetime.timedelta(seconds=SECONDS_AFTER_EVENT)) > datetime.timedelta(seconds=VIDEO_LENTH_MINUTES*60):
+        end_time = f"00:0{VIDEO_LENTH_MINUTES}:00"
+    return start_time, end_time
+
+def uploadDestination(args):
+    """Bucket and path (empty or ending with /) to upload event clips to."""
+    bucket_name, base_path = split_path(args.uploadEventClips)
+    return bucket_name, (base_path + "/").lstrip("/")
+
+@traced()
+def streamClip(backend, args, event, video):
+    """Trim a clip without temporary files: the source video is streamed into ffmpeg, and ffmpeg's output is streamed
+    to the --uploadEventClips destination if set, else written to args.output.
+
+    Returns the clip's filename, or (bucket, name) if it was uploaded."""
+    from clip_stream import TrimStream
+    bucket, video_name = video
+    start_time, end_time = clipTimes(event, video_name)
+    with TrimStream(backend, bucket, video_name, start_time, end_time) as clip:
+        if args.uploadEventClips:
+            upload_bucket, base_path = uploadDestination(args)
+            destination = (upload_bucket, base_path + event['id'] + ".mp4")
+            backend.upload_stream(clip, *destination)
+        else:
+            destination = args.output + "/" + event['id'] + ".mp4"
+            clip.save(destination)
+    profiler.add(bytes=clip.bytes_read)
+    return destination
+
+def downloadClip(backend, args, event, video):
+    bucket, video_name = video
+    tmp_filename = args.output + "/tmp/" + video_name.split('/')[-1]
+    # download file if it doesn't exist already
+    if not os.path.isfile(tmp_filename):
+        # delete last tmp file if we're not using it
+        if os.path.isdir(args.output + "/tmp"):
+            shutil.rmtree(args.output + "/tmp/")
+        os.mkdir(args.output + "/tmp/")
+        with profiler.span('download', 'storage', video=video_name):
+            backend.download(bucket, video_name, tmp_filename)
+            profiler.add(bytes=os.path.getsize(tmp_filename))
+    start_time, end_time = clipTimes(event, video_name)
+    # trim the video using ffmpeg
+    output_filename = args.output + "/" + event['id'] + ".mp4"
+    trim(start_time, end_time, tmp_filename, output_filename)
+    return output_filename
+
+def clipConsumer(backend, destination):
+    """Function saving a clip stream to destination: (bucket, name) to upload it to, or a filename."""
+    if isinstance(destination, tuple):
+        return lambda stream: backend.upload_stream(stream, *destination)
+    def save(stream):
+        with open(destination, 'wb') as f:
+            shutil.copyfileobj(stream, f)
+    return save
+
+@traced()
+def streamClips(backend, args, events, video):
+    """Trim the clips of several events in one video from a single stream of the video, without temporary files: each
+    clip is streamed to the --uploadEventClips destination if set, else written to args.output.
+
+    Returns the clips' filenames, or (bucket, name) of the uploaded ones."""
+    from clip_stream import trim_many
+    bucket, video_name = video
+    if args.uploadEventClips:
+        upload_bucket, base_path = uploadDestination(args)
+        destinations = [(upload_bucket, base_path + event['id'] + ".mp4") for event in events]
+    else:
+        destinations = [args.output + "/" + event['id'] + ".mp4" for event in events]
+    clips = [clipTimes(event, video_name) + (clipConsumer(backend, destination),)
+             for event, destination in zip(events, destinations)]
+    profiler.add(bytes=trim_many(backend, bucket, video_name, clips))
+    return destinations
+
+def downloadEventClips(backend, args, events):
+    """Find the source video of each event and trim a clip of it into args.output.
+
+    Events are grouped by video first, so each video is downloaded, or with args.streamClips streamed, once for all
+    of its events.  Streamed clips are uploaded as they are made if --uploadEventClips is set.
+    Returns the filenames of the local clips and (bucket, name) of the uploaded ones."""
+    videos = {}
+    for event in events:
+        with profiler.span('event', 'event', id=event['id']):
+            video = findEventVideo(backend, args, event)
+        if video:
+            videos.setdefault(video, []).append(event)
+    downloaded = []
+    uploaded = []
+    for video, video_events in videos.items():
+        for clip in videoClips(backend, args, video, video_events):
+            if isinstance(clip, tuple):
+                uploaded.append(clip)
+            else:
+                downloaded.append(clip)
+    # clear up tmp files
+    if os.path.isdir(args.output + "/tmp/"):
+        shutil.rmtree(args.output + "/tmp/")
+    return downloaded, uploaded
+
+def findEventVideo(backend, args, event):
+    """(bucket, name) of the video of an event, or None."""
+    event_time = dateutil.parser.parse(event['timeCollected']).astimezone(dateutil.tz.UTC)
+    print(f"Searching for video for event with ID {event['id']}... ", end="", flush=True)
+    video = findVideo(backend, args, event_time)
+    if video == False:
+        print("No luck.")
+        return None
+    print("Found!")
+    return video
+
+def videoClips(backend, args, video, events):
+    """Clips of the events in one video: filenames, or (bucket, name) of a clip streamed to the upload destination."""
+    from clip_stream import moov_first
+    if getattr(args, 'streamClips', False):
+        if moov_first(backend, *video):
+            if len(events) == 1:
+                with profiler.span('event', 'event', id=events[0]['id']):
+                    clips = [streamClip(backend, args, events[0], video)]
+            else:
+                clips = streamClips(backend, args, events, video)
+            for clip in clips:
+                if isinstance(clip, tuple):
+                    print(f"Uploaded {clip[0]}/{clip[1]}")
+                else:
+                    print(f"Downloaded {clip}")
+            return clips
+        print(f"{video[1]} has its moov atom at the end and can't be streamed, downloading it instead")
+    clips = []
+    for event in events:
+        with profiler.span('event', 'event', id=event['id']):
+            # the video is only downloaded for the first of its events
+            filename = downloadClip(backend, args, event, video)
+        print(f"Downloaded {filename}")
+        clips.append(filename)
+    return clips
+
+# add start time to event list    
+def addStartTime(eventList):
+    format_str = "%Y-%m-%dT%H:%M:%S.%f"
+    for event in eventList:
+        if not event['value']:
+            print(f"ERROR: Event {event['id']} does not have value content")
+            sys.exit(1)
+        timedelta_from_value = datetime.timedelta(seconds=event["value"])
+        event_time = dateutil.parser.parse(event['timeCollected']).astimezone(dateutil.tz.UTC)
+        event["startTime"] = (event_time - timedelta_from_value).strftime(format_str)
+
+# find event with closest timestamp to provided timestamp
+def findClosest(timestamp, event_list):
+    event_time = dateutil.parser.parse(timestamp).astimezone(dateutil.tz.UTC)
+    closest = None
+    before = True
+    for potential_event in event_list:
+        # find difference in time
+        potential_event_time = dateutil.parser.parse(potential_event['timeCollected']).astimezone(dateutil.tz.UTC)
+        if re.match(r"(COLLISION_[0-9]*)|(PRESENCE_.*_[0-9]*)", potential_event['sensorName']):
+            potential_event_time = dateutil.parser.parse(potential_event['startTime']).astimezone(dateutil.tz.UTC)
+        time_difference = None
+        if potential_event_time < event_time:
+            before = True
+            time_difference = event_time - potential_event_time
+        else: 
+            before = False
+            time_difference = potential_event_time - event_time
+
+        if not closest:
+            if before == True:
+                closest = {"event": potential_event, "time_difference_str": "-" + str(time_difference), "time_difference_timedelta": time_difference}
+            else:
+                closest = {"event": potential_event, "time_difference_str": str(time_difference), "time_difference_timedelta": time_difference}
+            continue
+        if time_difference < closest["time_difference_timedelta"]:
+            if before == True:
+                closest = {"event": potential_event, "time_difference_str": "-" + str(time_difference), "time_difference_timedelta": time_difference}
+            else:
+                closest = {"event": potential_event, "time_difference_str": str(time_difference), "time_difference_timedelta": time_difference}
+    return closest
+
+# add CrossReference events
+def addCrossReferences(filtered_result, crossReferenceEvents):
+    for primary_event in filtered_result:
+        if 'startTime' in primary_event:
+            primary_event['closestStartTime'] = findClosest(primary_event['startTime'], crossReferenceEvents)
+        else:
+            primary_event['closestTimeCollected'] = findClosest(primary_event['timeCollected'], crossReferenceEvents)
+    return filtered_result
+
+# write csvInfo to csv
+def write_to_csv(args, csvInfo):
+    if args.csv:
+        csv_file = None
+        try: 
+            csv_file = open(args.csv, "w+")
+            print(f"Writing to CSV file at {args.csv}... ", end="")
+        except:
+            print(f"ERROR: Could not open {args.csv}")
+            sys.exit(1)
+        csv_file.write("eventId,")
+        for key in list(list(csvInfo.values())[0].keys()):
+            csv_file.write(str(key)+",")
+        csv_file.write("\n")
+        for eventId in csvInfo:
+            csv_file.write(f"{eventId},")
+            for key in csvInfo[eventId]:
+                csv_file.write(f"{csvInfo[eventId][key]},")
+            csv_file.write("\n")
+        print("Done!")
+
+def uploadEventClips(args, downloaded, csvInfo, backend, uploaded=()):
+    # upload event clips (uploaded lists the ones already streamed to the destination)
+    uploads = list(uploaded)
+    if args.uploadEventClips:
+        bucket_name, base_path = uploadDestination(args)
+        print(f"Uploading all event clips to bucket {bucket_name} and path {base_path}")
+
+        for filepath in downloaded:
+            filename = filepath.split("/")[-1]
+            print(f"Uploading {filename} to {bucket_name}/{base_path}... ", end="")
+            try:
+                with profiler.span('upload', 'storage', clip=filename, bytes=os.path.getsize(filepath)):
+                    backend.upload(filepath, bucket_name, base_path + filename)
+            except Exception as e:
+                print(f"ERROR: Trouble uploading to bucket {bucket_name}: {e}")
+                sys.exit(1)
+            uploads.append((bucket_name, base_path + filename))
+            print("Done!")
+            
+        if args.csv: 
+            for bucket_name, name in uploads:
+                eventId = name.split("/")[-1].replace(".mp4","")
+                csvInfo[eventId]["GCP Authenticated URL"] = backend.link(bucket_name, name)
+    
+    return args, csvInfo
+
+def main(argv=None, client=None, backend=None):
+    """Run a query (and clip) job.  batch.py passes a client and storage backend shared by many jobs."""
+    parser = argparse.ArgumentParser(description="Data API query tool for the Sigthhound Data API",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog=textwrap.dedent('''\
+    Examples:
+    Query data for collision sensor on BAI_0000754 for the last 3 days:
+        python data-api.py --key=${API_KEY} --sensors=COLLISION_1 --deviceId=BAI_0000754 --lastDays=3
+    Query data for collision sensor on BAI_0000754 for the last 5 hours:
+        python data-api.py --key=${API_KEY} --sensors=COLLISION_1 --deviceId=BAI_0000754 --lastHours=5
+    Query data for collision sensor on BAI_0000754 for a specific date range:
+        python data-api.py --key=${API_KEY} --sensors=COLLISION_1 --deviceId=BAI_0000754 \
+            --startTime=2021-07-20T16:49:41 --endTime=2021-07-22T16:49:41
+    Query data for collision sensor on BAI_0000754 for the last day, filtering on events which occurred
+    in the first 5 minutes of any 10 minute interval:
+        python data-api.py --key=${API_KEY} --sensors=COLLISION_1 --deviceId=BAI_0000754 --lastDays=1 \
+            --filterMinutesModulo=10 --filterMinutesRestrict=5
+    Download clips of all collision events in the last hour to output folder ./output/:
+        python3 data-api.py --key=${API_KEY} --sensors=COLLISION_1 --deviceId=BAI_0000754 --lastHours=1 \
+            --filterMinutesModulo=10 --filterMinutesRestrict=5 --downloadEventClips --output output/
+    Download event clips of all collision events in the last hour from GCP bucket base path sh-ext-customer (change to 
+    your bucket name), upload event clips to GCP bucket bai-dev-data/ai-analysis/sample, and save a CSV file out.csv 
+    with links to the clips. Note that this is the legacy implementation.
+        export BUCKET_PATH=sh-ext-customer/
+        python3 data-api.py --key=${API_KEY} --sensors=COLLISION_1 --deviceId=BAI_0000754 --lastHour=1 \
+            --filterMinutesModulo=10 --filterMinutesRestrict=5 --downloadEventClips --sourceGCPpath ${BUCKET_PATH} \
+            --output output/ --uploadEventClips bai-dev-data/ai-analysis/sample/ --csv out.csv
+    '''))
+    parser.add_argument('--sensors', help="A comma separated list of sensors to query")
+    parser.add_argument('--deviceId', help="The device ID (BAI_XXXXXXX)")
+    parser.add_argument('--lastMinutes',
+                        type=int,
+                        help="A number of minutes relative to endTime (or now if endTime is not specified) to query")
+    parser.add_argument('--lastHours',
+                        type=int,
+                        help="A number of hours relative to endTime (or now if endTime is not specified) to query")
+    parser.add_argument('--lastDays',
+                        type=int,
+                        help="A number of days relative to endTime (or now if endTime is not specified) to query")
+    parser.add_argument('--startTime',
+                        help="The start time, accepted in any format dateutil.parser supports.  Optional and not used"
+                             "if --lastHours aor --lastDays is specified")
+    parser.add_argument('--endTime',
+                        help="The end time, accepted in any format dateutil.parser supports.\n"
+                             "see https://dateutil.readthedocs.io/en/stable/examples.html#parse-examples.\n"
+                             "If not specified, set to now")
+    parser.add_argument('--key',
+                        help="The API key for the workspace associated with the device (available from the platform)")
+    parser.add_argument('--filterMinutesModulo', type=int,
+                        help='An optional modulo filter.  When specified with filterMinutesRestrict this filters\n'
+                             'out events which occurred outside periods defined by a modulus of the minute of event\n'
+                             'for instance, specifying --filterMinutesModulo 10 and --filterMinutesRestrict 3 would\n'
+                             'include events which happened during the first 3 minutes of every 10 minute interval,\n'
+                             'starting at the top of the hour.')
+    parser.add_argument('--filterMinutesRestrict', type=int,
+                        help='An optional restrict filter.  See notes for filterMinutesModulo')
+    add_where_argument(parser)
+    parser.add_argument('--noMeta', action='store_true',
+                        help='Query events without their meta, which is most of each event, unless --where uses meta '
+                             'fields.  Printed events then only have their ID, time, sensor and value, and an event\'s '
+                             'meta is fetched only if it is needed.')
+    parser.add_argument('--crossReferenceSensor', type=str,
+                        help='A sensor to cross reference events with. The cross referenceed sensors time and \n'
+                             'time difference relative to the original sensor will be included in the csv \n'
+                             'if --csv is specified.')
+    parser.add_argument('--downloadEventClips', action='store_true',
+                        help='An optional argument to download the video clips of the events if they exist in the bai-rawdata\n'
+                             'GCP bucket. Must be used with --output flag. ')
+    parser.add_argument('-o', '--output',
+                        help='Directory to download event clips. To be used with --downloadEventClips flag, and optional\n'
+                             'with --streamClips and --uploadEventClips.')
+    parser.add_argument('--sourceGCPpath', 
+                        help='GCP path to search for and retrieve video clips from. Should be in the format'
+                             '<bucket>/pathTo/deviceDirs/ . Defaults to bai-rawdata/gcpbai/ if not specified.')
+    parser.add_argument('--mediaRoot',
+                        help='Local directory mirroring the GCP buckets (for instance an NFS mirror of bai-rawdata), used\n'
+                             'instead of GCP to find and download videos and to upload clips. gs://<bucket>/path is read\n'
+                             'from <mediaRoot>/<bucket>/path. Defaults to $DATA_API_MEDIA_ROOT if set.')
+    parser.add_argument('--streamClips', action='store_true',
+                        help='Trim clips without temporary files: source videos are streamed into ffmpeg, and clips are\n'
+                             'streamed to --uploadEventClips (as fragmented MP4) instead of being written to --output.\n'
+                             'Each video is streamed once for all of its events. Videos with the moov atom at the end of\n'
+                             'the file are downloaded as usual, to a temporary directory if --output isn\'t given.')
+    parser.add_argument('--uploadEventClips', 
+                        help='GCP path to upload trimmed event clips to. Should be in the format'
+                             '<bucket>/pathTo/deviceDirs/ . If specified, video clips will be deleted locally')
+    parser.add_argument('--csv', 
+                        help='Path to output CSV file with event clip information.'
+                             'eventId and time collected information for each uploaded clip.')
+    parser.add_argument('--explain', action='store_true',
+                        help='Dry run: estimate the events, API requests, video listings, bytes downloaded and uploaded\n'
+                             'and wall time of the job from an aggregate count query and a sampled video listing,\n'
+                             'without running it.')
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) == 0:
+        parser.print_help()
+        sys.exit(1)
+    args = parser.parse_args(argv)
+
+    time_parse(args, parser)
+    client = client or client_from_env(args.key)
+    if args.explain:
+        from explain import explain, print_estimate
+        if args.downloadEventClips and backend is None:
+            backend = backend_for(args.mediaRoot, use_service_account=True)
+        estimate = explain(client, args, backend)
+        print_estimate(estimate)
+        return estimate
+    conditions = [f'({args.where})'] if args.where else []
+    if args.filterMinutesModulo and args.filterMinutesRestrict:
+        print(f"Events filtered for the first {args.filterMinutesRestrict} minutes of each "
+              f"{args.filterMinutesModulo} minute interval")
+        conditions.append(f'minute % {args.filterMinutesModulo} < {args.filterMinutesRestrict}')
+    event_filter = where_filter(' and '.join(conditions))
+    # with --noMeta, meta (most of each event) isn't transferred: only id, timeCollected, sensorName and value are used
+    with_meta = False if args.noMeta and not (event_filter and event_filter.uses_meta) else None
+    # the cross reference sensor covers the same window, so the planner fetches both sensors with one request
+    planner = QueryPlanner(client)
+    query = build_query(args, args.sensors, with_meta)
+    result = planner.submit('query_sensor_flat', query)
+    crossReference = None
+    if args.crossReferenceSensor:
+        crossReferenceQuery = build_query(args, args.crossReferenceSensor, with_meta)
+        crossReference = planner.submit('query_sensor_flat', crossReferenceQuery)
+    print_curl(client, args, [args.sensors] + ([args.crossReferenceSensor] if args.crossReferenceSensor else []),
+               with_meta)
+    with profiler.span('query_flat'):
+        planner.execute()
+    result = result.result()
+    if with_meta is False:
+        result = lazy_meta(result, client, query)
+    filtered_result = event_filter.apply(result) if event_filter else result
+    start_date = dateutil.parser.parse(args.startTime).astimezone(dateutil.tz.tzlocal())
+    end_date = dateutil.parser.parse(args.endTime).astimezone(dateutil.tz.tzlocal())
+    print(f"Starting at {args.startTime} (local time {start_date}) "
+          f"and ending {end_date - start_date} later at {args.endTime} (local time {end_date})")
+    pprint.pprint(filtered_result)
+
+    if len(filtered_result) == 0:
+        print("No events matching filters.")
+        return None
+
+    # initialize csvInfo dictionary
+    csvInfo = {}
+    if args.csv:
+        for event in filtered_result:
+            csvInfo[event['id']] = {}
+            if event['value']:
+                csvInfo[event['id']]['value'] = event['value']
+
+    # cross reference events
+    if args.crossReferenceSensor:
+        print(f"Cross referencing {args.sensors} events with {args.crossReferenceSensor}")
+        crossReferenceEvents = crossReference.result()
+        if with_meta is False:
+            crossReferenceEvents = lazy_meta(crossReferenceEvents, client, crossReferenceQuery)
+        for event_list in [filtered_result, crossReferenceEvents]:
+            if event_list and re.match(r"(COLLISION_[0-9]*)|(PRESENCE_.*_[0-9]*)", event_list[0]['sensorName']):
+                eventList = addStartTime(event_list)
+        # add cross reference events to filtered_result dictionary
+        filtered_result = addCrossReferences(filtered_result, crossReferenceEvents)
+        if filtered_result and re.match(r"COLLISION_[0-9]*", filtered_result[0]['sensorName']):
+            for event in filtered_result:
+                csvInfo[event['id']]['startTime'] = event['startTime']
+                csvInfo[event['id']]['endTime'] = event['timeCollected']
+                csvInfo[event['id']][f'{args.crossReferenceSensor} Time'] = event['closestStartTime']['event']['startTime'] if event['closestStartTime'] else None
+                csvInfo[event['id']][f'{args.crossReferenceSensor} Time Difference'] = event['closestStartTime']['time_difference_str'] if event['closestStartTime'] else None
+        else:
+            for event in filtered_result:
+                csvInfo[event['id']]['timeCollected'] = event['timeCollected']
+                csvInfo[event['id']][f'{args.crossReferenceSensor} Time'] = event['closestTimeCollected']['event']['timeCollected'] if event['closestTimeCollected'] else None
+                csvInfo[event['id']][f'{args.crossReferenceSensor} Time Difference'] = event['closestTimeCollected']['time_difference_str'] if event['closestTimeCollected'] else None
+
+
+    # download clips if video exists in source GCP bucket 
+    if args.downloadEventClips:
+        temporary_output = None
+        if not args.output and args.streamClips and args.uploadEventClips:
+            # clips are streamed to the upload destination; only videos which can't be streamed are downloaded here
+            args.output = temporary_output = tempfile.mkdtemp(prefix='data-api-clips-')
+        if not args.output:
+            print("ERROR: must pass --output flag with --downloadEventClips (unless --streamClips and "
+                  "--uploadEventClips are used)")
+            sys.exit(1)
+        if not os.path.isdir(args.output):
+            print(f"Creating output directory {args.output}")
+            os.mkdir(args.output)
+
+        if backend is None:
+            backend = backend_for(args.mediaRoot, use_service_account=True)
+            if isinstance(backend, GCSBackend):
+                try:
+                    backend.pool.client
+                except:
+                    print(f"Failed opening GCP storage client, please login using `gcloud auth application-default login`")
+                    sys.exit(1)
+
+        downloaded, uploaded = downloadEventClips(backend, args, filtered_result)
+
+        args, csvInfo = uploadEventClips(args, downloaded, csvInfo, backend, uploaded)
+        if temporary_output:
+            shutil.rmtree(temporary_output)
+    # write results to csv
+    write_to_csv(args, csvInfo)
+    if hasattr(client, 'transfer_summary'):
+        print(client.transfer_summary())
+
+    return filtered_result
+
+
+# Press the green button in the gutter to run the script.
+if __name__ == '__main__':
+    result = main()
+
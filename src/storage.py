@@ -0,0 +1,254 @@
+import abc
+import os
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Tuple
+from urllib.parse import urlparse
+
+from profiling import profiler
+
+DEFAULT_DOWNLOAD_WORKERS = 8
+# GCS resumable uploads need chunks in multiples of 256 KB
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def parse_gcs_url(url: str) -> Tuple[str, str]:
+    """Split a gs://bucket/path or https://storage.googleapis.com/bucket/path URL into (bucket, blob name)."""
+    parsed = urlparse(url)
+    if parsed.scheme == 'gs':
+        return parsed.netloc, parsed.path.lstrip('/')
+    bucket, _, name = parsed.path.lstrip('/').partition('/')
+    return bucket, name
+
+
+class StoragePool:
+    """One Google Cloud storage client with a cache of bucket handles, shared by every download.
+
+    Blobs are addressed directly with ``bucket.blob(name)`` so a download is a single request, without the
+    metadata lookup of ``get_blob``.
+    """
+
+    def __init__(self, use_service_account: bool = False):
+        self.use_service_account = use_service_account
+        self._client = None
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                from google.cloud import storage
+                if self.use_service_account:
+                    import google.auth
+                    credentials, project = google.auth.default()
+                    self._client = storage.Client(project, credentials)
+                else:
+                    self._client = storage.Client()
+            return self._client
+
+    def bucket(self, name: str):
+        client = self.client
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = client.bucket(name)
+            return self._buckets[name]
+
+    def blob(self, url: str):
+        bucket, name = parse_gcs_url(url)
+        return self.bucket(bucket).blob(name)
+
+    def download(self, url: str, filename: str):
+        self.blob(url).download_to_filename(filename)
+
+
+def download_many(items: List[Tuple[str, str]],
+                  download: Callable[[str, str], None],
+                  workers: int = DEFAULT_DOWNLOAD_WORKERS,
+                  progress: bool = True) -> List[Tuple[str, str, Exception]]:
+    """Download ``(url, filename)`` pairs concurrently with at most ``workers`` downloads in flight.
+
+    Returns ``(url, filename, error)`` for every item, where error is None if the download succeeded.  A failed
+    download doesn't stop the others.
+    """
+    results = []
+    if not items:
+        return results
+    def traced_download(url, filename):
+        with profiler.span('download', 'storage', url=url):
+            download(url, filename)
+            if profiler.enabled:
+                profiler.add(bytes=os.path.getsize(filename))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(traced_download, url, filename): (url, filename) for url, filename in items}
+        for done, future in enumerate(as_completed(futures), start=1):
+            url, filename = futures[future]
+            error = future.exception()
+            results.append((url, filename, error))
+            if progress:
+                if error:
+                    print(f"[{done}/{len(items)}] Failed downloading {url}: {error}", file=sys.stderr)
+                else:
+                    size = os.path.getsize(filename) if os.path.exists(filename) else 0
+                    print(f"[{done}/{len(items)}] Downloaded {url.split('/')[-1]} to {filename} "
+                          f"({size / 1e6:.1f} MB)")
+    return results
+
+
+class StorageBackend(abc.ABC):
+    """Object storage used by the video pipeline.  Objects are addressed by bucket and name, as in GCS.
+
+    ``list`` returns names in lexicographic order; ``start_offset`` is inclusive and ``end_offset`` exclusive, like
+    the offsets of ``google.cloud.storage.Client.list_blobs``.  A backend must implement every abstract method, else it
+    can't be created.
+    """
+
+    @abc.abstractmethod
+    def list(self, bucket: str, prefix: str, start_offset: str = None, end_offset: str = None) -> List[str]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read(self, bucket: str, name: str, start: int = 0, end: int = None) -> bytes:
+        """Bytes [start, end) of an object, or [start, EOF) if end is None."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def download(self, bucket: str, name: str, filename: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def upload(self, filename: str, bucket: str, name: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def open_read(self, bucket: str, name: str):
+        """Binary file object streaming the contents of an object."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def upload_stream(self, stream, bucket: str, name: str):
+        """Upload everything read from a binary stream, which doesn't need to be seekable (e.g. a pipe)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def link(self, bucket: str, name: str) -> str:
+        """Location of an object to show to users."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def size(self, bucket: str, name: str) -> int:
+        """Size of an object in bytes."""
+        raise NotImplementedError
+
+    def download_url(self, url: str, filename: str):
+        """Download a gs:// or https://storage.googleapis.com/ URL."""
+        self.download(*parse_gcs_url(url), filename)
+
+
+class GCSBackend(StorageBackend):
+    """Google Cloud Storage, through a shared StoragePool."""
+
+    def __init__(self, pool: StoragePool = None):
+        self.pool = pool or StoragePool()
+
+    def list(self, bucket, prefix, start_offset=None, end_offset=None):
+        blobs = self.pool.client.list_blobs(bucket, prefix=prefix, start_offset=start_offset, end_offset=end_offset)
+        return [blob.name for blob in blobs]
+
+    def read(self, bucket, name, start=0, end=None):
+        if end is not None and end <= start:
+            return b''
+        # GCS ranges include their end byte
+        return self.pool.bucket(bucket).blob(name).download_as_bytes(start=start, end=None if end is None else end - 1)
+
+    def download(self, bucket, name, filename):
+        self.pool.bucket(bucket).blob(name).download_to_filename(filename)
+
+    def upload(self, filename, bucket, name):
+        self.pool.bucket(bucket).blob(name).upload_from_filename(filename)
+
+    def open_read(self, bucket, name):
+        return self.pool.bucket(bucket).blob(name).open('rb', chunk_size=STREAM_CHUNK_SIZE)
+
+    def upload_stream(self, stream, bucket, name):
+        # a resumable upload, sent chunk by chunk as the stream is read
+        with self.pool.bucket(bucket).blob(name).open('wb', chunk_size=STREAM_CHUNK_SIZE) as f:
+            shutil.copyfileobj(stream, f, STREAM_CHUNK_SIZE)
+
+    def link(self, bucket, name):
+        return f'https://storage.cloud.google.com/{bucket}/{name}'
+
+    def size(self, bucket, name):
+        return self.pool.bucket(bucket).get_blob(name).size
+
+
+class LocalBackend(StorageBackend):
+    """A local (or NFS mounted) directory mirroring one or more buckets: gs://bucket/path is <root>/bucket/path."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, bucket: str, name: str) -> str:
+        return os.path.join(self.root, bucket, *name.split('/'))
+
+    def list(self, bucket, prefix, start_offset=None, end_offset=None):
+        bucket_root = os.path.join(self.root, bucket)
+        names = []
+        for directory, _, files in os.walk(self.path(bucket, prefix.rpartition('/')[0])):
+            relative = os.path.relpath(directory, bucket_root).replace(os.sep, '/')
+            for file in files:
+                name = file if relative == '.' else f'{relative}/{file}'
+                if not name.startswith(prefix) or name.endswith('.part'):
+                    continue
+                if (start_offset and name < start_offset) or (end_offset and name >= end_offset):
+                    continue
+                names.append(name)
+        return sorted(names)
+
+    def read(self, bucket, name, start=0, end=None):
+        with open(self.path(bucket, name), 'rb') as f:
+            f.seek(start)
+            return f.read() if end is None else f.read(max(end - start, 0))
+
+    def download(self, bucket, name, filename):
+        shutil.copyfile(self.path(bucket, name), filename)
+
+    def upload(self, filename, bucket, name):
+        path = self.path(bucket, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # copy next to the destination first so a listing never sees a partial object
+        partial = f'{path}.{threading.get_ident()}.part'
+        shutil.copyfile(filename, partial)
+        os.replace(partial, path)
+
+    def open_read(self, bucket, name):
+        return open(self.path(bucket, name), 'rb')
+
+    def upload_stream(self, stream, bucket, name):
+        path = self.path(bucket, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f'{path}.{threading.get_ident()}.part'
+        try:
+            with open(partial, 'wb') as f:
+                shutil.copyfileobj(stream, f, STREAM_CHUNK_SIZE)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def link(self, bucket, name):
+        return os.path.abspath(self.path(bucket, name))
+
+    def size(self, bucket, name):
+        return os.path.getsize(self.path(bucket, name))
+
+
+def backend_for(media_root: str = None, use_service_account: bool = False) -> StorageBackend:
+    """A LocalBackend for media_root (or $DATA_API_MEDIA_ROOT) if set, otherwise a GCSBackend."""
+    media_root = media_root or os.environ.get('DATA_API_MEDIA_ROOT')
+    if media_root:
+        return LocalBackend(media_root)
+    return GCSBackend(StoragePool(use_service_account))
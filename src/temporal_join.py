@@ -0,0 +1,206 @@
+import argparse
+import bisect
+import itertools
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from api_types import SensorQuery
+from filters import EVENT_FIELDS, add_where_argument, event_getter, where_filter
+from planner import QueryPlanner
+from profiling import profiler
+from utils import to_epoch_ms
+
+DEFAULT_WINDOW_SECONDS = 5
+# devices queried at once
+MAX_FETCH_THREADS = 8
+
+
+def event_time(event: dict) -> int:
+    return to_epoch_ms(event['timeCollected'])
+
+
+class TimeBuckets:
+    """Events of one stream bucketed by group and by ``bucket_ms`` of time.
+
+    With buckets as wide as the join window, finding the events within the window of a time looks at two or three
+    buckets, so joining n events against m costs O(n + m) plus the matches, instead of the O(n * m) of comparing every
+    pair.
+    """
+
+    def __init__(self, events: Iterable, bucket_ms: int, time: Callable[[dict], int] = event_time,
+                 key: Callable[[dict], object] = None):
+        self.bucket_ms = max(int(bucket_ms), 1)
+        self.count = 0
+        buckets: Dict[tuple, List[tuple]] = {}
+        for event in events:
+            ms = time(event)
+            group = key(event) if key else None
+            if key and group is None:
+                # an event without the key (e.g. a meta field it lacks) can't share it with an anchor
+                continue
+            buckets.setdefault((group, ms // self.bucket_ms), []).append((ms, event))
+            self.count += 1
+        # each bucket as (sorted times, events in the same order), so window edges are found by bisection
+        self._buckets: Dict[tuple, Tuple[List[int], List[dict]]] = {}
+        for bucket, entries in buckets.items():
+            entries.sort(key=lambda entry: entry[0])
+            self._buckets[bucket] = ([entry[0] for entry in entries], [entry[1] for entry in entries])
+
+    def between(self, group, start: int, end: int) -> List[dict]:
+        """The events of ``group`` with ``start <= time <= end``, in time order."""
+        found = []
+        for bucket in range(start // self.bucket_ms, end // self.bucket_ms + 1):
+            entries = self._buckets.get((group, bucket))
+            if entries is None:
+                continue
+            times, events = entries
+            found.extend(events[bisect.bisect_left(times, start):bisect.bisect_right(times, end)])
+        return found
+
+
+def temporal_join(anchors: Iterable, others: Sequence[Iterable], before_ms: int, after_ms: Optional[int] = None,
+                  key: Callable[[dict], object] = None, time: Callable[[dict], int] = event_time,
+                  outer: bool = False) -> Iterator[tuple]:
+    """N-way join of event streams on time: ``(anchor, event of others[0], event of others[1], ...)`` for every
+    combination of events collected from ``before_ms`` before to ``after_ms`` (default ``before_ms``) after the
+    anchor.
+
+    With ``key`` (e.g. ``lambda event: event['deviceId']``) only events with the anchor's key are matched, and events
+    whose key is None match nothing.  Anchors
+    without a match in some stream are skipped, unless ``outer``, in which case that stream's place is None.  The other
+    streams are indexed in ``TimeBuckets``; anchors are streamed, in order, so they can be a generator.
+    """
+    after_ms = before_ms if after_ms is None else after_ms
+    with profiler.span('temporal_join.index', 'join'):
+        indexes = [TimeBuckets(stream, before_ms + after_ms, time, key) for stream in others]
+    for anchor in anchors:
+        ms = time(anchor)
+        group = key(anchor) if key else None
+        if key and group is None:
+            matches = [[] for _ in indexes]
+        else:
+            matches = [index.between(group, ms - before_ms, ms + after_ms) for index in indexes]
+        if outer:
+            matches = [found or [None] for found in matches]
+        yield from itertools.product((anchor,), *matches)
+
+
+def fetch_sensor_events(client, devices: List[str], sensors: List[str], start_time: str, end_time: str,
+                        with_meta: Optional[bool] = False) -> Dict[str, List[dict]]:
+    """Events of each sensor on all devices, each event tagged with its ``deviceId``.  A device's sensors are
+    fetched with one merged request, and devices are queried concurrently."""
+
+    def fetch(device: str) -> Dict[str, List[dict]]:
+        planner = QueryPlanner(client)
+        futures = {sensor: planner.submit('query_sensor_flat', SensorQuery(
+            device_id=device, sensors=[sensor], start_time=start_time, end_time=end_time, with_meta=with_meta))
+            for sensor in sensors}
+        with profiler.span('query_flat', device=device):
+            planner.execute()
+        events = {sensor: future.result() for sensor, future in futures.items()}
+        for sensor_events in events.values():
+            for event in sensor_events:
+                event.setdefault('deviceId', device)
+        return events
+
+    by_sensor = {sensor: [] for sensor in sensors}
+    with ThreadPoolExecutor(max_workers=min(len(devices), MAX_FETCH_THREADS)) as executor:
+        for events in executor.map(fetch, devices):
+            for sensor, sensor_events in events.items():
+                by_sensor[sensor].extend(sensor_events)
+    return by_sensor
+
+
+def _match_row(match: tuple, group) -> dict:
+    anchor_ms = event_time(match[0])
+    return {
+        'key': group,
+        'time': match[0]['timeCollected'],
+        # seconds from the anchor to each event, None where an outer join found nothing
+        'offsets': [None if event is None else (event_time(event) - anchor_ms) / 1000 for event in match],
+        'events': list(match),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Join the events of several sensors and devices on time: every combination of events of the other '
+                    'sensors within a window around each event of the first sensor.')
+    parser.add_argument('--devices', required=True, help='comma separated device IDs (BAI_XXXXXXX) to query')
+    parser.add_argument('--sensors', required=True,
+                        help='comma separated sensors.  Events of the first are matched with events of the others.')
+    parser.add_argument('--window', type=float, default=DEFAULT_WINDOW_SECONDS,
+                        help=f'seconds before and after an event to match events in.  Defaults to '
+                             f'{DEFAULT_WINDOW_SECONDS}.')
+    parser.add_argument('--before', type=float, help='seconds before an event to match events in, instead of --window')
+    parser.add_argument('--after', type=float, help='seconds after an event to match events in, instead of --window')
+    parser.add_argument('--by', default='deviceId',
+                        help='event field, or meta field (e.g. meta.zone or zone), matched events must share.  Events '
+                             'without the field match nothing.  Defaults to deviceId; "none" matches events across '
+                             'devices.')
+    parser.add_argument('--outer', action='store_true',
+                        help='also output events of the first sensor without a match for some sensor')
+    parser.add_argument('--output', help='JSON lines file to write the matches to, instead of printing them')
+    parser.add_argument('--lastMinutes', type=int, help='query the last N minutes')
+    parser.add_argument('--lastHours', type=int, help='query the last N hours')
+    parser.add_argument('--lastDays', type=int, help='query the last N days')
+    parser.add_argument('--startTime',
+                        help='start of the time range to query, in any format dateutil supports.  Times without a time '
+                             'zone are local time.')
+    parser.add_argument('--endTime', help='end of the time range to query, like --startTime.  Defaults to now.')
+    parser.add_argument('--key', help='API key.  Defaults to $API_KEY.')
+    parser.add_argument('--noMeta', action='store_true',
+                        help='query events without their meta, unless --by or --where use meta fields.  The output '
+                             'events then have no meta.')
+    add_where_argument(parser)
+    args = parser.parse_args(argv)
+
+    from client import client_from_env
+    from sensor_query import time_parse
+    sensors = args.sensors.split(',')
+    if len(sensors) < 2:
+        parser.error('--sensors needs at least two sensors to join')
+    devices = args.devices.split(',')
+    time_parse(args, parser)
+    before = args.window if args.before is None else args.before
+    after = args.window if args.after is None else args.after
+    key = None if args.by.lower() == 'none' else event_getter(args.by)
+
+    client = client_from_env(args.key)
+    event_filter = where_filter(args.where)
+    # meta fields of --by and --where can only be read from events queried with meta
+    uses_meta = (key is not None and args.by not in EVENT_FIELDS) or (event_filter and event_filter.uses_meta)
+    with_meta = False if args.noMeta and not uses_meta else None
+    by_sensor = fetch_sensor_events(client, devices, sensors, args.startTime, args.endTime, with_meta)
+    if event_filter:
+        by_sensor = {sensor: event_filter.apply(events) for sensor, events in by_sensor.items()}
+    for sensor, events in by_sensor.items():
+        print(f'{len(events)} {sensor} events')
+
+    anchors = sorted(by_sensor[sensors[0]], key=event_time)
+    counts = {}
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        with profiler.span('temporal_join', 'join', anchors=len(anchors)):
+            for match in temporal_join(anchors, [by_sensor[sensor] for sensor in sensors[1:]],
+                                       int(before * 1000), int(after * 1000), key=key, outer=args.outer):
+                group = key(match[0]) if key else None
+                counts[group] = counts.get(group, 0) + 1
+                output.write(json.dumps(_match_row(match, group), default=str) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(f'{sum(counts.values())} matches of {len(anchors)} {sensors[0]} events with '
+          f'{", ".join(sensors[1:])} from {before}s before to {after}s after')
+    if key:
+        for group, count in sorted(counts.items(), key=lambda item: -item[1]):
+            print(f'  {args.by} {group}: {count}')
+    if hasattr(client, 'transfer_summary'):
+        print(client.transfer_summary())
+    return counts
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import json
+from typing import Dict, Iterable, List
+
+from utils import to_epoch_ms
+
+
+def objects_in_region(input: json):
+    try:
+        return int(input['meta']['numObjectsInRegion'])
+    except KeyError:
+        return 0
+
+
+def get_object_id(event: json):
+    return event['meta']['object']['uniqueId']
+
+
+class Track:
+    """All events for one object, sorted by timeCollected when read.
+
+    Events are appended as they are added.  Events of one sensor query arrive in time order, so after adding several
+    sensors' events the list is a few sorted runs, which the one stable sort on the next read merges in about linear
+    time (instead of inserting each out of order event into place).
+    """
+
+    object_id: str
+    sensors: List[str]
+    max_objects_in_region: int
+
+    def __init__(self, object_id: str):
+        self.object_id = object_id
+        self._events = []
+        self._times = []
+        self._sorted = True
+        self.sensors = []
+        self.max_objects_in_region = 0
+
+    def add(self, event: dict):
+        time = to_epoch_ms(event['timeCollected'])
+        if self._times and time < self._times[-1]:
+            self._sorted = False
+        self._times.append(time)
+        self._events.append(event)
+        if event['sensorId'] not in self.sensors:
+            self.sensors.append(event['sensorId'])
+        self.max_objects_in_region = max(self.max_objects_in_region, objects_in_region(event))
+
+    def _sort(self):
+        if not self._sorted:
+            # stable, so events with the same time keep the order they were added in
+            order = sorted(range(len(self._times)), key=self._times.__getitem__)
+            self._times = [self._times[i] for i in order]
+            self._events = [self._events[i] for i in order]
+            self._sorted = True
+
+    @property
+    def events(self) -> List[dict]:
+        self._sort()
+        return self._events
+
+    @property
+    def times(self) -> List[int]:
+        self._sort()
+        return self._times
+
+    @property
+    def first_seen(self) -> str:
+        return self.events[0]['timeCollected']
+
+    @property
+    def last_seen(self) -> str:
+        return self.events[-1]['timeCollected']
+
+    def summary(self) -> dict:
+        return {
+            'objectId': self.object_id,
+            'firstSeen': self.first_seen,
+            'lastSeen': self.last_seen,
+            'numEvents': len(self.events),
+            'sensors': self.sensors,
+            'maxObjectsInRegion': self.max_objects_in_region,
+        }
+
+
+class TrackBuilder:
+    """Builds object tracks in a single pass by indexing events on ``meta.object.uniqueId``.
+
+    Events from any number of sensor queries can be added; events without an object ID are skipped.
+    """
+
+    tracks: Dict[str, Track]
+
+    def __init__(self):
+        self.tracks = {}
+
+    def add(self, event: dict):
+        try:
+            object_id = get_object_id(event)
+        except (KeyError, TypeError):
+            return
+        track = self.tracks.get(object_id)
+        if track is None:
+            track = self.tracks[object_id] = Track(object_id)
+        track.add(event)
+
+    def add_all(self, events: Iterable[dict]):
+        for event in events:
+            self.add(event)
+
+    def get(self, object_id: str) -> Track:
+        return self.tracks.get(object_id)
+
+    def summaries(self) -> List[dict]:
+        return [track.summary() for track in self.tracks.values()]
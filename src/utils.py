@@ -1,5 +1,31 @@
 import datetime
 
+from dateutil import parser as date_parser
+from dateutil import tz
+
 
 def get_media_range(event_start: datetime, look_back: int = 15, look_forward: int = 15):
     return event_start - datetime.timedelta(minutes=look_back), event_start + datetime.timedelta(minutes=look_forward)
+
+
+def response_data(response):
+    """The list in a response, which some endpoints wrap in a ``data`` key."""
+    return response['data'] if isinstance(response, dict) and 'data' in response else response
+
+
+def to_epoch_ms(value) -> int:
+    """Convert a Data API timestamp (ISO string or datetime) to milliseconds since the epoch.
+
+    Naive datetimes are treated as UTC, which is how the Data API interprets them.
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = date_parser.isoparse(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=tz.UTC)
+    return int(value.timestamp() * 1000)
+
+
+def from_epoch_ms(value: int) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(value / 1000, tz=tz.UTC)
@@ -0,0 +1,44 @@
+import requests
+
+from device_status_check import devices_with_recent_data
+
+
+class StubClient:
+    """Answers the workspace sensor query with ``workspace`` (or raises it) and per-device queries from ``devices``."""
+
+    def __init__(self, workspace, devices):
+        self.workspace = workspace
+        self.devices = devices
+        self.device_queries = []
+
+    def get_sensors_by_workspace(self, query):
+        if isinstance(self.workspace, Exception):
+            raise self.workspace
+        return self.workspace
+
+    def query_sensors_by_device(self, query):
+        self.device_queries.append(query)
+        return self.devices.get(query.device_id, [])
+
+
+def test_empty_workspace_response_falls_back_to_device_queries():
+    client = StubClient({'data': []}, {'BAI_1': [{'sensorName': 'PRESENCE_PERSON_1'}]})
+    assert devices_with_recent_data(client, 'workspace', ['BAI_1', 'BAI_2']) == {'BAI_1'}
+    assert len(client.device_queries) == 2
+    assert all(isinstance(query.start_time, str) for query in client.device_queries)
+
+
+def test_workspace_rows_without_device_ids_fall_back_to_device_queries():
+    client = StubClient({'data': [{'sensorName': 'PRESENCE_PERSON_1'}]}, {'BAI_2': [{'sensorName': 'X'}]})
+    assert devices_with_recent_data(client, 'workspace', ['BAI_1', 'BAI_2']) == {'BAI_2'}
+
+
+def test_workspace_query_error_falls_back_to_device_queries():
+    client = StubClient(requests.HTTPError('500 Server Error'), {'BAI_1': [{'sensorName': 'X'}]})
+    assert devices_with_recent_data(client, 'workspace', ['BAI_1']) == {'BAI_1'}
+
+
+def test_workspace_response_is_used_when_it_has_device_ids():
+    client = StubClient({'data': [{'deviceId': 'BAI_1'}, {'deviceId': 'BAI_3'}]}, {})
+    assert devices_with_recent_data(client, 'workspace', ['BAI_1', 'BAI_2']) == {'BAI_1'}
+    assert client.device_queries == []
@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from filters import EventFilter
+
+
+def events(count=120):
+    start = datetime(2024, 1, 1, 1, 0)
+    return [{'id': str(i), 'timeCollected': (start + timedelta(seconds=61 * i)).isoformat() + 'Z',
+             'sensorName': 'PRESENCE_PERSON_1' if i % 2 else 'COLLISION_1', 'value': i % 5 - 1,
+             'meta': {'timeOn': i % 3 if i % 7 else None, 'zone': 'a' if i % 4 else ''}}
+            for i in range(count)]
+
+
+@pytest.mark.parametrize('expression', [
+    'minute and hour',
+    'value and minute',
+    'value or minute',
+    'timeOn and value',
+    'zone or value',
+    'not value and hour',
+    'minute and hour or value',
+    "value and matches(sensor, 'PRESENCE_*')",
+    'value / 0 > 1',
+    'minute % 0 < 1',
+    'value * 1e308 * 10 > 0',
+])
+def test_mask_agrees_with_call(expression):
+    event_filter = EventFilter(expression)
+    batch = events()
+    assert event_filter.mask(batch).tolist() == [event_filter(event) for event in batch]
+
+
+def test_and_of_integers_is_logical():
+    # minute=2 and hour=1 is 2 & 1 == 0 bitwise, but true as a condition
+    event = {'id': '1', 'timeCollected': '2024-01-01T01:02:00Z', 'value': 1}
+    event_filter = EventFilter('minute and hour')
+    assert event_filter(event)
+    assert event_filter.mask([event]).tolist() == [True]
@@ -0,0 +1,27 @@
+import pytest
+
+from ranking import GroupedTopK, TopK, top_k
+
+
+def events():
+    return [{'id': str(i), 'sensorId': f'S{i % 2}', 'count': i % 7} for i in range(30)]
+
+
+def count(event):
+    return event['count']
+
+
+@pytest.mark.parametrize('k', [0, -1])
+def test_no_events_are_kept_for_k_below_one(k):
+    top = TopK(k, count)
+    top.add_all(events())
+    assert top.results() == []
+    assert len(top) == 0
+    assert top_k(events(), k, count) == []
+    grouped = GroupedTopK(k, count, group=lambda event: event['sensorId'])
+    grouped.add_all(events())
+    assert all(results == [] for results in grouped.results().values())
+
+
+def test_largest_keys_first_and_earlier_events_win_ties():
+    assert [event['id'] for event in top_k(events(), 3, count)] == ['6', '13', '20']